@@ -32,11 +32,13 @@ from ethereum.utils import (
 from gevent.event import Event
 
 from . import config as app_config
+from . import db_bench
 from . import eth_protocol
 from . import utils
 from .accounts import AccountsService, Account
 from .console_service import Console
-from .db_service import DBService
+from .db_maintenance_service import DBMaintenanceService
+from .db_service import DBService, dbs
 from .eth_service import ChainService
 from .jsonrpc import JSONRPCServer, IPCRPCServer
 from .pow_service import PoWService
@@ -49,8 +51,8 @@ from pyethapp.utils import merge_dict, load_contrib_services, FallbackChoice, \
 
 log = slogging.get_logger('app')
 
-services = [DBService, AccountsService, NodeDiscovery, PeerManager, ChainService,
-            PoWService, ValidatorService, JSONRPCServer, IPCRPCServer, Console]
+services = [DBService, DBMaintenanceService, AccountsService, NodeDiscovery, PeerManager,
+            ChainService, PoWService, ValidatorService, JSONRPCServer, IPCRPCServer, Console]
 
 
 class EthApp(BaseApp):
@@ -476,7 +478,10 @@ def import_blocks(ctx, file):
 
     Use - to read from stdin.
     """
-    app = EthApp(ctx.obj['config'])
+    config = dict(ctx.obj['config'])
+    # blocks are written in large batches, see DBService
+    config['db'] = dict(config['db'], group_commit=True)
+    app = EthApp(config)
     DBService.register_with_app(app)
     AccountsService.register_with_app(app)
     ChainService.register_with_app(app)
@@ -531,6 +536,93 @@ def import_blocks(ctx, file):
     log.info('import finished', head_number=app.services.chain.chain.head.number)
 
 
+@app.command('backfill_receipts')
+@click.option('--from', 'from_', type=int, help='Number of the first block (default: genesis)')
+@click.option('--to', type=int, help='Number of the last block (default: latest)')
+@click.pass_context
+def backfill_receipts(ctx, from_, to):
+    """Store the receipts of the canonical blocks imported without them.
+
+    Blocks imported by this version store their receipts, data directories of older versions
+    compute them on each lookup until this has been run once. Blocks whose receipts are stored
+    already are skipped, so an interrupted backfill can be resumed.
+    """
+    app = EthApp(ctx.obj['config'])
+    DBService.register_with_app(app)
+    AccountsService.register_with_app(app)
+    ChainService.register_with_app(app)
+    chain = app.services.chain
+
+    head_number = chain.chain.head.number
+    from_ = max(from_ or 0, 1)  # the genesis has no transactions
+    to = head_number if to is None else min(to, head_number)
+    log.info('backfilling receipts', first=from_, last=to)
+    stored = chain.backfill_receipts(from_, to)
+    log.info('backfill finished', stored=stored)
+
+
+@app.group()
+@click.pass_context
+def bench(ctx):
+    """Run benchmarks."""
+
+
+@bench.command('db')
+@click.option('--backend', '-b', 'backends', multiple=True, type=click.Choice(sorted(dbs)),
+              help='db implementation to benchmark, can be given multiple times (default: all)')
+@click.option('--cache-size', '-s', 'cache_sizes', multiple=True, type=int,
+              help='read cache size in bytes, can be given multiple times (default: '
+                   'db.cache_size)')
+@click.option('--workload', '-w', 'workload_names', multiple=True,
+              type=click.Choice(db_bench.WORKLOADS),
+              help='workload to run, can be given multiple times (default: all, "trace" only '
+                   'if a trace file is given)')
+@click.option('--ops', '-n', type=int, default=10000, help='operations per run (default: 10000)')
+@click.option('--accounts', type=int, default=10000,
+              help='number of accounts in the state read by the "reads" workload')
+@click.option('--trace', type=click.Path(exists=True, dir_okay=False),
+              help='db access trace recorded with "-c db.trace_file=FILE"')
+@click.option('--json', 'as_json', is_flag=True, help='print the results as JSON')
+@click.pass_context
+def bench_db(ctx, backends, cache_sizes, workload_names, ops, accounts, trace, as_json):
+    """Benchmark the db backends.
+
+    Each combination of backend, cache size and workload runs on a new, temporary database in
+    a separate process. Reported are operations per second, the median and 99th percentile
+    latency of an operation (for "appends" a block, for "mixed" a commit cycle), the bytes
+    written and the peak RSS of the process.
+    """
+    backends = backends or sorted(dbs)
+    cache_sizes = cache_sizes or [ctx.obj['config']['db']['cache_size']]
+    if not workload_names:
+        workload_names = [w for w in db_bench.WORKLOADS if w != 'trace' or trace]
+    results = []
+    fmt = ('{backend:<8} {cache_size:>10} {workload:<8} {ops:>8} {ops_per_sec:>10.0f} '
+           '{p50:>9.3f} {p99:>9.3f} {written:>11.1f} {rss:>8.1f}')
+    if not as_json:
+        click.echo('{:<8} {:>10} {:<8} {:>8} {:>10} {:>9} {:>9} {:>11} {:>8}'.format(
+            'backend', 'cache', 'workload', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 'written MB',
+            'RSS MB'))
+    for backend in backends:
+        for cache_size in cache_sizes:
+            for workload in workload_names:
+                try:
+                    result = db_bench.run_isolated(backend, cache_size, workload, ops,
+                                                   accounts=accounts, trace=trace)
+                except RuntimeError as e:
+                    log.error('benchmark failed', backend=backend, workload=workload, error=e)
+                    continue
+                results.append(result)
+                if not as_json:
+                    click.echo(fmt.format(**dict(result,
+                                                 written=result['bytes_written'] / 1024.**2,
+                                                 rss=result['peak_rss'] / 1024.**2,
+                                                 p50=result['p50'] * 1000,
+                                                 p99=result['p99'] * 1000)))
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+
+
 @app.group()
 @click.pass_context
 def account(ctx):
@@ -0,0 +1,168 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from __future__ import division
+import math
+import os
+from hashlib import md5
+from builtins import object
+from builtins import range
+import rlp
+from ethereum.slogging import get_logger
+from ethereum.utils import to_string, big_endian_to_int
+
+log = get_logger('db')
+
+HASH_NAMESPACE = b''
+
+
+def key_namespace(key):
+    """Return the namespace of a db key.
+
+    Keys of 32 bytes are hashes (trie nodes, blocks, code) and have a namespace of their own,
+    other keys are namespaced by their prefix up to the first ``:``, e.g. ``b'block:'``.
+    """
+    if len(key) == 32:
+        return HASH_NAMESPACE
+    i = key.find(b':')
+    return key[:i + 1] if i >= 0 else key
+
+
+class BloomFilter(object):
+
+    """A Bloom filter over byte strings.
+
+    Membership tests may give false positives at roughly the configured error rate as long as
+    no more than `capacity` keys are added, but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, num_bits=None, num_hashes=None, count=0,
+                 bits=None):
+        self.capacity = max(1, capacity)
+        if num_bits is None:
+            num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+            num_bits = (num_bits + 7) // 8 * 8
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits / self.capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.bits = bytearray(bits) if bits is not None else bytearray(num_bits // 8)
+        assert len(self.bits) * 8 == self.num_bits
+
+    def _positions(self, key):
+        # double hashing, see Kirsch and Mitzenmacher
+        digest = md5(key).digest()
+        h1 = big_endian_to_int(digest[:8])
+        h2 = big_endian_to_int(digest[8:]) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    @property
+    def saturated(self):
+        return self.count > self.capacity
+
+    def serialize(self):
+        return [self.capacity, self.num_bits, self.num_hashes, self.count, bytes(self.bits)]
+
+    @classmethod
+    def deserialize(cls, data):
+        capacity, num_bits, num_hashes, count = [big_endian_to_int(x) for x in data[:4]]
+        return cls(capacity, num_bits=num_bits, num_hashes=num_hashes, count=count,
+                   bits=data[4])
+
+
+class KeyFilter(object):
+
+    """Bloom filters of the keys in a database, one per :func:`key_namespace`.
+
+    Keys are only ever added, so deleted keys stay (false) positives until the filter is
+    rebuilt. Namespaces seen for the first time get a filter for `min_capacity` keys.
+
+    :ivar negatives: number of lookups answered without touching the database
+    :ivar epoch: tag of the database state the loaded filter was saved for
+    """
+
+    def __init__(self, error_rate=0.01, min_capacity=10000):
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.filters = dict()
+        self.negatives = 0
+        self.epoch = b''
+
+    @classmethod
+    def build(cls, keys, counts, error_rate=0.01, min_capacity=10000):
+        """Create a filter sized for `counts` (namespace -> number of keys) and add `keys`."""
+        key_filter = cls(error_rate, min_capacity)
+        for namespace, count in counts.items():
+            # leave room for the namespace to grow until the next rebuild
+            key_filter.filters[namespace] = BloomFilter(max(min_capacity, 2 * count), error_rate)
+        for key in keys:
+            key_filter.add(key)
+        return key_filter
+
+    def add(self, key):
+        key = to_string(key)
+        namespace = key_namespace(key)
+        try:
+            bloom = self.filters[namespace]
+        except KeyError:
+            bloom = self.filters[namespace] = BloomFilter(self.min_capacity, self.error_rate)
+        bloom.add(key)
+        if bloom.count == bloom.capacity + 1:
+            log.info('bloom filter saturated, false positives will increase',
+                     namespace=namespace, capacity=bloom.capacity)
+
+    def might_contain(self, key):
+        key = to_string(key)
+        bloom = self.filters.get(key_namespace(key))
+        if bloom is None or key not in bloom:
+            self.negatives += 1
+            return False
+        return True
+
+    @property
+    def saturated(self):
+        return any(bloom.saturated for bloom in self.filters.values())
+
+    @property
+    def stats(self):
+        return dict(namespaces=len(self.filters), negatives=self.negatives,
+                    keys=sum(bloom.count for bloom in self.filters.values()),
+                    size=sum(len(bloom.bits) for bloom in self.filters.values()))
+
+    def save(self, path, epoch=b''):
+        """Write the filter to `path`, tagged with `epoch` to match it with the database."""
+        data = [[namespace, bloom.serialize()] for namespace, bloom in self.filters.items()]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(rlp.encode([epoch, data]))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, error_rate=0.01, min_capacity=10000):
+        """Load a filter saved by :meth:`save` and remove the file.
+
+        The file is only valid for the database state at the time it was written, so it is
+        removed on load and its :attr:`epoch` has to be compared with the one stored in the
+        database by the caller.
+        """
+        with open(path, 'rb') as f:
+            epoch, data = rlp.decode(f.read())
+        os.remove(path)
+        key_filter = cls(error_rate, min_capacity)
+        key_filter.epoch = epoch
+        for namespace, bloom in data:
+            key_filter.filters[namespace] = BloomFilter.deserialize(bloom)
+        return key_filter
@@ -0,0 +1,196 @@
+# -*- coding: utf8 -*-
+"""Value codecs for the db backends.
+
+Every value is stored with a one byte tag naming the codec it was encoded with, so values
+written with different settings can be mixed in the same database. The codec used for new
+values is chosen per key class, see :func:`key_class`.
+
+snappy and zstd are optional, they are used if the `python-snappy` and `zstandard` packages are
+installed.
+"""
+from __future__ import absolute_import
+import zlib
+from builtins import object
+from ethereum.slogging import get_logger
+from .bloom_filter import key_namespace
+
+log = get_logger('db')
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class NoneCodec(object):
+    name = 'none'
+    tag = b'\x00'
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(object):
+    name = 'zlib'
+    tag = b'\x01'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class SnappyCodec(object):
+    name = 'snappy'
+    tag = b'\x02'
+
+    def compress(self, data):
+        return snappy.compress(data)
+
+    def decompress(self, data):
+        return snappy.decompress(data)
+
+
+class ZstdCodec(object):
+
+    """zstd, optionally with a dictionary trained on samples of the values (see
+    :func:`train_zstd_dictionary`), which helps with small values like trie nodes."""
+
+    name = 'zstd'
+    tag = b'\x03'
+
+    def __init__(self, level=3, dictionary=None):
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+def available_codecs():
+    names = ['none', 'zlib']
+    if snappy is not None:
+        names.append('snappy')
+    if zstandard is not None:
+        names.append('zstd')
+    return names
+
+
+def train_zstd_dictionary(samples, size=112640):
+    """Train a zstd dictionary of `size` bytes on a list of sample values."""
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def _list_payload(data, offset=0):
+    "returns the offset of the payload of the RLP list at `offset` or -1 for other items"
+    prefix = bytearray(data[offset:offset + 1])
+    if not prefix or prefix[0] < 0xc0:
+        return -1
+    if prefix[0] <= 0xf7:
+        return offset + 1
+    return offset + 1 + prefix[0] - 0xf7
+
+
+def is_block_body(value):
+    """If `value` looks like the RLP of a block stored under its hash.
+
+    Blocks are lists starting with the header, a list longer than 55 bytes. Trie nodes are
+    lists of strings or of embedded nodes shorter than 32 bytes, so they never start like this.
+    """
+    payload = _list_payload(value)
+    if payload < 0:
+        return False
+    first = bytearray(value[payload:payload + 1])
+    return bool(first) and first[0] >= 0xf8
+
+
+def key_class(key, value=b''):
+    """Return the class of a db key used to select its codec.
+
+    32 byte keys are hashes, in class ``'body'`` for blocks (see :func:`is_block_body`) and in
+    class ``'node'`` for trie nodes and code, both fall back to the codec of class ``'hash'``.
+    Prefixed keys like ``b'block:1'`` are in the class named by the prefix (``'block'``), all
+    others in ``'default'``.
+    """
+    if len(key) == 32:
+        return 'body' if is_block_body(value) else 'node'
+    namespace = key_namespace(key)
+    if namespace.endswith(b':'):
+        return namespace[:-1].decode('latin-1')
+    return 'default'
+
+
+class ValueCodec(object):
+
+    """Encodes values with the codec configured for their key class and decodes tagged values.
+
+    :param key_codecs: mapping of key class to codec name, the ``'default'`` entry applies to
+                       all classes not listed
+    :param tagged: `False` for databases written before tags were introduced, values are then
+                   stored as is and compression is disabled
+    :param zstd_dictionary: dictionary used by the zstd codec, it must not change for the
+                            lifetime of a database
+    :param min_size: values shorter than this are not compressed
+    """
+
+    def __init__(self, key_codecs=None, tagged=True, zstd_dictionary=None, min_size=64):
+        self.tagged = tagged
+        self.min_size = min_size
+        self.codecs = {NoneCodec.tag: NoneCodec(), ZlibCodec.tag: ZlibCodec()}
+        if snappy is not None:
+            self.codecs[SnappyCodec.tag] = SnappyCodec()
+        if zstandard is not None:
+            self.codecs[ZstdCodec.tag] = ZstdCodec(dictionary=zstd_dictionary)
+        by_name = dict((codec.name, codec) for codec in self.codecs.values())
+        self.key_codecs = dict()
+        for cls, name in (key_codecs or dict()).items():
+            if name not in by_name:
+                raise ValueError('codec %s for %s keys is not available, choose one of %s' %
+                                 (name, cls, ', '.join(available_codecs())))
+            self.key_codecs[cls] = by_name[name]
+        self.default_codec = self.key_codecs.pop('default', by_name['none'])
+        if 'hash' in self.key_codecs:
+            for cls in ('body', 'node'):
+                self.key_codecs.setdefault(cls, self.key_codecs['hash'])
+
+    def encode(self, key, value):
+        if not self.tagged:
+            return value
+        codec = self.key_codecs.get(key_class(key, value), self.default_codec)
+        if codec.tag != NoneCodec.tag and len(value) >= self.min_size:
+            compressed = codec.compress(value)
+            if len(compressed) < len(value):
+                return codec.tag + compressed
+        return NoneCodec.tag + value
+
+    def decode(self, data):
+        data = bytes(data)
+        if not self.tagged:
+            return data
+        try:
+            codec = self.codecs[data[:1]]
+        except KeyError:
+            raise ValueError('value encoded with an unknown codec (tag %r)' % data[:1])
+        return codec.decompress(data[1:])
+
+    def __repr__(self):
+        if not self.tagged:
+            return '<ValueCodec untagged>'
+        return '<ValueCodec default=%s %s>' % (self.default_codec.name, ' '.join(
+            '%s=%s' % (cls, codec.name) for cls, codec in sorted(self.key_codecs.items())))
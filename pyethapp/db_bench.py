@@ -0,0 +1,262 @@
+# -*- coding: utf8 -*-
+"""Benchmarks of the db backends over trie and block workloads, see ``pyethapp bench db``.
+
+Every combination of backend, cache size and workload runs in a fresh database in a child
+process, so that the peak RSS and the bytes written can be attributed to it.
+
+Workloads:
+
+trace    replay of a db access trace recorded by a node with ``db.trace_file`` set
+reads    random account reads from a state trie
+appends  sequential block appends, committing every block
+mixed    commit cycles of random reads and writes of trie nodes
+"""
+from __future__ import absolute_import
+from __future__ import division
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from builtins import object
+from builtins import range
+import gipc
+from devp2p.app import BaseApp
+from ethereum.utils import sha3, to_string, encode_hex, decode_hex, int_to_big_endian, zpad
+from ethereum.slogging import get_logger
+
+log = get_logger('db.bench')
+
+WORKLOADS = ('trace', 'reads', 'appends', 'mixed')
+
+
+class TraceWriter(object):
+
+    """Records db accesses for the ``trace`` workload, one per line.
+
+    ``g <hex key> <value size or -1>`` for reads, ``p <hex key> <value size>`` for writes and
+    ``c`` for commits.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def get(self, key, size):
+        self.f.write('g %s %d\n' % (encode_hex(key), size))
+
+    def put(self, key, size):
+        self.f.write('p %s %d\n' % (encode_hex(key), size))
+
+    def commit(self):
+        self.f.write('c\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_trace(path):
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] == 'c':
+                yield 'c', None, 0
+            else:
+                yield parts[0], decode_hex(parts[1]), int(parts[2])
+
+
+class Latencies(object):
+
+    def __init__(self):
+        self.samples = []
+
+    def measure(self, func, *args):
+        st = time.time()
+        result = func(*args)
+        self.samples.append(time.time() - st)
+        return result
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.
+        samples = sorted(self.samples)
+        return samples[int(round(p * (len(samples) - 1)))]
+
+
+def random_bytes(rnd, size):
+    if size == 0:
+        return b''
+    return zpad(int_to_big_endian(rnd.getrandbits(8 * size)), size)
+
+
+def load_trace_reads(db, rnd, trace):
+    "puts random values of the traced sizes for the keys the trace reads before writing them"
+    written = set()
+    for op, key, size in read_trace(trace):
+        if op == 'p':
+            written.add(key)
+        elif op == 'g' and size >= 0 and key not in written:
+            db.put(key, random_bytes(rnd, size))
+            written.add(key)
+    db.commit()
+
+
+def replay_op(db, rnd, latencies, op, key, size):
+    "measures a single traced operation, a missing key is not an error"
+    if op == 'g':
+        try:
+            latencies.measure(db.get, key)
+        except KeyError:
+            pass
+    elif op == 'p':
+        latencies.measure(db.put, key, random_bytes(rnd, size))
+    else:
+        latencies.measure(db.commit)
+
+
+def run_trace(db, rnd, latencies, ops, trace=None, **options):
+    """Replay `trace`, keys read before they are written are loaded beforehand."""
+    if trace is None:
+        raise ValueError('the trace workload needs a trace file')
+    load_trace_reads(db, rnd, trace)
+    count = 0
+    for op, key, size in read_trace(trace):
+        replay_op(db, rnd, latencies, op, key, size)
+        count += 1
+        if count == ops:
+            break
+    return count
+
+
+def run_reads(db, rnd, latencies, ops, accounts=10000, **options):
+    """Read random accounts from a state trie of `accounts` accounts."""
+    from ethereum.config import Env
+    from ethereum.db import RefcountDB
+    from ethereum.securetrie import SecureTrie
+    from ethereum.state import State
+    from ethereum.trie import Trie
+    addresses = [random_bytes(rnd, 20) for _ in range(accounts)]
+    state = State(env=Env(db))
+    for i, address in enumerate(addresses):
+        state.set_balance(address, i + 1)
+    state.commit()
+    db.commit()
+    trie = SecureTrie(Trie(RefcountDB(db), state.trie.root_hash))
+    for _ in range(ops):
+        latencies.measure(trie.get, rnd.choice(addresses))
+    return ops
+
+
+def run_appends(db, rnd, latencies, ops, block_size=2048, **options):
+    """Append blocks of `block_size` bytes, half of them random, committing each block."""
+
+    def append(number, block):
+        blockhash = sha3(block)
+        db.put(blockhash, block)
+        db.put(b'block:' + to_string(number), blockhash)
+        db.commit()
+
+    for number in range(ops):
+        block = random_bytes(rnd, block_size // 2) + b'\x00' * (block_size // 2)
+        latencies.measure(append, number, block)
+    return ops
+
+
+def run_mixed(db, rnd, latencies, ops, reads_per_commit=50, writes_per_commit=10, **options):
+    """Commit cycles reading random trie nodes and writing new ones."""
+    keys = []
+    for _ in range(max(1000, ops)):
+        value = random_bytes(rnd, rnd.randint(70, 530))
+        keys.append(sha3(value))
+        db.put(keys[-1], value)
+    db.commit()
+
+    def cycle(reads, writes):
+        for key in reads:
+            db.get(key)
+        for key, value in writes:
+            db.put(key, value)
+        db.commit()
+
+    cycles = max(1, ops // (reads_per_commit + writes_per_commit))
+    for _ in range(cycles):
+        reads = [rnd.choice(keys) for _ in range(reads_per_commit)]
+        values = [random_bytes(rnd, rnd.randint(70, 530)) for _ in range(writes_per_commit)]
+        writes = [(sha3(value), value) for value in values]
+        latencies.measure(cycle, reads, writes)
+        keys.extend(key for key, _ in writes)
+    return cycles * (reads_per_commit + writes_per_commit)
+
+
+workloads = dict(trace=run_trace, reads=run_reads, appends=run_appends, mixed=run_mixed)
+
+
+def written_bytes():
+    """Bytes written to storage by this process, `None` where unknown."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run(implementation, cache_size, workload, ops, seed=0, **options):
+    """Run `workload` on a new db and return the measurements."""
+    from .db_service import DBService
+    data_dir = tempfile.mkdtemp(prefix='pyethapp-bench-')
+    try:
+        app = BaseApp(config=dict(data_dir=data_dir,
+                                  db=dict(implementation=implementation, cache_size=cache_size)))
+        db = DBService(app)
+        db.start()
+        rnd = random.Random(seed)
+        latencies = Latencies()
+        written_before = written_bytes()
+        count = workloads[workload](db, rnd, latencies, ops, **options)
+        elapsed = sum(latencies.samples)  # setup of the workload excluded
+        db.commit()
+        written = written_bytes()
+        if written is None:
+            written = disk_usage(data_dir)
+        else:
+            written -= written_before
+        db.stop()
+        return dict(backend=implementation, cache_size=cache_size, workload=workload, ops=count,
+                    ops_per_sec=count / elapsed if elapsed else 0.,
+                    p50=latencies.percentile(0.5), p99=latencies.percentile(0.99),
+                    bytes_written=written, peak_rss=peak_rss())
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _run_in_process(writer, args, options):
+    try:
+        writer.put(run(*args, **options))
+    except Exception as e:
+        writer.put(dict(error='%s: %s' % (e.__class__.__name__, e)))
+
+
+def run_isolated(*args, **options):
+    """Like :func:`run`, but in a child process."""
+    with gipc.pipe() as (reader, writer):
+        process = gipc.start_process(target=_run_in_process, args=(writer, args, options))
+        result = reader.get()
+        process.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from __future__ import division
+import time
+import gevent
+from builtins import range
+from devp2p.service import BaseService
+from ethereum.slogging import get_logger
+
+log = get_logger('db.maintenance')
+
+
+class DBMaintenanceService(BaseService):
+
+    """Compacts and measures the db backend of the :class:`pyethapp.db_service.DBService`.
+
+    Every ``dbmaintenance.interval`` seconds:
+
+    - LevelDB: the key space is split by the first byte of the keys into
+      ``compaction_ranges`` ranges. Ranges which have received at least ``compaction_min_writes``
+      writes since they were last compacted, but none since the previous round (i.e. cold
+      ranges), are compacted with ``CompactRange``, the most written first.
+    - LMDB: the map usage and the freelist are logged and the map is doubled once more than
+      ``lmdb_max_usage`` of it is used.
+
+    Compactions run on a native thread and only while the node is idle: not syncing, at most
+    ``max_block_queue`` blocks waiting for import and the last new block imported within
+    ``latency_budget`` seconds. Between compactions the service sleeps long enough to spend at
+    most ``max_duty`` of the time compacting.
+
+    :ivar stats: the last measurements and the number of compactions
+    """
+
+    name = 'dbmaintenance'
+    default_config = dict(dbmaintenance=dict(
+        interval=60.,  # seconds between maintenance rounds
+        compaction_ranges=16,
+        compaction_min_writes=100000,
+        max_block_queue=0,
+        latency_budget=1.,  # seconds to import a new block, compactions pause above
+        max_duty=0.2,  # fraction of the time spent compacting
+        lmdb_max_usage=0.8,  # fraction of the LMDB map used before it is grown
+    ))
+
+    def __init__(self, app):
+        super(DBMaintenanceService, self).__init__(app)
+        self.db = app.services.db
+        self.backend = self.db.db_service
+        config = self.app.config['dbmaintenance']
+        self.interval = config['interval']
+        self.num_ranges = config['compaction_ranges']
+        assert 0 < self.num_ranges <= 256
+        self.min_writes = config['compaction_min_writes']
+        self.max_block_queue = config['max_block_queue']
+        self.latency_budget = config['latency_budget']
+        self.max_duty = config['max_duty']
+        assert 0 < self.max_duty <= 1
+        self.lmdb_max_usage = config['lmdb_max_usage']
+        self.compacted_writes = [0] * self.num_ranges  # range writes at the last compaction
+        self.round_writes = [0] * self.num_ranges  # range writes at the last round
+        self.stats = dict(compactions=0, compaction_time=0.)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.maintain()
+            except Exception as e:
+                log.error('maintenance failed', error=e, exc_info=True)
+
+    def maintain(self):
+        if hasattr(self.backend, 'map_usage'):
+            self.check_map()
+        if hasattr(self.backend, 'compact_range'):
+            self.compact_cold_ranges()
+
+    def is_idle(self):
+        chain = self.app.services.get('chain')
+        if chain is None:
+            return True
+        if chain.is_syncing or chain.block_queue.qsize() > self.max_block_queue:
+            return False
+        times = chain.newblock_processing_times
+        return not times or times[-1] <= self.latency_budget
+
+    def range_bounds(self, i):
+        """Return the first and last key prefix of the `i`-th key range (`None` if unbounded)."""
+        width = 256 // self.num_ranges
+        start = bytes(bytearray([i * width])) if i else None
+        if i == self.num_ranges - 1:
+            return start, None
+        return start, bytes(bytearray([(i + 1) * width]))
+
+    def _range_writes(self):
+        writes = self.db.writes_by_first_byte
+        width = 256 // self.num_ranges
+        counts = [sum(writes[i * width:(i + 1) * width]) for i in range(self.num_ranges)]
+        counts[-1] += sum(writes[self.num_ranges * width:])
+        return counts
+
+    def cold_ranges(self):
+        """Return the ranges due for compaction, most written first."""
+        counts = self._range_writes()
+        cold = [i for i in range(self.num_ranges)
+                if counts[i] - self.compacted_writes[i] >= self.min_writes and
+                counts[i] == self.round_writes[i]]
+        self.round_writes = counts
+        return sorted(cold, key=lambda i: self.compacted_writes[i] - counts[i])
+
+    def compact_cold_ranges(self):
+        for i in self.cold_ranges():
+            if not self.is_idle():
+                log.debug('not idle, postponing compactions')
+                return
+            start, end = self.range_bounds(i)
+            st = time.time()
+            gevent.get_hub().threadpool.apply(self.backend.compact_range, (start, end))
+            elapsed = time.time() - st
+            self.compacted_writes[i] = self.round_writes[i]
+            self.stats['compactions'] += 1
+            self.stats['compaction_time'] += elapsed
+            log.info('compacted', range=i, elapsed=elapsed)
+            gevent.sleep(elapsed * (1 - self.max_duty) / self.max_duty)
+
+    def check_map(self):
+        usage = self.backend.map_usage()
+        self.stats.update(('lmdb_' + k, v) for k, v in usage.items())
+        log.info('lmdb map usage', **usage)
+        if usage['used'] > self.lmdb_max_usage * usage['map_size']:
+            map_size = 2 * usage['map_size']
+            with self.db.commit_lock:  # held by offloaded writes
+                resized = self.backend.resize(map_size)
+            if resized:
+                log.info('resized lmdb map', map_size=map_size)
+            else:
+                log.debug('transactions open, postponing resize')
+
+    def stop(self):
+        log.info('stopping db maintenance', **self.stats)
+        super(DBMaintenanceService, self).stop()
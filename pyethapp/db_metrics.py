@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from __future__ import division
+import time
+from builtins import object
+from builtins import range
+
+# upper bounds of the latency buckets in seconds: 1us, 2us, 4us, ... ~34s
+BUCKETS = [1e-6 * 2**i for i in range(26)]
+
+
+class Histogram(object):
+
+    """Latencies counted in power of two buckets from 1us.
+
+    Percentiles are reported as the upper bound of the bucket they fall into.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, elapsed):
+        i = 0
+        while i < len(BUCKETS) and elapsed > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    @property
+    def stats(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.total / self.count if self.count else 0.,
+                    p50=self.percentile(0.5), p99=self.percentile(0.99))
+
+
+class DBMetrics(object):
+
+    """Operation counters and latency histograms of a :class:`pyethapp.db_service.DBService`.
+
+    :ivar ops: a :class:`Histogram` per operation (``get``, ``get_many``, ``put``, ``delete``,
+               ``commit``)
+    :ivar bytes_read: size of the values returned
+    :ivar bytes_written: size of the values put
+    :ivar misses: reads of unknown keys
+    :ivar commit_keys: total number of keys written by commits
+    :ivar commit_keys_max: largest number of keys written by a commit
+    """
+
+    def __init__(self):
+        self.ops = dict((op, Histogram()) for op in ('get', 'get_many', 'put', 'delete',
+                                                     'commit'))
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.misses = 0
+        self.commit_keys = 0
+        self.commit_keys_max = 0
+        self.started = time.time()
+
+    def get(self, st, value):
+        self.ops['get'].add(time.time() - st)
+        if value is None:
+            self.misses += 1
+        else:
+            self.bytes_read += len(value)
+
+    def get_many(self, st, values):
+        self.ops['get_many'].add(time.time() - st)
+        for value in values:
+            if value is None:
+                self.misses += 1
+            else:
+                self.bytes_read += len(value)
+
+    def put(self, st, value):
+        self.ops['put'].add(time.time() - st)
+        self.bytes_written += len(value)
+
+    def delete(self, st):
+        self.ops['delete'].add(time.time() - st)
+
+    def commit(self, st, keys):
+        self.ops['commit'].add(time.time() - st)
+        self.commit_keys += keys
+        self.commit_keys_max = max(self.commit_keys_max, keys)
+
+    @property
+    def stats(self):
+        commits = self.ops['commit'].count
+        return dict(
+            uptime=time.time() - self.started,
+            ops=dict((op, histogram.stats) for op, histogram in self.ops.items()),
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            misses=self.misses,
+            commit_keys=dict(total=self.commit_keys, max=self.commit_keys_max,
+                             mean=self.commit_keys / commits if commits else 0.),
+        )
@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from ethereum.db import BaseDB
+from ethereum.utils import to_string
+from .lru_cache import LRUCache
+
+
+class Namespace(BaseDB):
+
+    """A keyspace of its own within a :class:`pyethapp.db_service.DBService`.
+
+    Keys are stored in a column family if the backend provides them (named databases in LMDB)
+    and `column_family` is set, otherwise they are prefixed with ``<name>:`` in the shared
+    keyspace. Reads are cached in a LRU cache of `cache_size` bytes and counted per namespace.
+
+    Namespaced keys must only be accessed through their namespace, the cache is not aware of
+    writes bypassing it.
+
+    :ivar reads: number of reads, hits and misses are counted by the cache
+    :ivar writes: number of puts
+    :ivar deletes: number of deletes
+    :ivar bytes_written: total size of the values put
+    """
+
+    def __init__(self, db, name, cache_size, column_family=True):
+        self.db = db
+        self.name = name
+        self.prefix = to_string(name) + b':'
+        backend = db.db_service
+        if column_family and hasattr(backend, 'column_family'):
+            self.store = backend.column_family(name)
+        else:
+            self.store = None
+        self.cache = LRUCache(cache_size)
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+        self.bytes_written = 0
+
+    def _get(self, key):
+        if self.store is not None:
+            return self.store.get(key)
+        return self.db._get_flat(self.prefix + key)
+
+    def get(self, key):
+        self.reads += 1
+        value = self.cache.get(key)
+        if value is None:
+            value = self._get(key)
+            self.cache.put(key, value)
+        return value
+
+    def get_many(self, keys):
+        """Return the values for `keys` in the same order, `None` for unknown keys."""
+        values = [self.cache.get(key) for key in keys]
+        self.reads += len(keys)
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            if self.store is not None:
+                found = self.store.get_many(missing)
+            else:
+                found = self.db._get_many_flat([self.prefix + key for key in missing])
+            found = dict(zip(missing, found))
+            for i, key in enumerate(keys):
+                if values[i] is None and found[key] is not None:
+                    values[i] = found[key]
+                    self.cache.put(key, values[i])
+        return values
+
+    def put(self, key, value):
+        self.writes += 1
+        self.bytes_written += len(value)
+        self.cache.put(key, value)
+        if self.store is not None:
+            self.store.put(key, value)
+        else:
+            self.db._put_flat(self.prefix + key, value)
+
+    def delete(self, key):
+        self.deletes += 1
+        self.cache.invalidate(key)
+        if self.store is not None:
+            self.store.delete(key)
+        else:
+            self.db._delete_flat(self.prefix + key)
+
+    def commit(self):
+        """Commit all pending changes of the db, not only the ones of this namespace."""
+        self.db.commit()
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    @property
+    def stats(self):
+        return dict(reads=self.reads, writes=self.writes, deletes=self.deletes,
+                    bytes_written=self.bytes_written, column_family=self.store is not None,
+                    cache=self.cache.stats)
+
+    def __repr__(self):
+        return '<Namespace %s %s>' % (self.name, 'column family' if self.store is not None
+                                      else 'prefix=%r' % self.prefix)
@@ -1,13 +1,38 @@
 # -*- coding: utf8 -*-
 
 from __future__ import absolute_import
+from __future__ import division
+import json
+import os
+import time
+import gevent
+import gevent.event
+import gevent.lock
+import rlp
+from gevent.threadpool import ThreadPool
 from devp2p.service import BaseService
 from ethereum.db import BaseDB
 from ethereum.slogging import get_logger
+from ethereum.utils import sha3, encode_int, big_endian_to_int, to_string
+from .bloom_filter import KeyFilter, key_namespace
+from .db_metrics import DBMetrics
+from .db_namespace import Namespace
 from .ephemdb_service import EphemDB
+from .freezer import Freezer
 
 log = get_logger('db')
 
+REFCOUNT_PREFIX = b'refcount:'
+PRUNING_JOURNAL_PREFIX = b'pruning:journal:'
+PRUNING_RELEASED_KEY = b'pruning:released'
+PRUNING_DEATH_ROW_KEY = b'pruning:death_row'
+FROZEN_PREFIX = b'frozen:'
+FREEZER_COUNT_KEY = b'freezer:count'
+GROUP_COMMIT_KEY = b'db:group_commit'
+FILTER_EPOCH_KEY = b'db:filter_epoch'
+BLANK_ROOT = sha3(rlp.encode(b''))
+BLANK_HASH = sha3(b'')
+
 dbs = {}
 dbs['EphemDB'] = EphemDB
 
@@ -32,11 +57,165 @@ except ImportError:
 else:
     dbs['LmDB'] = LmDBService
 
+try:
+    from .rocksdb_service import RocksDBService
+except ImportError:
+    pass
+else:
+    dbs['RocksDB'] = RocksDBService
+
+
+def trie_node_references(value):
+    """Return the db keys referenced by the trie node stored as `value`.
+
+    The state stores trie nodes through :class:`ethereum.db.RefcountDB`, which prefixes the
+    rlp encoding with a 4 byte put counter. Leaves of the state trie reference the storage root
+    and the code of their account.
+
+    :returns: a list of ``(key, is_node)`` tuples, `is_node` being `False` for contract code
+    """
+    try:
+        node = rlp.decode(value[4:])
+    except rlp.DecodingError:
+        return []
+    refs = []
+    stack = [node]
+    while stack:
+        for child in _child_nodes(stack.pop(), refs):
+            if isinstance(child, list):
+                stack.append(child)  # nodes shorter than 32 bytes are embedded
+            elif len(child) == 32:
+                refs.append((child, True))
+    return refs
+
+
+def _child_nodes(node, refs):
+    "returns the children of `node`, the references of account leaves are added to `refs`"
+    if not isinstance(node, list):
+        return []
+    if len(node) == 17:
+        return node[:16]
+    if len(node) == 2 and node[0]:
+        if bytearray(node[0][:1])[0] & 0x20:  # hex prefix flag of leaves
+            refs.extend(_account_references(node[1]))
+            return []
+        return node[1:]
+    return []
+
+
+def _account_references(leaf_value):
+    try:
+        account = rlp.decode(leaf_value)
+    except rlp.DecodingError:
+        return []
+    if not isinstance(account, list) or len(account) != 4:
+        return []  # storage leaves hold plain values
+    storage_root, code_hash = account[2:]
+    refs = []
+    if len(storage_root) == 32 and storage_root != BLANK_ROOT:
+        refs.append((storage_root, True))
+    if len(code_hash) == 32 and code_hash != BLANK_HASH:
+        refs.append((code_hash, False))
+    return refs
+
 
 class DBService(BaseDB, BaseService):
 
+    """Dispatches to the configured db backend.
+
+    With ``db.offload`` enabled, commits of at least ``db.offload_min_keys`` dirty keys and
+    :meth:`get_many` calls for at least as many keys run on a native thread pool, so the gevent
+    hub can keep serving other greenlets meanwhile. Only backends which can freeze their write
+    buffer (see :meth:`LevelDB.freeze_uncommitted`) are offloaded. Commits are serialized and the
+    frozen batch stays readable until it is written, so readers never observe a gap.
+
+    If :attr:`ttl` is set to a non negative number of epochs (blocks), state is pruned by
+    reference counting trie nodes: every node counts the references from parent nodes plus the
+    state roots pinned via :meth:`inc_refcount`. A pinned root is journaled for its epoch by
+    :meth:`commit_refcount_changes` and released again by :meth:`cleanup` `ttl` + 1 epochs
+    later, so with a `ttl` of 0 only the state of the latest epoch is kept.
+    Nodes without references are deleted in batches of ``db.prune_batch_size`` and release
+    their children in turn. The batches run in a background greenlet between block imports (see
+    :meth:`begin_block`), so a node which an imported state writes again is referenced by the
+    time the pruner checks it. The nodes still to be deleted are stored with every batch and
+    picked up again after a restart.
+
+    With ``db.bloom_filter`` enabled, the keys of persistent backends are tracked in per
+    namespace Bloom filters, so lookups of absent keys mostly return without a read. The filter
+    is rebuilt from the backend's keys on start, unless it was saved by a clean shutdown: the
+    saved file and the last written batch carry the same ``db:filter_epoch``, which the first
+    put after saving deletes, as services stopped later may still write.
+
+    Persistent backends get a :class:`Freezer` in ``data_dir/freezer``. Values moved there by
+    :meth:`freeze` (old blocks, see ``db.freezer_depth``) leave a small ``frozen:`` entry in the
+    db and stay readable through :meth:`get`.
+
+    :meth:`namespace` provides separate keyspaces with their own read cache and statistics,
+    backed by column families where the backend supports them. The keys pyethereum's chain
+    writes with one of the prefixes in ``db.routed_namespaces`` (e.g. ``b'block:'``, the
+    canonical chain index) are accessed through the namespace of that name, which keeps them
+    at their prefixed key. Block bodies and state are stored under their hash without a prefix
+    to tell them apart on reads, so they stay in the shared keyspace.
+
+    With ``db.group_commit`` enabled, :meth:`commit` does not write. The pending changes are
+    written as one batch by :meth:`flush` at a block boundary: the chain service brackets every
+    block import with :meth:`begin_block` and :meth:`end_block`, and the first block ended
+    after ``group_commit_bytes`` are pending, ``group_commit_blocks`` blocks have been imported
+    or ``group_commit_interval`` seconds have passed in the group flushes it. Commits outside
+    of a block import (e.g. by the tx index builder) flush on the size and age limits only.
+    Every batch is written atomically and stores its sequence number, its number of blocks and
+    whether it was written by :meth:`stop` under ``db:group_commit``. After a crash the db,
+    including the chain head, is at the end of the last written group: the blocks after it are
+    lost and imported again by the synchronizer.
+    This is detected on start (see :attr:`group_recovered`). Batches are synced every
+    ``db.sync_every`` batches and on :meth:`stop`.
+
+    :ivar offload_stats: number of offloaded commits and reads and the seconds spent in the
+                         thread pool, i.e. the time the hub would have been blocked otherwise
+    :ivar ttl: the pruning window in epochs or `-1` if pruning is disabled
+    :ivar group_recovered: if the last run with group commits was not stopped cleanly
+    """
+
     name = 'db'
-    default_config = dict(db=dict(implementation='LevelDB'))
+    default_config = dict(db=dict(
+        implementation='LevelDB',
+        cache_size=32 * 1024**2,  # bytes of values kept in the backend's read cache
+        offload=False,
+        offload_min_keys=1000,
+        offload_threads=2,
+        prune_batch_size=1000,
+        bloom_filter=True,
+        bloom_error_rate=0.01,
+        bloom_min_capacity=10000,  # keys of namespaces not seen while building the filter
+        freezer=True,
+        freezer_depth=90000,  # blocks behind the head which are moved to the freezer
+        # LevelDB value codecs by key class, see pyethapp.compression.key_class
+        codecs=dict(default='none'),
+        zstd_dictionary='',  # path of a trained dictionary for the zstd codec
+        trace_file='',  # record accesses for the trace workload of `pyethapp bench db`
+        namespace_cache_size=4 * 1024**2,  # bytes of values cached per namespace
+        namespaces=dict(),  # cache sizes of individual namespaces
+        routed_namespaces=['block', 'txindex'],  # prefixes of chain keys with a namespace
+        group_commit=False,  # coalesce the commits of consecutive blocks into one batch
+        group_commit_bytes=64 * 1024**2,  # flush once this many bytes are pending
+        group_commit_blocks=100,  # flush after this many imported blocks
+        group_commit_interval=5.,  # flush at the first block end this many seconds into a group
+        sync_every=0,  # fsync every n-th written batch, 0: only the last one on shutdown
+        metrics=True,  # count operations and their latencies, see debug_dbStats
+        metrics_file='',  # path the stats are dumped to as JSON
+        metrics_interval=60.,  # seconds between dumps, on commit
+        lmdb_map_size=2**40,  # maximum size of the LMDB database, fixed on creation
+        lmdb_writemap=False,  # write through a writable memory map
+        lmdb_metasync=True,  # sync the meta page on commit, a crash may undo the last commit
+        lmdb_sync=True,  # sync on commit, a crash may lose or corrupt the last commits
+        rocksdb_block_cache_size=256 * 1024**2,  # shared by all RocksDB instances
+        rocksdb_bloom_bits=10,  # bits per key of the Bloom filters
+        rocksdb_hash_prefix=4,  # prefix of hash keys for prefix Bloom filters, fixed on creation
+        rocksdb_compression='snappy',  # none, snappy, zlib, lz4 or zstd
+        rocksdb_write_buffer_size=64 * 1024**2,
+        rocksdb_compaction_threads=2,  # background compactions, bounds their disk bandwidth
+    ))
+    ttl = -1
 
     def __init__(self, app):
         super(DBService, self).__init__(app)
@@ -44,27 +223,523 @@ class DBService(BaseDB, BaseService):
         if len(dbs) == 0:
             log.warning('No db installed')
         self.db_service = dbs[impl](app)
+        dbconfig = self.app.config['db']
+        self.offload = dbconfig['offload'] and hasattr(self.db_service, 'freeze_uncommitted')
+        self.offload_min_keys = dbconfig['offload_min_keys']
+        self.offload_stats = dict(commits=0, reads=0, hub_time_saved=0.)
+        if self.offload:
+            self.threadpool = ThreadPool(dbconfig['offload_threads'])
+        self.commit_lock = gevent.lock.Semaphore()
+        self.prune_batch_size = dbconfig['prune_batch_size']
+        self.pinned = []  # roots pinned in the current epoch
+        self.refcount_journal = []  # (key, previous refcount) changed in the current epoch
+        self.death_row = self._stored_death_row()  # (key, is_node) without references
+        self.death_row_stored = bool(self.death_row)
+        self.pruner = None
+        self.key_filter = None
+        self.key_filter_path = None
+        self.key_filter_pending = None  # keys put while the filter is being rebuilt
+        self.key_filter_saved = False  # the stored filter epoch is valid until the next put
+        if self.app.config.get('data_dir') and hasattr(self.db_service, 'iterkeys'):
+            self.key_filter_path = os.path.join(self.app.config['data_dir'], 'bloom_filter')
+            if not dbconfig['bloom_filter'] and os.path.exists(self.key_filter_path):
+                os.remove(self.key_filter_path)  # would miss the keys written by this run
+        self.bloom = dbconfig['bloom_filter'] and self.key_filter_path is not None
+        if self.bloom:
+            self.key_filter_pending = []
+        self.namespaces = dict()
+        self.routes = dict()  # key prefix -> Namespace the keys are accessed through
+        for name in dbconfig['routed_namespaces']:
+            namespace = self.namespace(name, column_family=False)
+            self.routes[namespace.prefix] = namespace
+        self.trace = None
+        if dbconfig['trace_file']:
+            from .db_bench import TraceWriter
+            self.trace = TraceWriter(dbconfig['trace_file'])
+        self.group_commit = dbconfig['group_commit']
+        self.group_commit_bytes = dbconfig['group_commit_bytes']
+        self.group_commit_blocks = dbconfig['group_commit_blocks']
+        self.group_commit_interval = dbconfig['group_commit_interval']
+        self.sync_every = dbconfig['sync_every']
+        self.pending_bytes = 0
+        self.pending_blocks = 0
+        self.between_blocks = gevent.event.Event()  # not between begin_block and end_block
+        self.between_blocks.set()
+        self.group_started = None  # time of the first commit of the pending group
+        self.batches_written = 0
+        self.metrics = DBMetrics() if dbconfig['metrics'] else None
+        self.metrics_file = dbconfig['metrics_file'] if self.metrics is not None else ''
+        self.metrics_interval = dbconfig['metrics_interval']
+        self.metrics_dumped = time.time()
+        self.writes_by_first_byte = [0] * 256  # key ranges written to, see DBMaintenanceService
+        self._open_group_log()
+        self.freezer = None
+        self.freezer_unsynced = False
+        if dbconfig['freezer'] and self.app.config.get('data_dir') and impl != 'EphemDB':
+            self.open_freezer(os.path.join(self.app.config['data_dir'], 'freezer'))
 
     def start(self):
+        if self.bloom:
+            self.load_key_filter()
+        if self.ttl >= 0:
+            self._start_pruner()  # left over from the last run
         return self.db_service.start()
 
+    def stop(self):
+        self.is_stopped = True
+        if self.pruner is not None:
+            self.pruner.join()  # finishes its batch, the rest is pruned after a restart
+        if self.key_filter is not None:
+            self.save_key_filter()
+        self.flush(sync=True, clean=True)
+        if self.metrics_file:
+            self.dump_metrics()
+        if self.freezer is not None:
+            self.freezer.close()
+        if self.trace is not None:
+            self.trace.close()
+        self.db_service.stop()
+        super(DBService, self).stop()
+
+    def open_freezer(self, path):
+        self.freezer = Freezer(path)
+        try:
+            count = big_endian_to_int(self.db_service.get(FREEZER_COUNT_KEY))
+        except KeyError:
+            count = 0
+        if count < self.freezer.count:
+            # items appended after the last commit are still in the db
+            log.warning('dropping uncommitted freezer items', count=self.freezer.count - count)
+            self.freezer.truncate(count)
+        assert count == self.freezer.count, 'freezer is missing items'
+
+    def freeze(self, key):
+        """Move the value of `key` from the db to the freezer and return its number there.
+
+        The change is durable after the next :meth:`commit`.
+        """
+        assert self.freezer is not None
+        number = self.freezer.append(self.db_service.get(key))
+        self.freezer_unsynced = True
+        self.put(FROZEN_PREFIX + key, encode_int(number))
+        self.put(FREEZER_COUNT_KEY, encode_int(self.freezer.count))
+        self.delete(key)
+        return number
+
+    def _get(self, key):
+        if self.key_filter is not None and not self.key_filter.might_contain(key):
+            raise KeyError('key not in db')
+        return self.db_service.get(key)
+
+    def _frozen_number(self, key):
+        # only block hashes are frozen
+        if self.freezer is None or not self.freezer.count or len(key) != 32:
+            raise KeyError('key not in db')
+        return big_endian_to_int(self._get(FROZEN_PREFIX + key))
+
+    def _get_frozen(self, key):
+        number = self._frozen_number(key)
+        return self.freezer.get(number)
+
+    def save_key_filter(self):
+        """Save the Bloom filter with a new epoch, which is written with the next batch."""
+        epoch = os.urandom(16)
+        self.key_filter.save(self.key_filter_path, epoch)
+        self.db_service.put(FILTER_EPOCH_KEY, epoch)
+        self.key_filter_saved = True
+        log.debug('saved bloom filter', **self.key_filter.stats)
+
+    def _stored_filter_epoch(self):
+        try:
+            epoch = self.db_service.get(FILTER_EPOCH_KEY)
+        except KeyError:
+            return None
+        # this run writes keys the saved filter does not know about
+        self.db_service.delete(FILTER_EPOCH_KEY)
+        self.db_service.commit()
+        return epoch
+
+    def load_key_filter(self):
+        dbconfig = self.app.config['db']
+        epoch = self._stored_filter_epoch()
+        try:
+            self.key_filter = KeyFilter.load(self.key_filter_path, dbconfig['bloom_error_rate'],
+                                             dbconfig['bloom_min_capacity'])
+        except (IOError, OSError, ValueError, rlp.DecodingError):
+            pass
+        else:
+            if self.key_filter.epoch != epoch:
+                log.info('bloom filter outdated, rebuilding')
+            elif not self.key_filter.saturated:
+                for key in self.key_filter_pending:
+                    self.key_filter.add(key)
+                self.key_filter_pending = None
+                log.debug('loaded bloom filter', **self.key_filter.stats)
+                return
+            self.key_filter = None  # rebuild with larger filters
+        gevent.spawn(self.rebuild_key_filter)
+
+    def rebuild_key_filter(self):
+        """Build the Bloom filter from the keys in the backend, yielding to other greenlets."""
+        dbconfig = self.app.config['db']
+        st = time.time()
+
+        def keys():
+            for i, key in enumerate(self.db_service.iterkeys()):
+                if i % 10000 == 0:
+                    gevent.sleep(0)
+                yield key
+
+        counts = dict()
+        for key in keys():
+            namespace = key_namespace(to_string(key))
+            counts[namespace] = counts.get(namespace, 0) + 1
+        key_filter = KeyFilter.build(keys(), counts, dbconfig['bloom_error_rate'],
+                                     dbconfig['bloom_min_capacity'])
+        for key in self.key_filter_pending:
+            key_filter.add(key)
+        self.key_filter_pending = None
+        self.key_filter = key_filter
+        log.info('rebuilt bloom filter', elapsed=time.time() - st, **key_filter.stats)
+
     def _run(self):
         return self.db_service._run()
 
+    def _run_offloaded(self, func, *args):
+        def timed():
+            st = time.time()
+            return func(*args), time.time() - st
+        result, elapsed = self.threadpool.apply(timed)
+        self.offload_stats['hub_time_saved'] += elapsed
+        return result
+
+    def _route(self, key):
+        "returns the namespace `key` is routed to or `None`"
+        if not self.routes:
+            return None
+        return self.routes.get(key_namespace(to_string(key)))
+
     def get(self, key):
-        return self.db_service.get(key)
+        route = self._route(key)
+        if route is not None:
+            return route.get(key[len(route.prefix):])
+        return self._get_flat(key)
+
+    def _get_flat(self, key):
+        if self.metrics is None:
+            return self._get_value(key)
+        st = time.time()
+        try:
+            value = self._get_value(key)
+        except KeyError:
+            self.metrics.get(st, None)
+            raise
+        self.metrics.get(st, value)
+        return value
+
+    def _get_value(self, key):
+        if self.trace is not None:
+            return self._traced_get(key)
+        try:
+            return self._get(key)
+        except KeyError:
+            return self._get_frozen(key)
+
+    def _traced_get(self, key):
+        try:
+            value = self._get(key)
+        except KeyError:
+            try:
+                value = self._get_frozen(key)
+            except KeyError:
+                self.trace.get(key, -1)
+                raise
+        self.trace.get(key, len(value))
+        return value
+
+    def get_many(self, keys):
+        """Return the values for `keys` in the same order, `None` for unknown keys."""
+        route = self._route(keys[0]) if keys else None
+        if route is not None and all(self._route(key) is route for key in keys):
+            return route.get_many([key[len(route.prefix):] for key in keys])
+        return self._get_many_flat(keys)
+
+    def _get_many_flat(self, keys):
+        if self.metrics is None:
+            return self._get_values(keys)
+        st = time.time()
+        values = self._get_values(keys)
+        self.metrics.get_many(st, values)
+        return values
+
+    def _get_values(self, keys):
+        if self.key_filter is not None:
+            found = [key for key in keys if self.key_filter.might_contain(key)]
+            if len(found) < len(keys):
+                values = dict(zip(found, self._get_many(found) if found else []))
+                values = [values.get(key) for key in keys]
+                return self._get_many_frozen(keys, values)
+        return self._get_many_frozen(keys, self._get_many(keys))
+
+    def _get_many(self, keys):
+        if self.offload and len(keys) >= self.offload_min_keys:
+            self.offload_stats['reads'] += 1
+            return self.db_service.get_many(keys, executor=self._run_offloaded)
+        return self.db_service.get_many(keys)
+
+    def _get_many_frozen(self, keys, values):
+        if self.freezer is None or not self.freezer.count:
+            return values
+        for i, key in enumerate(keys):
+            if values[i] is None and len(key) == 32:
+                try:
+                    values[i] = self._get_frozen(key)
+                except KeyError:
+                    pass
+        return values
+
+    def namespace(self, name, column_family=True):
+        """Return the :class:`Namespace` called `name`.
+
+        Its cache size is ``db.namespaces.<name>`` or ``db.namespace_cache_size`` bytes.
+
+        :param column_family: `False` to keep the keys prefixed in the shared keyspace, only
+                              applies when the namespace is created
+        """
+        if name not in self.namespaces:
+            dbconfig = self.app.config['db']
+            cache_size = dbconfig['namespaces'].get(name, dbconfig['namespace_cache_size'])
+            self.namespaces[name] = Namespace(self, name, cache_size, column_family)
+        return self.namespaces[name]
+
+    def stats(self):
+        """Return the metrics and the statistics of the backend, its caches, the namespaces, the
+        Bloom filters, offloading and the freezer as a JSON serializable dict."""
+        backend = self.db_service
+        stats = dict(implementation=self.app.config['db']['implementation'],
+                     offload=self.offload_stats,
+                     namespaces=dict((name, namespace.stats)
+                                     for name, namespace in self.namespaces.items()),
+                     group_commit=dict(seq=self.group_seq, batches=self.batches_written,
+                                       recovered=self.group_recovered,
+                                       pending_blocks=self.pending_blocks,
+                                       pending_bytes=self.pending_bytes))
+        if self.metrics is not None:
+            stats.update(self.metrics.stats)
+        if hasattr(backend, 'cache'):
+            stats['cache'] = backend.cache.stats
+        if hasattr(backend, 'overlay_hits'):
+            stats['overlay_hits'] = backend.overlay_hits
+            if self.metrics is not None and self.metrics.ops['get'].count:
+                stats['overlay_hit_ratio'] = backend.overlay_hits / self.metrics.ops['get'].count
+        if hasattr(backend, 'uncommitted'):
+            stats['uncommitted'] = self._num_uncommitted()
+        if self.key_filter is not None:
+            stats['bloom_filter'] = self.key_filter.stats
+        if self.freezer is not None:
+            stats['frozen'] = self.freezer.count
+        return stats
+
+    def dump_metrics(self):
+        """Write :meth:`stats` to ``db.metrics_file``."""
+        with open(self.metrics_file, 'w') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
+        self.metrics_dumped = time.time()
+
+    def fork(self, app):
+        """Return a new service for `app` starting with a copy-on-write copy of the committed db.
+
+        Only supported by the ``EphemDB`` backend, e.g. to set up many test apps or simulated
+        nodes from a db holding the genesis state. `app` has to be configured to use it too.
+        """
+        if not hasattr(self.db_service, 'fork'):
+            raise NotImplementedError('%s can not be forked' % self.db_service.__class__.__name__)
+        self.commit()
+        service = self.__class__(app)
+        service.db_service = self.db_service.fork(app)
+        return service
+
+    def snapshot(self):
+        """Return a frozen point-in-time read view of the db, see :class:`Snapshot`.
+
+        Later writes to the db, committed or not, are not visible through the snapshot. It has
+        to be closed after use.
+        """
+        return self.db_service.snapshot()
 
     def put(self, key, value):
-        return self.db_service.put(key, value)
+        route = self._route(key)
+        if route is not None:
+            return route.put(key[len(route.prefix):], value)
+        self._put_flat(key, value)
+
+    def _put_flat(self, key, value):
+        if self.key_filter_saved:
+            self.db_service.delete(FILTER_EPOCH_KEY)  # the saved filter misses `key`
+            self.key_filter_saved = False
+        if self.key_filter is not None:
+            self.key_filter.add(key)
+        elif self.key_filter_pending is not None:
+            self.key_filter_pending.append(key)
+        if self.trace is not None:
+            self.trace.put(key, len(value))
+        self.pending_bytes += len(key) + len(value)
+        if key:
+            self.writes_by_first_byte[ord(key[:1])] += 1
+        if self.metrics is None:
+            return self.db_service.put(key, value)
+        st = time.time()
+        self.db_service.put(key, value)
+        self.metrics.put(st, value)
+
+    def _last_group(self):
+        """Return the sequence number and number of blocks of the last written group and if it
+        was written on a clean shutdown."""
+        try:
+            marker = rlp.decode(self.db_service.get(GROUP_COMMIT_KEY))
+        except KeyError:
+            return 0, 0, True
+        seq, blocks = [big_endian_to_int(x) for x in marker[:2]]
+        return seq, blocks, marker[2:] == [b'\x01']
+
+    def _put_group_marker(self, blocks, clean):
+        # not through `put`, the marker is not a key of the chain and the Bloom filter
+        self.db_service.put(GROUP_COMMIT_KEY, rlp.encode([self.group_seq, blocks, int(clean)]))
+
+    def _open_group_log(self):
+        """Check how the last run with group commits ended and mark the log as open."""
+        self.group_seq, self.group_blocks, clean = self._last_group()
+        self.group_recovered = not clean
+        if not self.group_commit:
+            return
+        if clean:
+            log.info('last written group', seq=self.group_seq, blocks=self.group_blocks)
+            # a crash before the next written group must not look like a clean shutdown
+            self._put_group_marker(self.group_blocks, clean=False)
+            self.db_service.commit()
+        else:
+            log.warning('db was not stopped cleanly, blocks imported after the last written '
+                        'group are lost and have to be imported again',
+                        seq=self.group_seq, blocks=self.group_blocks)
 
     def commit(self):
-        return self.db_service.commit()
+        if self.trace is not None:
+            self.trace.commit()
+        if not self.group_commit:
+            return self.flush()
+        if self.group_started is None:
+            self.group_started = time.time()
+        if self.between_blocks.is_set() and self._group_full():
+            self.flush()
+
+    def begin_block(self):
+        """Mark the start of a block import, commits until :meth:`end_block` don't flush."""
+        self.between_blocks.clear()
+
+    def end_block(self, blocks=1):
+        """Mark the end of a block import which added `blocks` blocks to the chain.
+
+        With group commits this is where groups are flushed, so a written group never holds
+        part of a block.
+        """
+        self.between_blocks.set()
+        if not self.group_commit:
+            return
+        self.pending_blocks += blocks
+        if self.group_started is None:
+            self.group_started = time.time()
+        if self._group_full():
+            self.flush()
+
+    def _group_full(self):
+        return (self.pending_bytes >= self.group_commit_bytes or
+                self.pending_blocks >= self.group_commit_blocks or
+                time.time() - self.group_started >= self.group_commit_interval)
+
+    def flush(self, sync=None, clean=False):
+        """Write all pending changes as one batch.
+
+        :param sync: whether to fsync the batch, by default every ``db.sync_every``-th batch is
+        :param clean: if this is the last batch before a clean shutdown
+        """
+        if self.group_commit:
+            if self.group_started is None and not (clean or sync):
+                return  # nothing committed since the last batch
+            if self.pending_blocks:
+                self.group_seq += 1
+                self.group_blocks = self.pending_blocks
+            if self.pending_blocks or clean:  # the last group again if empty
+                self._put_group_marker(self.group_blocks, clean)
+            log.debug('writing group', seq=self.group_seq, blocks=self.pending_blocks,
+                      size=self.pending_bytes)
+        self.pending_bytes = 0
+        self.pending_blocks = 0
+        self.group_started = None
+        self.batches_written += 1
+        if sync is None:
+            sync = self.sync_every > 0 and self.batches_written % self.sync_every == 0
+        if self.metrics is None:
+            return self._write(sync)
+        st = time.time()
+        keys = self._num_uncommitted()
+        self._write(sync)
+        self.metrics.commit(st, keys)
+        if self.metrics_file and time.time() - self.metrics_dumped >= self.metrics_interval:
+            self.dump_metrics()
+
+    def _num_uncommitted(self):
+        if hasattr(self.db_service, 'num_uncommitted'):  # see db_snapshot.OverlayChain
+            return self.db_service.num_uncommitted()
+        return len(getattr(self.db_service, 'uncommitted', ()))
+
+    def _write(self, sync):
+        if self.freezer_unsynced:
+            self.freezer.sync()  # the db must not refer to items which might get lost
+            self.freezer_unsynced = False
+        if not self.offload:
+            return self.db_service.commit(sync=sync)
+        # wait for an offloaded commit in flight, so that batches are written in order
+        with self.commit_lock:
+            if self._num_uncommitted() < self.offload_min_keys:
+                return self.db_service.commit(sync=sync)
+            batch = self.db_service.freeze_uncommitted()
+            try:
+                self._run_offloaded(self.db_service.write_batch, batch, sync)
+            except Exception:
+                self.db_service.finish_commit(success=False)
+                raise
+            self.db_service.finish_commit()
+            self.offload_stats['commits'] += 1
+            log.debug('offloaded commit', **self.offload_stats)
 
     def delete(self, key):
-        return self.db_service.delete(key)
+        route = self._route(key)
+        if route is not None:
+            return route.delete(key[len(route.prefix):])
+        self._delete_flat(key)
+
+    def _delete_flat(self, key):
+        if self.metrics is None:
+            return self.db_service.delete(key)
+        st = time.time()
+        self.db_service.delete(key)
+        self.metrics.delete(st)
 
     def __contains__(self, key):
-        return key in self.db_service
+        route = self._route(key)
+        if route is not None:
+            return key[len(route.prefix):] in route
+        try:
+            self._get(key)
+        except KeyError:
+            pass
+        else:
+            return True
+        try:
+            self._frozen_number(key)
+        except KeyError:
+            return False
+        return True
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.db_service == other.db_service
@@ -72,20 +747,153 @@ class DBService(BaseDB, BaseService):
     def __repr__(self):
         return repr(self.db_service)
 
+    def _refcount(self, key):
+        try:
+            return big_endian_to_int(self.get(REFCOUNT_PREFIX + key))
+        except KeyError:
+            return 0
+
+    def _set_refcount(self, key, count):
+        if count:
+            self.put(REFCOUNT_PREFIX + key, encode_int(count))
+        else:
+            self.delete(REFCOUNT_PREFIX + key)
+
+    def _incref(self, key, is_node=True):
+        stack = [(key, is_node)]
+        while stack:
+            key, is_node = stack.pop()
+            count = self._refcount(key)
+            self._set_refcount(key, count + 1)
+            self.refcount_journal.append((key, count))
+            if count == 0 and is_node:
+                # first reference, so the children are referenced through this node now
+                try:
+                    stack.extend(trie_node_references(self.get(key)))
+                except KeyError:
+                    pass
+
+    def _decref(self, key, is_node=True):
+        count = self._refcount(key)
+        if count == 0:
+            return
+        self._set_refcount(key, count - 1)
+        self.refcount_journal.append((key, count))
+        if count == 1:
+            self.death_row.append((key, is_node))
+
     def inc_refcount(self, key, value):
         self.put(key, value)
+        if self.ttl >= 0:
+            self._incref(key)
+            self.pinned.append(key)
 
     def dec_refcount(self, key):
-        pass
+        if self.ttl >= 0:
+            self._decref(key)
 
     def revert_refcount_changes(self, epoch):
-        pass
+        if self.ttl < 0:
+            return
+        for key, count in reversed(self.refcount_journal):
+            self._set_refcount(key, count)
+        self.refcount_journal = []
+        self.pinned = []
 
     def commit_refcount_changes(self, epoch):
-        pass
+        if self.ttl < 0:
+            return
+        if self.pinned:
+            # pins of epochs released already (late side chain blocks) go to the next one
+            epoch = max(epoch, self._released_epoch() + 1)
+            journal_key = PRUNING_JOURNAL_PREFIX + to_string(epoch)
+            try:
+                pinned = rlp.decode(self.get(journal_key))
+            except KeyError:
+                pinned = []
+            self.put(journal_key, rlp.encode(pinned + self.pinned))
+        self.pinned = []
+        self.refcount_journal = []
+
+    def _released_epoch(self):
+        try:
+            return big_endian_to_int(self.get(PRUNING_RELEASED_KEY))
+        except KeyError:
+            return -1
 
     def cleanup(self, epoch):
-        pass
+        """Release the roots pinned more than `ttl` epochs before `epoch` and start deleting
+        unreferenced nodes, i.e. the states of `epoch` and the `ttl` epochs before are kept."""
+        if self.ttl < 0:
+            return
+        self._release(epoch - self.ttl - 1)
+        self.refcount_journal = []  # released references can not be reverted anymore
+        self._save_death_row()
+        self.commit()
+        self._start_pruner()
+
+    def _start_pruner(self):
+        if self.death_row and (self.pruner is None or self.pruner.ready()):
+            self.pruner = gevent.spawn(self._prune)
+
+    def _release(self, epoch):
+        journal_key = PRUNING_JOURNAL_PREFIX + to_string(epoch)
+        try:
+            expired = rlp.decode(self.get(journal_key))
+        except KeyError:
+            expired = []
+        else:
+            self.delete(journal_key)
+        for root in expired:
+            self._decref(root)
+        if epoch > self._released_epoch():
+            self.put(PRUNING_RELEASED_KEY, encode_int(epoch))
+
+    def _stored_death_row(self):
+        try:
+            return [(key, bool(is_node)) for key, is_node in
+                    rlp.decode(self.db_service.get(PRUNING_DEATH_ROW_KEY))]
+        except KeyError:
+            return []
+
+    def _save_death_row(self):
+        if self.death_row:
+            death_row = [[key, int(is_node)] for key, is_node in self.death_row]
+            self.put(PRUNING_DEATH_ROW_KEY, rlp.encode(death_row))
+        elif self.death_row_stored:
+            self.delete(PRUNING_DEATH_ROW_KEY)
+        self.death_row_stored = bool(self.death_row)
+
+    def _prune(self):
+        "deletes the nodes on death row in batches between block imports, returns their number"
+        pruned = 0
+        while self.death_row and not self.is_stopped:
+            if not self.between_blocks.wait(timeout=1.):
+                continue  # checks if the service was stopped meanwhile
+            pruned += self._prune_batch()
+            self.refcount_journal = []  # no block is imported, so these are the pruner's
+            self._save_death_row()
+            self.commit()
+            gevent.sleep(0)
+        log.debug('pruned state', nodes=pruned, remaining=len(self.death_row))
+        return pruned
+
+    def _prune_batch(self):
+        pruned = 0
+        while self.death_row and pruned < self.prune_batch_size:
+            key, is_node = self.death_row.pop()
+            if self._refcount(key) > 0:
+                continue  # referenced again in the meantime
+            if is_node:
+                try:
+                    children = trie_node_references(self.get(key))
+                except KeyError:
+                    continue
+                for child, child_is_node in children:
+                    self._decref(child, child_is_node)
+            self.delete(key)
+            pruned += 1
+        return pruned
 
     def put_temporarily(self, key, value):
         self.inc_refcount(key, value)
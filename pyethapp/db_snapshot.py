@@ -0,0 +1,159 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from ethereum.db import BaseDB
+
+# marks a key without an entry in an overlay
+NULL = object()
+
+
+class OverlayChain(object):
+
+    """Mixin keeping the pending changes of a database as a chain of overlays.
+
+    Writes go to the ``uncommitted`` dict. A snapshot moves it to the front of ``frozen`` (newest
+    first), where it is never modified again, and starts a new ``uncommitted`` dict, so neither
+    taking a snapshot nor the next write copies the pending changes. Commits merge the chain
+    into ``committing`` and start a new one.
+    """
+
+    max_frozen = 8  # longer chains are merged into one overlay, bounding the cost of reads
+
+    def _from_overlay(self, key):
+        "returns the pending value of `key` (or its deletion marker) or `NULL` if there is none"
+        value = self.uncommitted.get(key, NULL)
+        if value is NULL:
+            for overlay in self.frozen:
+                value = overlay.get(key, NULL)
+                if value is not NULL:
+                    return value
+            value = self.committing.get(key, NULL)
+        return value
+
+    def num_uncommitted(self):
+        "returns the number of pending changes, keys changed again after a snapshot count twice"
+        return len(self.uncommitted) + sum(len(overlay) for overlay in self.frozen)
+
+    def _snapshot_overlays(self):
+        "returns the overlays of the pending changes for a :class:`Snapshot`, newest first"
+        if self.uncommitted:
+            self.frozen.insert(0, self.uncommitted)
+            self.uncommitted = dict()
+            if len(self.frozen) > self.max_frozen:
+                self.frozen = [_merged(self.frozen)]
+        return self.frozen + [self.committing]
+
+    def _take_uncommitted(self):
+        "returns all pending changes in one dict and starts an empty chain"
+        overlays = [self.uncommitted] + self.frozen
+        self.uncommitted, self.frozen = dict(), []
+        return overlays[0] if len(overlays) == 1 else _merged(overlays)
+
+    def _restore_uncommitted(self, changes):
+        "keeps the `changes` of a failed commit unless they have been overwritten since"
+        newer = [self.uncommitted] + self.frozen
+        for key, value in changes.items():
+            if not any(key in overlay for overlay in newer):
+                self.uncommitted[key] = value
+
+
+def _merged(overlays):
+    merged = dict()
+    for overlay in reversed(overlays):
+        merged.update(overlay)
+    return merged
+
+
+class Snapshot(BaseDB):
+
+    """A frozen point-in-time read view of a database.
+
+    Reads check the snapshot's own writes, then the `overlays` of pending changes of the
+    database at the time the snapshot was taken (first match wins, `deleted` marks deleted
+    keys) and finally `reader`, a function raising :exc:`KeyError` for unknown keys which reads
+    the committed state of the database as of the snapshot.
+
+    Writes (e.g. ``BLANK_HASH`` stored by :class:`ethereum.state.Account`) stay in the snapshot.
+    Snapshots pinning backend resources have to be closed, preferably by using them as a
+    context manager.
+    """
+
+    def __init__(self, reader, overlays=(), deleted=None, close=None):
+        self.reader = reader
+        self.overlays = list(overlays)
+        self.deleted = deleted
+        self.writes = dict()
+        self._close = close
+
+    def get(self, key):
+        o = self.writes.get(key, NULL)
+        if o is NULL:
+            for overlay in self.overlays:
+                o = overlay.get(key, NULL)
+                if o is not NULL:
+                    break
+        if o is NULL:
+            return self.reader(key)
+        if o is self.deleted:
+            raise KeyError('key not in db')
+        return o
+
+    def get_many(self, keys):
+        values = []
+        for key in keys:
+            try:
+                values.append(self.get(key))
+            except KeyError:
+                values.append(None)
+        return values
+
+    def put(self, key, value):
+        self.writes[key] = value
+
+    def delete(self, key):
+        self.writes[key] = self.deleted
+
+    def commit(self):
+        pass
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def inc_refcount(self, key, value):
+        self.put(key, value)
+
+    def dec_refcount(self, key):
+        pass
+
+    def revert_refcount_changes(self, epoch):
+        pass
+
+    def commit_refcount_changes(self, epoch):
+        pass
+
+    def cleanup(self, epoch):
+        pass
+
+    def put_temporarily(self, key, value):
+        self.put(key, value)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+        self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return '<Snapshot overlays=%d writes=%d>' % (len(self.overlays), len(self.writes))
@@ -1,19 +1,124 @@
+import random
+import weakref
 from devp2p.service import BaseService
 from gevent.event import Event
 from ethereum.db import _EphemDB
 from logging import getLogger
+from .db_snapshot import NULL, Snapshot
 
 log = getLogger(__name__)
 
+# marks keys deleted in a fork which are still present in the shared base
+DELETE = object()
+
 
 class EphemDB(_EphemDB, BaseService):
 
+    """An in-memory database.
+
+    :meth:`fork` creates copy-on-write children: the parent's contents become an immutable
+    `base` shared by parent and child, each of them only stores its own changes in `db`.
+    Forking a database again without changes in between costs nothing, so e.g. a database
+    holding a genesis state can be forked for every test or simulated node.
+
+    Snapshots read through `db` and `base` as well. Until they are garbage collected, writes
+    first save the value they replace (or a `DELETE` tombstone) for every open snapshot.
+    """
+
     name = 'db'
 
-    def __init__(self, app):
+    def __init__(self, app, base=None):
         BaseService.__init__(self, app)
         _EphemDB.__init__(self)
+        self.base = base if base is not None else dict()  # never modified once shared
         self.stop_event = Event()
+        self.h = random.randrange(10**50)
+        self.snapshots = weakref.WeakKeyDictionary()  # snapshot -> values replaced since
+
+    def put(self, key, value):
+        self._preserve(key)
+        self.db[key] = value
+
+    def get(self, key):
+        value = self.db.get(key, NULL)
+        if value is NULL:
+            value = self.base[key]
+        elif value is DELETE:
+            raise KeyError(key)
+        return value
+
+    def get_many(self, keys):
+        values = []
+        for key in keys:
+            value = self.db.get(key)
+            if value is None:
+                value = self.base.get(key)
+            elif value is DELETE:
+                value = None
+            values.append(value)
+        return values
+
+    def delete(self, key):
+        self._preserve(key)
+        if key in self.base:
+            if self.db.get(key) is DELETE:
+                raise KeyError(key)
+            self.db[key] = DELETE
+        else:
+            del self.db[key]
+
+    def _preserve(self, key):
+        for replaced in self.snapshots.values():
+            if key not in replaced:
+                value = self.db.get(key, NULL)
+                replaced[key] = self.base.get(key, DELETE) if value is NULL else value
+
+    def commit(self, sync=False):
+        pass
+
+    def _has_key(self, key):
+        value = self.db.get(key, NULL)
+        if value is NULL:
+            return key in self.base
+        return value is not DELETE
+
+    def contents(self):
+        """Return a dict of all entries, it must not be modified."""
+        if not self.db:
+            return self.base
+        items = dict(self.base)
+        for key, value in self.db.items():
+            if value is DELETE:
+                del items[key]
+            else:
+                items[key] = value
+        return items
+
+    def fork(self, app=None):
+        """Return a copy-on-write copy of the database as a service of `app`.
+
+        Changes of the parent or the fork are not visible to the other one.
+        """
+        if self.db:
+            # merge the changes into a new base, the old one may be shared with other forks
+            self.base = self.contents()
+            self.db = self.kv = dict()
+            self.snapshots.clear()  # they keep reading the old `db` and `base`, never modified
+        return self.__class__(app or self.app, base=self.base)
+
+    def snapshot(self):
+        def reader(key):
+            raise KeyError('key not in db')
+        replaced = dict()
+        snapshot = Snapshot(reader, [replaced, self.db, self.base], deleted=DELETE)
+        self.snapshots[snapshot] = replaced
+        return snapshot
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.contents() == other.contents()
+
+    def __hash__(self):
+        return self.h
 
     def _run(self):
         self.stop_event.wait()
@@ -40,6 +40,7 @@ class TransientBlock(rlp.Serializable):
 
     def __init__(self, header, transactions, uncles, newblock_timestamp=0):
         self.newblock_timestamp = newblock_timestamp
+        self.preparation = None  # greenlet preparing the block for import, see ChainService
         self.header = header
         self.transactions = transactions
         self.uncles = uncles
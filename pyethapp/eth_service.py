@@ -6,9 +6,10 @@ from builtins import range
 from past.utils import old_div
 from builtins import object
 import copy
+import itertools
 import time
 import statistics
-from collections import deque
+from collections import OrderedDict, deque
 
 import gevent
 import gevent.lock
@@ -16,32 +17,38 @@ from gevent.queue import Queue
 from gevent.event import AsyncResult
 
 import rlp
+from rlp.sedes import CountableList
 
 from devp2p.protocol import BaseProtocol
 from devp2p.service import WiredService
 
 from ethereum.block import Block
-from ethereum.meta import make_head_candidate
+from ethereum.common import add_transactions, mk_block_from_prevstate, set_execution_results
+from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.hybrid_casper import casper_utils
 from ethereum.hybrid_casper.chain import Chain
 from ethereum.hybrid_casper.consensus import initialize, check_pow
 from ethereum.config import Env
 from ethereum.genesis_helpers import mk_genesis_data
 from ethereum import config as ethereum_config
-from ethereum.messages import apply_transaction, validate_transaction
-from ethereum.transaction_queue import TransactionQueue
-from ethereum.experimental.refcount_db import RefcountDB
+from ethereum.messages import Receipt, apply_transaction, validate_transaction
 from ethereum.slogging import get_logger
+from ethereum.state import STATE_DEFAULTS, State
 from ethereum.exceptions import InvalidTransaction, InvalidNonce, \
     InsufficientBalance, InsufficientStartGas, VerificationFailed
 from ethereum.transactions import Transaction
 from ethereum.utils import (
+    big_endian_to_int,
     encode_hex,
     decode_hex,
+    sha3,
     to_string,
 )
 
+from .db_metrics import Histogram
+from .sender_recovery import SenderRecovery
 from .synchronizer import Synchronizer
+from .tx_pool import TxPool
 from . import eth_protocol
 
 from pyethapp import sentry
@@ -52,23 +59,66 @@ log = get_logger('eth.chainservice')
 
 class DuplicatesFilter(object):
 
-    def __init__(self, max_items=128):
-        self.max_items = max_items
-        self.filter = list()
+    """A set of the most recently seen items with O(1) updates and lookups.
+
+    Items are kept in two generations of up to ``max_items // 2`` items. Once the current
+    generation is full it replaces the previous one, so at least the last ``max_items // 2``
+    and at most `max_items` items are remembered.
+    """
+
+    def __init__(self, max_items=32768):
+        self.generation_size = max(1, max_items // 2)
+        self.current = set()
+        self.previous = set()
 
     def update(self, data):
         "returns True if unknown"
-        if data not in self.filter:
-            self.filter.append(data)
-            if len(self.filter) > self.max_items:
-                self.filter.pop(0)
-            return True
-        else:
-            self.filter.append(self.filter.pop(0))
-            return False
+        known = data in self
+        self.add(data)
+        return not known
+
+    def add(self, data):
+        if data not in self.current:
+            if len(self.current) >= self.generation_size:
+                self.previous, self.current = self.current, set()
+            self.current.add(data)
 
     def __contains__(self, v):
-        return v in self.filter
+        return v in self.current or v in self.previous
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+class BlockQueue(Queue):
+
+    """A queue of ``(t_block, proto)`` tuples with an index of the queued block hashes."""
+
+    def _init(self, maxsize, items=None):
+        self.hashes = dict()  # block hash -> number of queued entries
+        Queue._init(self, maxsize, items or ())
+        for item in self.queue:
+            self._index(item)
+
+    def _index(self, item):
+        h = item[0].header.hash
+        self.hashes[h] = self.hashes.get(h, 0) + 1
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self._index(item)
+
+    def _get(self):
+        item = Queue._get(self)
+        h = item[0].header.hash
+        if self.hashes[h] == 1:
+            del self.hashes[h]
+        else:
+            self.hashes[h] -= 1
+        return item
+
+    def __contains__(self, block_hash):
+        return block_hash in self.hashes
 
 
 class DAOChallenger(object):
@@ -111,7 +161,11 @@ class ChainService(WiredService):
     # required by BaseService
     name = 'chain'
     default_config = dict(
-        eth=dict(network_id=0, genesis='', pruning=-1),
+        eth=dict(network_id=0, genesis='', pruning=-1,
+                 txindex_blocks=0,  # transactions of the last N blocks are indexed, 0 for all
+                 head_candidate_debounce=0.,  # min seconds between head candidate updates
+                 sender_recovery_processes=0,  # worker processes recovering tx senders
+                 txpool_max_txs=TxPool.max_txs, txpool_max_bytes=TxPool.max_bytes),
         block=ethereum_config.default_config
     )
 
@@ -124,6 +178,11 @@ class ChainService(WiredService):
     synchronizer = None
     config = None
     block_queue_size = 1024
+    freezer_batch_size = 1000  # max blocks moved to the freezer per new head
+    known_txs_per_peer = 8192
+    known_blocks_per_peer = 1024
+    txindex_batch_size = 1000  # blocks indexed per commit while building the tx index
+    import_lookahead = 8  # queued blocks prepared for import while earlier ones execute
     processed_gas = 0
     processed_elapsed = 0
     process_time_queue_period = 5
@@ -131,24 +190,27 @@ class ChainService(WiredService):
     def __init__(self, app):
         self.config = app.config
         sce = self.config['eth']
+        self.db = app.services.db
+        # markers describing the database, older versions stored them in the shared keyspace
+        self.meta = self.db.namespace('meta') if hasattr(self.db, 'namespace') else None
+        # receipts of imported blocks by block hash
+        self.receipts = self.db.namespace('receipts') if hasattr(self.db, 'namespace') else None
         if int(sce['pruning']) >= 0:
-            self.db = RefcountDB(app.services.db)
-            if "I am not pruning" in self.db.db:
+            if self._has_marker(b'I am not pruning'):
                 raise RuntimeError(
                     "The database in '{}' was initialized as non-pruning. "
                     "Can not enable pruning now.".format(self.config['data_dir']))
             self.db.ttl = int(sce['pruning'])
-            self.db.db.put("I am pruning", "1")
+            self._put_marker(b'I am pruning', b'1')
         else:
-            self.db = app.services.db
-            if "I am pruning" in self.db:
+            if self._has_marker(b'I am pruning'):
                 raise RuntimeError(
                     "The database in '{}' was initialized as pruning. "
                     "Can not disable pruning now".format(self.config['data_dir']))
-            self.db.put("I am not pruning", "1")
+            self._put_marker(b'I am not pruning', b'1')
 
-        if 'network_id' in self.db:
-            db_network_id = self.db.get(b'network_id')
+        if self._has_marker(b'network_id'):
+            db_network_id = self._get_marker(b'network_id')
             if db_network_id != to_string(sce['network_id']):
                 raise RuntimeError(
                     "The database in '{}' was initialized with network id {} and can not be used "
@@ -158,7 +220,7 @@ class ChainService(WiredService):
                 )
 
         else:
-            self.db.put(b'network_id', to_string(sce['network_id']))
+            self._put_marker(b'network_id', to_string(sce['network_id']))
             self.db.commit()
 
         assert self.db is not None
@@ -180,22 +242,54 @@ class ChainService(WiredService):
         self.dao_challenges = dict()
         self.synchronizer = Synchronizer(self, force_sync=None)
 
-        self.block_queue = Queue(maxsize=self.block_queue_size)
+        self._init_tx_index()
+
+        processes = sce.get('sender_recovery_processes', 0)
+        self.sender_recovery = SenderRecovery(processes) if processes else None
+
+        self.block_queue = BlockQueue(maxsize=self.block_queue_size)
         # When the transaction_queue is modified, we must set
         # self._head_candidate_needs_updating to True in order to force the
-        # head candidate to be updated.
-        self.transaction_queue = TransactionQueue()
+        # head candidate to be updated, on new heads _head_candidate_needs_rebuild.
+        self.transaction_queue = TxPool(sce.get('txpool_max_txs'), sce.get('txpool_max_bytes'))
+        self.head_candidate_debounce = sce.get('head_candidate_debounce', 0)
+        self._head_candidate_needs_rebuild = True
         self._head_candidate_needs_updating = True
+        self._head_candidate_new_txs = []  # admitted since the candidate was last updated
+        self._head_candidate_updated = 0
         # Initialize a new head candidate.
         _ = self.head_candidate
         self.min_gasprice = 100 * 10**9 # TODO: better be an option to validator service?
         self.add_blocks_lock = False
         self.add_transaction_lock = gevent.lock.Semaphore()
         self.broadcast_filter = DuplicatesFilter()
+        # hashes each peer announced to us or was sent by us, they are not broadcast to it again
+        self.known_txs = dict()
+        self.known_blocks = dict()
         self.on_new_head_cbs = []
         self.newblock_processing_times = deque(maxlen=1000)
+        self.import_timings = dict((stage, Histogram())
+                                   for stage in ('decode', 'senders', 'wait', 'execute'))
         gevent.spawn_later(self.process_time_queue_period, self.process_time_queue)
 
+    def _get_marker(self, key):
+        if self.meta is not None:
+            try:
+                return self.meta.get(key)
+            except KeyError:
+                pass
+        return self.db.get(key)
+
+    def _has_marker(self, key):
+        try:
+            self._get_marker(key)
+        except KeyError:
+            return False
+        return True
+
+    def _put_marker(self, key, value):
+        (self.meta if self.meta is not None else self.db).put(key, value)
+
     @property
     def is_syncing(self):
         return self.synchronizer.synctask is not None
@@ -209,42 +303,375 @@ class ChainService(WiredService):
         return False
 
     def process_time_queue(self):
+        queued = len(self.chain.time_queue)
+        self._begin_block()
         try:
             self.chain.process_time_queue()
         except Exception as e:
             log.info(str(e))
         finally:
+            self._end_block(queued - len(self.chain.time_queue))
             gevent.spawn_later(self.process_time_queue_period, self.process_time_queue)
 
-    # TODO: Move to pyethereum
+    def _begin_block(self):
+        if hasattr(self.db, 'begin_block'):  # not a plain db
+            self.db.begin_block()
+
+    def _end_block(self, blocks):
+        if hasattr(self.db, 'end_block'):
+            self.db.end_block(blocks)
+
+    def _add_to_chain(self, block):
+        """Add `block` to the chain and pin its state if it ends up on a side chain.
+
+        The db writes of the import, including those of the new head callbacks, are one block
+        of a db with group commits, see :meth:`DBService.end_block`.
+        """
+        added = False
+        self._begin_block()
+        try:
+            added = self.chain.add_block(block)
+            if added:
+                self._pin_side_state(block)
+        finally:
+            self._end_block(int(added))
+        return added
+
     def get_receipts(self, block):
-        # Receipts are no longer stored in the database, so need to generate
-        # them on the fly here.
+        """Return the receipts of `block`.
+
+        They are read from the ``receipts`` namespace of the db, blocks imported to the head
+        store them there. Receipts of other blocks are computed by executing the block on top of
+        its parent's state. They are stored for later lookups if the block is in the chain, but
+        not for pending blocks like the head candidate, whose hash changes with every tx.
+        """
+        if not block.transactions:
+            return []
+        receipts = self._load_receipts(block.hash)
+        if receipts is None:
+            receipts = self._compute_receipts(block)
+            if self.chain.has_blockhash(block.hash):
+                self._store_receipts(block, receipts)
+        return receipts
+
+    def _compute_receipts(self, block):
         temp_state = self.chain.mk_poststate_of_blockhash(block.header.prevhash)
         initialize(temp_state, block)
         for tx in block.transactions:
             apply_transaction(temp_state, tx)
         return temp_state.receipts
 
+    def _load_receipts(self, blockhash):
+        if self.receipts is None:
+            return None
+        try:
+            data = self.receipts.get(blockhash)
+        except KeyError:
+            return None
+        return rlp.decode(data, sedes=CountableList(Receipt))
+
+    def _store_receipts(self, block, receipts):
+        if self.receipts is not None and receipts:
+            assert len(receipts) == len(block.transactions)
+            self.receipts.put(block.hash, rlp.encode(receipts, sedes=CountableList(Receipt)))
+
+    def has_receipts(self, block):
+        "if the receipts of `block` are stored or need not be (no transactions)"
+        return not block.transactions or (self.receipts is not None and
+                                          block.hash in self.receipts)
+
+    def backfill_receipts(self, first, last, commit_every=1000):
+        """Store the receipts of the canonical blocks `first` to `last` not stored yet.
+
+        :returns: the number of blocks whose receipts were stored
+        """
+        stored = 0
+        for n in range(first, last + 1):
+            block = self.chain.get_block_by_number(n)
+            if not self.has_receipts(block):
+                self.get_receipts(block)  # computes and stores them
+                stored += 1
+            if n % commit_every == 0:
+                self.db.commit()
+                log.info('backfilled receipts', number=n, stored=stored)
+        self.db.commit()
+        return stored
+
+    def _get_many(self, keys):
+        "reads `keys` from the chain db in one batch if the db supports it"
+        db = self.chain.db
+        if hasattr(db, 'get_many'):
+            return db.get_many(keys)
+        values = []
+        for key in keys:
+            try:
+                values.append(db.get(key))
+            except KeyError:
+                values.append(None)
+        return values
+
+    def get_blocks(self, blockhashes):
+        "returns the blocks for `blockhashes`, `None` for unknown ones"
+        blocks = []
+        for blockhash, block_rlp in zip(blockhashes, self._get_many(blockhashes)):
+            if block_rlp is None:
+                blocks.append(None)
+            elif block_rlp == b'GENESIS':
+                blocks.append(self.chain.genesis)
+            else:
+                try:
+                    blocks.append(rlp.decode(block_rlp, Block))
+                except rlp.DecodingError:
+                    log.debug('failed to decode block', block_hash=encode_hex(blockhash))
+                    blocks.append(None)
+        return blocks
+
+    def get_blocks_by_number(self, numbers):
+        "returns the blocks of the canonical chain for `numbers`, `None` for unknown ones"
+        blockhashes = self._get_many([b'block:' + to_string(n) for n in numbers])
+        known = [h for h in blockhashes if h is not None]
+        blocks = dict(zip(known, self.get_blocks(known)))
+        return [blocks.get(h) for h in blockhashes]
+
     def _on_new_head(self, block):
         log.debug('new head cbs', num=len(self.on_new_head_cbs))
-        self.transaction_queue = self.transaction_queue.diff(
-            block.transactions)
-        self._head_candidate_needs_updating = True
+        if getattr(self.db, 'ttl', -1) >= 0:
+            self._pin_state(block)  # before the cleanup releases states it shares nodes with
+            self.db.cleanup(block.number)
+        receipts = self.chain.state.receipts
+        # blocks added on top of the head leave their receipts in the state, not reorgs
+        if block.transactions and len(receipts) == len(block.transactions):
+            self._store_receipts(block, receipts)
+        if self.txloc is not None:
+            self.update_tx_index(block)
+        self.freeze_ancient_blocks(block.number)
+        self.transaction_queue.remove(block.transactions)
+        self._head_candidate_needs_rebuild = True
         for cb in self.on_new_head_cbs:
             cb(block)
 
+    def _pin_state(self, block):
+        "references the state of `block` in a pruning db until it leaves the pruning window"
+        if getattr(self.db, 'ttl', -1) < 0:
+            return
+        root = block.header.state_root
+        if root in self.db:  # the blank root is never stored
+            self.db.inc_refcount(root, self.db.get(root))
+        self.db.commit_refcount_changes(block.number)
+
+    def _pin_side_state(self, block):
+        "pins the state of an imported block not (yet) on the canonical chain"
+        if block.header.hash != self.chain.head_hash:
+            self._pin_state(block)  # its nodes would not be counted and never be pruned
+
+    def _init_tx_index(self):
+        """Set up the index of the transactions of the canonical chain.
+
+        The ``txloc`` namespace maps transaction hashes to the hash of their block and their
+        index in it, for the blocks from :attr:`txindex_tail` to :attr:`txindex_head`. New heads
+        are indexed as they arrive, older blocks by :meth:`build_tx_index` in the background.
+        """
+        self.txloc = None
+        if self.meta is None:
+            return
+        self.txloc = self.db.namespace('txloc')
+        self.txindex_blocks = self.config['eth']['txindex_blocks']
+        try:
+            self.txindex_head = self.meta.get(b'txindex_head')
+            self.txindex_tail = int(self.meta.get(b'txindex_tail'))
+        except KeyError:
+            head = self.chain.head
+            self.txindex_head = head.hash
+            self.txindex_tail = head.number + 1  # empty, built downwards from the head
+            self._put_tx_index_markers()
+            self.db.commit()
+        if self.txindex_tail > self._tx_index_bound():
+            gevent.spawn(self.build_tx_index)
+
+    def _tx_index_bound(self, head_number=None):
+        "returns the number of the oldest block to be indexed"
+        if head_number is None:
+            head_number = self.chain.head.number
+        if self.txindex_blocks:
+            return max(1, head_number - self.txindex_blocks + 1)
+        return 1  # the genesis has no transactions
+
+    def _put_tx_index_markers(self):
+        self.meta.put(b'txindex_head', self.txindex_head)
+        self.meta.put(b'txindex_tail', to_string(self.txindex_tail))
+
+    def _index_block(self, block):
+        for i, tx in enumerate(block.transactions):
+            self.txloc.put(tx.hash, rlp.encode([block.hash, i]))
+
+    def _unindex_block(self, block):
+        for tx in block.transactions:
+            try:
+                blockhash, _ = rlp.decode(self.txloc.get(tx.hash))
+            except KeyError:
+                continue
+            if blockhash == block.hash:  # not included again by the new chain
+                self.txloc.delete(tx.hash)
+
+    def update_tx_index(self, block):
+        """Index the new head `block`.
+
+        On reorgs the blocks of the previous head's chain which are no longer canonical are
+        removed from the index first and all canonical blocks up to `block` are added. If the
+        index is bounded the blocks which fell out of the window are removed.
+        """
+        fork_number = block.number - 1
+        if block.header.prevhash != self.txindex_head:
+            b = self.chain.get_block(self.txindex_head)
+            while b is not None and b.number >= self.txindex_tail and \
+                    self.chain.get_blockhash_by_number(b.number) != b.hash:
+                self._unindex_block(b)
+                b = self.chain.get_parent(b)
+            fork_number = b.number if b is not None else self.txindex_tail - 1
+        for number in range(max(fork_number + 1, self.txindex_tail), block.number):
+            self._index_block(self.chain.get_block_by_number(number))
+        self._index_block(block)
+        self.txindex_head = block.hash
+        bound = self._tx_index_bound(block.number)
+        while self.txindex_tail < bound:
+            old = self.chain.get_block_by_number(self.txindex_tail)
+            if old is not None:
+                self._unindex_block(old)
+            self.txindex_tail += 1
+        self._put_tx_index_markers()
+
+    def build_tx_index(self):
+        "indexes the blocks below the tail of the tx index down to its bound, newest first"
+        log.info('building transaction index', **self.tx_index_progress())
+        while self.txindex_tail > self._tx_index_bound():
+            number = self.txindex_tail - 1
+            blockhash = self.chain.get_blockhash_by_number(number)
+            if blockhash is None:
+                log.warning('missing canonical block, not indexing', number=number)
+                break
+            self._index_block(self.chain.get_block(blockhash))
+            self.txindex_tail = number
+            if number % self.txindex_batch_size == 0:
+                self._put_tx_index_markers()
+                self.db.commit()
+                log.debug('building transaction index', **self.tx_index_progress())
+                gevent.sleep(0)
+        self._put_tx_index_markers()
+        self.db.commit()
+        log.info('transaction index built', **self.tx_index_progress())
+
+    def tx_index_progress(self):
+        "returns the indexed block range and the fraction of the blocks to index done"
+        if self.txloc is None:
+            return dict(enabled=False)
+        head_number = self.chain.head.number
+        bound = self._tx_index_bound(head_number)
+        total = head_number - bound + 1
+        indexed = head_number - max(self.txindex_tail, bound) + 1
+        return dict(enabled=True, first=self.txindex_tail, last=head_number, bound=bound,
+                    progress=indexed / total if total > 0 else 1.)
+
+    def get_transaction(self, txhash):
+        """Return `(tx, block, index)` of a transaction of the canonical chain.
+
+        The transaction index is used if it covers the transaction, otherwise the lookup falls
+        back to the chain's own index.
+
+        :raises: :exc:`KeyError` if the transaction is unknown
+        """
+        if self.txloc is not None:
+            try:
+                blockhash, index = rlp.decode(self.txloc.get(txhash))
+            except KeyError:
+                pass
+            else:
+                block = self.chain.get_block(blockhash)
+                index = big_endian_to_int(index)
+                return block.transactions[index], block, index
+        result = self.chain.get_transaction(txhash)
+        if result is None:
+            raise KeyError(txhash)
+        return result
+
+    def freeze_ancient_blocks(self, head_number):
+        """Move canonical blocks more than ``db.freezer_depth`` blocks behind the head to the
+        freezer of the db."""
+        if getattr(self.db, 'freezer', None) is None:
+            return
+        first = int(self.db.get(b'GENESIS_NUMBER')) + self.db.freezer.count
+        last = min(head_number - self.config['db']['freezer_depth'],
+                   first + self.freezer_batch_size - 1)
+        if last < first:
+            return
+        for number in range(first, last + 1):
+            blockhash = self.chain.get_blockhash_by_number(number)
+            if blockhash is None:
+                log.warning('missing canonical block, not freezing', number=number)
+                break
+            self.db.freeze(blockhash)
+        self.db.commit()
+        log.debug('froze blocks', first=first, last=number, frozen=self.db.freezer.count)
+
     @property
     def head_candidate(self):
-        if self._head_candidate_needs_updating:
-            self._head_candidate_needs_updating = False
-            # Make a copy of self.transaction_queue because
-            # make_head_candidate modifies it.
-            txqueue = copy.deepcopy(self.transaction_queue)
-            self._head_candidate, self._head_candidate_state = make_head_candidate(
-                self.chain, txqueue, timestamp=int(time.time() - 1), coinbase=self.coinbase)
+        """The block to be mined next.
+
+        It is rebuilt from all pending transactions on new heads only. Transactions admitted
+        later are applied on top of the unfinalized state of the current candidate, at most
+        once every ``eth.head_candidate_debounce`` seconds.
+        """
+        if self._head_candidate_needs_rebuild:
+            self._rebuild_head_candidate()
+        elif self._head_candidate_needs_updating:
+            if time.time() - self._head_candidate_updated >= self.head_candidate_debounce:
+                self._extend_head_candidate()
         return self._head_candidate
 
+    def _rebuild_head_candidate(self):
+        # same steps as ethereum.meta.make_head_candidate, but keeping the state before
+        # finalization to apply new transactions to
+        temp_state = State.from_snapshot(self.chain.state.to_snapshot(root_only=True),
+                                         self.chain.env)
+        cs = get_consensus_strategy(self.chain.env.config)
+        blk = mk_block_from_prevstate(self.chain, temp_state, timestamp=int(time.time() - 1),
+                                      coinbase=self.coinbase)
+        blk = blk.copy(uncles=cs.get_uncles(self.chain, temp_state))
+        blk = blk.copy(header=blk.header.copy(uncles_hash=sha3(rlp.encode(blk.uncles))))
+        cs.initialize(temp_state, blk)
+        # make a copy of self.transaction_queue because add_transactions modifies it
+        blk = add_transactions(temp_state, blk, self.transaction_queue.copy())
+        self._head_candidate_base = blk, temp_state
+        self._head_candidate_needs_rebuild = False
+        self._head_candidate_new_txs = []
+        self._finalize_head_candidate()
+
+    def _extend_head_candidate(self):
+        blk, temp_state = self._head_candidate_base
+        for tx in self._head_candidate_new_txs:
+            try:
+                apply_transaction(temp_state, tx)
+            except InvalidTransaction as e:  # e.g. a nonce gap, retried on the next rebuild
+                log.debug('tx not added to head candidate', tx=tx, error=e)
+                continue
+            blk = blk.copy(transactions=blk.transactions + (tx,))
+        self._head_candidate_base = blk, temp_state
+        self._head_candidate_new_txs = []
+        self._finalize_head_candidate()
+
+    def _finalize_head_candidate(self):
+        blk, temp_state = self._head_candidate_base
+        # finalize a copy, the base state keeps accepting transactions
+        temp_state.commit()
+        final_state = State.from_snapshot(
+            temp_state.to_snapshot(root_only=True, no_prevblocks=True), temp_state.env)
+        for param in STATE_DEFAULTS:
+            setattr(final_state, param, copy.copy(getattr(temp_state, param)))
+        get_consensus_strategy(self.chain.env.config).finalize(final_state, blk)
+        self._head_candidate = set_execution_results(final_state, blk)
+        self._head_candidate_state = final_state
+        self._head_candidate_needs_updating = False
+        self._head_candidate_updated = time.time()
+
     def add_transaction(self, tx, origin=None, force_broadcast=False, force=False):
         if self.is_syncing:
             if force_broadcast:
@@ -278,16 +705,82 @@ class ChainService(WiredService):
                 log.debug('discarding tx', syncing=self.is_syncing, mining=self.is_mining)
                 return
 
-        casper_contract = tx.to == self.chain.state.env.config['CASPER_ADDRESS']
-        vote = tx.data[0:4] == b'\xe9\xdc\x06\x14'
-        null_sender = tx.sender == b'\xff' * 20
-        if tx.gasprice >= self.min_gasprice or (casper_contract and vote and null_sender):
+        self._queue_transactions([tx], force=force)
+
+    def add_transactions(self, txs, origin=None):
+        """Admit a batch of transactions received from `origin`.
+
+        Like :meth:`add_transaction` for each of them, but known transactions are dropped up
+        front and the others are validated in order of sender and nonce against a single view
+        of the head candidate state, which accepts consecutive nonces of a sender within the
+        batch. The valid ones are broadcast with one message per peer and the head candidate
+        is updated once.
+        """
+        if self.is_syncing:
+            return  # we can not evaluate the txs based on outdated state
+        log.debug('add_transactions', num=len(txs), origin=origin)
+        assert origin is None or isinstance(origin, BaseProtocol)
+        hashes = set()
+        fresh = []
+        for tx in txs:
+            if tx.hash not in self.broadcast_filter and tx.hash not in hashes:
+                hashes.add(tx.hash)
+                fresh.append(tx)
+        if self.sender_recovery is not None:
+            self.sender_recovery.recover(fresh)
+        signed = []
+        for tx in fresh:
+            try:
+                tx.sender
+            except InvalidTransaction as e:
+                log.debug('invalid tx', error=e)
+                continue
+            signed.append(tx)
+        signed.sort(key=lambda tx: (tx.sender, tx.nonce))
+
+        valid = self._validate_transactions(signed)
+        log.debug('valid txs, broadcasting', num=len(valid), invalid=len(signed) - len(valid))
+        self.broadcast_transactions(valid, origin=origin)
+
+        if origin is not None and not self.is_mining:
+            log.debug('discarding txs', mining=self.is_mining)
+            return
+        self._queue_transactions(valid)
+
+    def _validate_transactions(self, txs):
+        "returns those of `txs` which are valid when applied in order to the head candidate"
+        view = self._head_candidate_state.ephemeral_clone()
+        valid = []
+        for tx in txs:
+            try:
+                validate_transaction(view, tx)
+            except InvalidTransaction as e:
+                log.debug('invalid tx', error=e)
+                continue
+            # the upfront cost is the most the tx can take from the sender
+            view.increment_nonce(tx.sender)
+            view.delta_balance(tx.sender, -(tx.value + tx.gasprice * tx.startgas))
+            valid.append(tx)
+        return valid
+
+    def _queue_transactions(self, txs, force=False):
+        queued = []
+        for tx in txs:
+            casper_contract = tx.to == self.chain.state.env.config['CASPER_ADDRESS']
+            vote = tx.data[0:4] == b'\xe9\xdc\x06\x14'
+            null_sender = tx.sender == b'\xff' * 20
+            if tx.gasprice >= self.min_gasprice or (casper_contract and vote and null_sender):
+                queued.append(tx)
+            else:
+                log.info("too low gasprice, ignore", tx=encode_hex(tx.hash)[:8],
+                         gasprice=tx.gasprice)
+        if queued:
             self.add_transaction_lock.acquire()
-            self.transaction_queue.add_transaction(tx, force=force)
+            for tx in queued:
+                if self.transaction_queue.add_transaction(tx, force=force):
+                    self._head_candidate_new_txs.append(tx)
             self._head_candidate_needs_updating = True
             self.add_transaction_lock.release()
-        else:
-            log.info("too low gasprice, ignore", tx=encode_hex(tx.hash)[:8], gasprice=tx.gasprice)
 
     def check_header(self, header):
         return check_pow(self.chain.state, header)
@@ -302,11 +795,11 @@ class ChainService(WiredService):
     def add_mined_block(self, block):
         log.debug('adding mined block', block=block)
         assert isinstance(block, Block)
-        if self.chain.add_block(block):
+        if self._add_to_chain(block):
             log.debug('added', block=block, ts=time.time())
             assert block == self.chain.head
-            self.transaction_queue = self.transaction_queue.diff(block.transactions)
-            self._head_candidate_needs_updating = True
+            self.transaction_queue.remove(block.transactions)
+            self._head_candidate_needs_rebuild = True
             self.broadcast_newblock(block, chain_difficulty=self.chain.get_pow_difficulty(block))
             return True
         log.debug('failed to add', block=block, ts=time.time())
@@ -317,10 +810,7 @@ class ChainService(WiredService):
         if self.chain.has_blockhash(block_hash):
             return True
         # check if queued or processed
-        for i in range(len(self.block_queue.queue)):
-            if block_hash == self.block_queue.queue[i][0].header.hash:
-                return True
-        return False
+        return block_hash in self.block_queue
 
     def _add_blocks(self):
         log.debug('add_blocks', qsize=self.block_queue.qsize(),
@@ -329,65 +819,113 @@ class ChainService(WiredService):
         self.add_transaction_lock.acquire()
         try:
             while not self.block_queue.empty():
-                # sleep at the beginning because continue keywords will skip bottom
+                self._prepare_queued_blocks()
                 gevent.sleep(0.001)
-
                 t_block, proto = self.block_queue.peek()  # peek: knows_block while processing
-                if self.chain.has_blockhash(t_block.header.hash):
-                    log.warn('known block', block=t_block)
-                    self.block_queue.get()
-                    continue
-                if not self.chain.has_blockhash(t_block.header.prevhash):
-                    log.warn('missing parent', block=t_block, head=self.chain.head)
-                    self.block_queue.get()
-                    continue
-                try:  # deserialize
-                    st = time.time()
-                    block = t_block.to_block()
-                    elapsed = time.time() - st
-                    log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
-                              gas_used=block.gas_used, gpsec=self.gpsec(block.gas_used, elapsed))
-                except InvalidTransaction as e:
-                    log.warn('invalid transaction', block=t_block, error=e, FIXME='ban node')
-                    errtype = \
-                        'InvalidNonce' if isinstance(e, InvalidNonce) else \
-                        'NotEnoughCash' if isinstance(e, InsufficientBalance) else \
-                        'OutOfGasBase' if isinstance(e, InsufficientStartGas) else \
-                        'other_transaction_error'
-                    sentry.warn_invalid(t_block, errtype)
-                    self.block_queue.get()
-                    continue
-                except VerificationFailed as e:
-                    log.warn('verification failed', error=e, FIXME='ban node')
-                    sentry.warn_invalid(t_block, 'other_block_error')
-                    self.block_queue.get()
-                    continue
-
-                # All checks passed
-                log.debug('adding', block=block, ts=time.time())
-                if self.chain.add_block(block):
-                    now = time.time()
-                    log.info('added', block=block, txs=block.transaction_count,
-                             gas_used=block.gas_used)
-                    if t_block.newblock_timestamp:
-                        total = now - t_block.newblock_timestamp
-                        self.newblock_processing_times.append(total)
-                        avg = statistics.mean(self.newblock_processing_times)
-                        med = statistics.median(self.newblock_processing_times)
-                        max_ = max(self.newblock_processing_times)
-                        min_ = min(self.newblock_processing_times)
-                        log.info('processing time', last=total, avg=avg, max=max_, min=min_,
-                                 median=med)
-                    if self.is_mining:
-                        self.transaction_queue = self.transaction_queue.diff(block.transactions)
-                else:
-                    log.warn('could not add', block=block)
-
+                block = self._prepared_block(t_block)
+                if block is not None:
+                    self._import_block(t_block, block)
                 self.block_queue.get()  # remove block from queue (we peeked only)
         finally:
             self.add_blocks_lock = False
             self.add_transaction_lock.release()
 
+    def _prepared_block(self, t_block):
+        "waits for the preparation of `t_block`, returns its block or `None` if it is skipped"
+        if self.chain.has_blockhash(t_block.header.hash):
+            log.warn('known block', block=t_block)
+            return None
+        if not self.chain.has_blockhash(t_block.header.prevhash):
+            log.warn('missing parent', block=t_block, head=self.chain.head)
+            return None
+        try:  # deserialize
+            st = time.time()
+            block, error = t_block.preparation.get()  # waits for the earlier stages
+            if error is not None:
+                raise error
+            elapsed = time.time() - st
+            self.import_timings['wait'].add(elapsed)
+            log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
+                      gas_used=block.gas_used, gpsec=self.gpsec(block.gas_used, elapsed))
+        except InvalidTransaction as e:
+            log.warn('invalid transaction', block=t_block, error=e, FIXME='ban node')
+            errtype = \
+                'InvalidNonce' if isinstance(e, InvalidNonce) else \
+                'NotEnoughCash' if isinstance(e, InsufficientBalance) else \
+                'OutOfGasBase' if isinstance(e, InsufficientStartGas) else \
+                'other_transaction_error'
+            sentry.warn_invalid(t_block, errtype)
+            return None
+        except VerificationFailed as e:
+            log.warn('verification failed', error=e, FIXME='ban node')
+            sentry.warn_invalid(t_block, 'other_block_error')
+            return None
+        return block
+
+    def _import_block(self, t_block, block):
+        # All checks passed
+        log.debug('adding', block=block, ts=time.time())
+        st = time.time()
+        if not self._add_to_chain(block):
+            log.warn('could not add', block=block)
+            return
+        now = time.time()
+        self.import_timings['execute'].add(now - st)
+        log.info('added', block=block, txs=block.transaction_count,
+                 gas_used=block.gas_used, elapsed='%.4fs' % (now - st))
+        if t_block.newblock_timestamp:
+            total = now - t_block.newblock_timestamp
+            self.newblock_processing_times.append(total)
+            avg = statistics.mean(self.newblock_processing_times)
+            med = statistics.median(self.newblock_processing_times)
+            max_ = max(self.newblock_processing_times)
+            min_ = min(self.newblock_processing_times)
+            log.info('processing time', last=total, avg=avg, max=max_, min=min_,
+                     median=med)
+        if self.is_mining:
+            self.transaction_queue.remove(block.transactions)
+
+    def _prepare_queued_blocks(self):
+        """Start the import stages preceding execution for the first queued blocks.
+
+        Each of the next :attr:`import_lookahead` blocks is deserialized and has its tx senders
+        recovered in a greenlet of its own. Deserialization runs in this process whenever the
+        import loop yields, so it is done ahead of execution but does not overlap with it. Only
+        sender recovery runs in parallel, if ``eth.sender_recovery_processes`` are configured.
+        The workers take the batches in queue order and a block only waits for the recovery of
+        its own transactions.
+        """
+        for t_block, _ in itertools.islice(self.block_queue.queue, self.import_lookahead):
+            if t_block.preparation is None:
+                t_block.preparation = gevent.spawn(self._prepare_block, t_block)
+
+    def _prepare_block(self, t_block):
+        "returns the :class:`Block` of `t_block` and the exception raised creating it"
+        st = time.time()
+        try:
+            block = t_block.to_block()
+        except (InvalidTransaction, VerificationFailed) as e:
+            return None, e
+        decoded = time.time()
+        self.import_timings['decode'].add(decoded - st)
+        if self.sender_recovery is not None:
+            self.sender_recovery.recover(block.transactions)
+            self.import_timings['senders'].add(time.time() - decoded)
+        return block, None
+
+    def import_stats(self):
+        """Return the timings of the block import stages.
+
+        ``wait`` is the time execution waited for the preceding stages of a block, it stays low
+        as long as import is bound by execution.
+        """
+        return dict((stage, histogram.stats) for stage, histogram in self.import_timings.items())
+
+    def stop(self):
+        if self.sender_recovery is not None:
+            self.sender_recovery.stop()
+        super(ChainService, self).stop()
+
     def gpsec(self, gas_spent=0, elapsed=0):
         if gas_spent:
             self.processed_gas += gas_spent
@@ -401,9 +939,8 @@ class ChainService(WiredService):
         assert isinstance(block, (eth_protocol.TransientBlock, Block))
         if self.broadcast_filter.update(block.header.hash):
             log.debug('broadcasting newblock', origin=origin)
-            bcast = self.app.services.peermanager.broadcast
-            bcast(eth_protocol.ETHProtocol, 'newblock', args=(block, chain_difficulty),
-                  exclude_peers=[origin.peer] if origin else [])
+            self._broadcast(self.known_blocks, {block.header.hash: block}, origin,
+                            lambda proto, blocks: proto.send_newblock(blocks[0], chain_difficulty))
         else:
             log.debug('already broadcasted block')
 
@@ -411,68 +948,103 @@ class ChainService(WiredService):
         assert isinstance(tx, Transaction)
         if self.broadcast_filter.update(tx.hash):
             log.debug('broadcasting tx', origin=origin)
-            bcast = self.app.services.peermanager.broadcast
-            bcast(eth_protocol.ETHProtocol, 'transactions', args=(tx,),
-                  exclude_peers=[origin.peer] if origin else [])
+            self._broadcast(self.known_txs, {tx.hash: tx}, origin,
+                            lambda proto, txs: proto.send_transactions(*txs))
         else:
             log.debug('already broadcasted tx')
 
+    def broadcast_transactions(self, txs, origin=None):
+        "sends each peer one message with those of `txs` it does not know"
+        txs = [tx for tx in txs if self.broadcast_filter.update(tx.hash)]
+        if not txs:
+            return
+        log.debug('broadcasting txs', num=len(txs), origin=origin)
+        self._broadcast(self.known_txs, OrderedDict((tx.hash, tx) for tx in txs), origin,
+                        lambda proto, txs: proto.send_transactions(*txs))
+
+    def _broadcast(self, known, items, origin, send):
+        """Sends each peer but `origin` those of `items` (by hash) it does not know yet.
+
+        The recipients are the peers connected when the broadcast starts, and only they are
+        marked as knowing what they were sent: a peer connecting while the uploads are under
+        way gets neither.
+        """
+        recipients = [peer for peer in self.app.services.peermanager.peers
+                      if self.wire_protocol in peer.protocols and
+                      (origin is None or peer is not origin.peer)]
+        for peer in recipients:
+            peer_known = known.get(peer, ())
+            unknown = [h for h in items if h not in peer_known]
+            if not unknown or self.wire_protocol not in peer.protocols:
+                continue  # nothing new or disconnected in the meantime
+            send(peer.protocols[self.wire_protocol], [items[h] for h in unknown])
+            if peer in known:
+                for h in unknown:
+                    known[peer].add(h)
+            peer.safe_to_read.wait()  # sequential uploads, like PeerManager.broadcast
+
+    def _mark_known(self, known, proto, item):
+        if proto.peer in known:  # registered by on_wire_protocol_start
+            known[proto.peer].add(item)
+
     def query_headers(self, hash_mode, max_hashes, skip, reverse, origin_hash=None, number=None):
+        if not hash_mode:
+            return self._query_headers_by_number(max_hashes, skip, reverse, number)
         headers = []
         unknown = False
         while not unknown and len(headers) < max_hashes:
-            if hash_mode:
-                if not origin_hash:
-                    break
-                block = self.chain.get_block(origin_hash)
-                if not block:
-                    break
-                # If reached genesis, stop
-                if block.number == 0:
-                    break
-                origin = block.header
-            else:
-                # If reached genesis, stop
-                if number is None or number == 0:
-                    break
-                block = self.chain.get_block_by_number(number)
-                if block is None:
-                    break
-                origin = block.header
+            if not origin_hash:
+                break
+            block = self.chain.get_block(origin_hash)
+            if not block:
+                break
+            # If reached genesis, stop
+            if block.number == 0:
+                break
+            origin = block.header
 
             headers.append(origin)
 
-            if hash_mode:  # hash traversal
-                if reverse:
-                    for i in range(skip+1):
-                        try:
-                            block = self.chain.get_block(origin_hash)
-                            if block:
-                                origin_hash = block.prevhash
-                            else:
-                                unknown = True
-                                break
-                        except KeyError:
-                            unknown = True
-                            break
-                else:
-                    blockhash = self.chain.get_blockhash_by_number(origin.number + skip + 1)
+            if reverse:
+                for i in range(skip+1):
                     try:
-                        # block = self.chain.get_block(blockhash)
-                        if block and self.chain.get_blockhashes_from_hash(blockhash, skip+1)[skip] == origin_hash:
-                            origin_hash = blockhash
+                        block = self.chain.get_block(origin_hash)
+                        if block:
+                            origin_hash = block.prevhash
                         else:
                             unknown = True
+                            break
                     except KeyError:
                         unknown = True
-            else:  # number traversal
-                if reverse:
-                    if number >= (skip + 1):
-                        number -= (skip + 1)
+                        break
+            else:
+                blockhash = self.chain.get_blockhash_by_number(origin.number + skip + 1)
+                try:
+                    # block = self.chain.get_block(blockhash)
+                    if block and self.chain.get_blockhashes_from_hash(blockhash, skip+1)[skip] == origin_hash:
+                        origin_hash = blockhash
                     else:
                         unknown = True
-                else:
-                    number += (skip + 1)
+                except KeyError:
+                    unknown = True
+        return headers
+
+    def _query_headers_by_number(self, max_hashes, skip, reverse, number):
+        # the requested numbers are known in advance, so fetch them in one batch
+        numbers = []
+        while number and len(numbers) < max_hashes:  # stop at genesis
+            numbers.append(number)
+            if reverse:
+                if number < skip + 1:
+                    break
+                number -= skip + 1
+            else:
+                number += skip + 1
+        headers = []
+        for block in self.get_blocks_by_number(numbers):
+            if block is None:
+                break
+            headers.append(block.header)
         return headers
 
     # wire protocol receivers ###########
@@ -481,6 +1053,8 @@ class ChainService(WiredService):
         # log.debug('----------------------------------')
         # log.debug('on_wire_protocol_start', proto=proto)
         assert isinstance(proto, self.wire_protocol)
+        self.known_txs[proto.peer] = DuplicatesFilter(self.known_txs_per_peer)
+        self.known_blocks[proto.peer] = DuplicatesFilter(self.known_blocks_per_peer)
         # register callbacks
         proto.receive_status_callbacks.append(self.on_receive_status)
         proto.receive_newblockhashes_callbacks.append(self.on_newblockhashes)
@@ -498,6 +1072,8 @@ class ChainService(WiredService):
 
     def on_wire_protocol_stop(self, proto):
         assert isinstance(proto, self.wire_protocol)
+        self.known_txs.pop(proto.peer, None)
+        self.known_blocks.pop(proto.peer, None)
         # log.debug('----------------------------------')
         # log.debug('on_wire_protocol_stop', proto=proto)
 
@@ -555,7 +1131,8 @@ class ChainService(WiredService):
         log.debug('----------------------------------')
         log.debug('remote_transactions_received', count=len(transactions), remote_id=proto)
         for tx in transactions:
-            self.add_transaction(tx, origin=proto)
+            self._mark_known(self.known_txs, proto, tx.hash)
+        self.add_transactions(transactions, origin=proto)
 
     # blockhashes ###########
 
@@ -567,6 +1144,8 @@ class ChainService(WiredService):
         log.debug('----------------------------------')
         log.debug("recv newblockhashes", num=len(newblockhashes), remote_id=proto)
         assert len(newblockhashes) <= 256
+        for h in newblockhashes:
+            self._mark_known(self.known_blocks, proto, h.hash)
         self.synchronizer.receive_newblockhashes(proto, newblockhashes)
 
     def on_receive_getblockheaders(self, proto, hash_or_number, block, amount, skip, reverse):
@@ -626,11 +1205,12 @@ class ChainService(WiredService):
         log.debug('----------------------------------')
         log.debug("on_receive_getblockbodies", count=len(blockhashes))
         found = []
-        for bh in blockhashes[:self.wire_protocol.max_getblocks_count]:
-            try:
-                found.append(self.chain.get_block(bh))
-            except KeyError:
+        blockhashes = blockhashes[:self.wire_protocol.max_getblocks_count]
+        for bh, block in zip(blockhashes, self.get_blocks(blockhashes)):
+            if block is None:
                 log.debug("unknown block requested", block_hash=encode_hex(bh))
+            else:
+                found.append(block)
         if found:
             log.debug("found", count=len(found))
             proto.send_blockbodies(*found)
@@ -644,4 +1224,5 @@ class ChainService(WiredService):
     def on_receive_newblock(self, proto, block, chain_difficulty):
         log.debug('----------------------------------')
         log.debug("recv newblock", block=block, remote_id=proto)
+        self._mark_known(self.known_blocks, proto, block.header.hash)
         self.synchronizer.receive_newblock(proto, block, chain_difficulty)
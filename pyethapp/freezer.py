@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+import os
+import struct
+from builtins import object
+from ethereum.slogging import get_logger
+
+log = get_logger('db.freezer')
+
+INDEX_ENTRY = struct.Struct('>Q')  # end offset of the item in the data file
+
+
+class Freezer(object):
+
+    """Append-only flat file storage for immutable items numbered from `0`.
+
+    Items are concatenated in ``<name>.dat``. ``<name>.idx`` holds a fixed width entry per item
+    with its end offset in the data file, so the `n`-th item is located with a single read of
+    the index.
+
+    Appended items are only durable after :meth:`sync`. Partially written items found on open
+    are dropped.
+
+    :ivar count: the number of items
+    """
+
+    def __init__(self, path, name='blocks'):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.index_file = open(os.path.join(path, name + '.idx'), 'a+b')
+        self.data_file = open(os.path.join(path, name + '.dat'), 'a+b')
+        self.index_file.seek(0, os.SEEK_END)
+        count = self.index_file.tell() // INDEX_ENTRY.size
+        self.count = count
+        self.truncate(count)  # drop partial entries
+        log.info('opened freezer', path=path, items=self.count)
+
+    def _end_offset(self, n):
+        if n < 0:
+            return 0
+        self.index_file.seek(n * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self.index_file.read(INDEX_ENTRY.size))[0]
+
+    def get(self, n):
+        """Return the `n`-th item or raise :exc:`KeyError`."""
+        if not 0 <= n < self.count:
+            raise KeyError('item %d not in freezer' % n)
+        start = self._end_offset(n - 1)
+        end = self._end_offset(n)
+        self.data_file.seek(start)
+        return self.data_file.read(end - start)
+
+    def append(self, value):
+        """Append `value` and return its number."""
+        end = self._end_offset(self.count - 1) + len(value)
+        self.data_file.seek(0, os.SEEK_END)
+        self.data_file.write(value)
+        self.index_file.seek(0, os.SEEK_END)
+        self.index_file.write(INDEX_ENTRY.pack(end))
+        self.count += 1
+        return self.count - 1
+
+    def sync(self):
+        for f in (self.data_file, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate(self, count):
+        """Drop all items from number `count` on."""
+        assert 0 <= count <= self.count
+        end = self._end_offset(count - 1)
+        self.index_file.truncate(count * INDEX_ENTRY.size)
+        self.data_file.truncate(end)
+        self.count = count
+
+    def close(self):
+        self.index_file.close()
+        self.data_file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '<Freezer at %s items=%d>' % (self.path, self.count)
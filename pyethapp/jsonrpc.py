@@ -10,6 +10,7 @@ import sys
 import inspect
 from copy import deepcopy
 from collections import Iterable
+from contextlib import contextmanager
 
 import ethereum.bloom as bloom
 from ethereum.utils import (is_numeric, is_string, int_to_big_endian, big_endian_to_int,
@@ -170,7 +171,7 @@ class RPCServer(BaseService):
 
     @classmethod
     def subdispatcher_classes(cls):
-        return (Web3, Personal, Net, Compilers, DB, Chain, Miner, FilterManager)
+        return (Web3, Personal, Net, Compilers, DB, Debug, Chain, Miner, FilterManager)
 
     def get_block(self, block_id=None):
         """Return the block identified by `block_id`.
@@ -830,6 +831,31 @@ class DB(Subdispatcher):
             return ''
 
 
+class Debug(Subdispatcher):
+
+    """Subdispatcher for diagnostics of the node."""
+
+    prefix = 'debug_'
+    required_services = ['db', 'chain']
+
+    @public
+    def dbStats(self):
+        """Return operation counts, latencies and cache statistics of the database."""
+        if not hasattr(self.db, 'stats'):
+            return dict()
+        return self.db.stats()
+
+    @public
+    def txIndexProgress(self):
+        """Return the block range covered by the transaction index and its build progress."""
+        return self.chain.tx_index_progress()
+
+    @public
+    def importStats(self):
+        """Return the timings of the block import stages."""
+        return self.chain.import_stats()
+
+
 class Chain(Subdispatcher):
 
     """Subdispatcher for methods to query the block chain."""
@@ -837,6 +863,21 @@ class Chain(Subdispatcher):
     prefix = 'eth_'
     required_services = ['chain']
 
+    @contextmanager
+    def state_at(self, block_id):
+        """Provide the state after the block identified by `block_id`.
+
+        Except for the pending block, the state is read from a single db snapshot, so answers
+        are consistent even if blocks are imported meanwhile.
+        """
+        block = self.json_rpc_server.get_block(block_id)
+        env = self.chain.chain.env
+        if block is self.chain.head_candidate or not hasattr(env.db, 'snapshot'):
+            yield State(block.state_root, env)
+            return
+        with env.db.snapshot() as snapshot:
+            yield State(block.state_root, Env(snapshot, env.config, env.global_config))
+
     @public
     def protocolVersion(self):
         return str(ETHProtocol.version)
@@ -864,17 +905,16 @@ class Chain(Subdispatcher):
     @decode_arg('block_id', block_id_decoder)
     @encode_res(quantity_encoder)
     def getBalance(self, address, block_id=None):
-        block = self.json_rpc_server.get_block(block_id)
-        state = State(block.state_root, self.chain.chain.env)
-        return state.get_balance(address)
+        with self.state_at(block_id) as state:
+            return state.get_balance(address)
 
     @public
     @decode_arg('address', address_decoder)
     @decode_arg('index', quantity_decoder)
     @decode_arg('block_id', block_id_decoder)
     def getStorageAt(self, address, index, block_id=None):
-        block = self.json_rpc_server.get_block(block_id)
-        i = block.get_storage_data(address, index)
+        with self.state_at(block_id) as state:
+            i = state.get_storage_data(address, index)
         assert is_numeric(i)
         return data_encoder(int_to_big_endian(i), length=32)
 
@@ -883,9 +923,9 @@ class Chain(Subdispatcher):
     @decode_arg('block_id', block_id_decoder)
     @encode_res(quantity_encoder)
     def getTransactionCount(self, address, block_id='pending'):
-        block = self.json_rpc_server.get_block(block_id)
-        state = State(block.state_root, self.chain.chain.env)
-        return state.get_nonce(address) - \
+        with self.state_at(block_id) as state:
+            nonce = state.get_nonce(address)
+        return nonce - \
             self.json_rpc_server.config['eth']['block']['ACCOUNT_INITIAL_NONCE']
 
     @public
@@ -927,9 +967,8 @@ class Chain(Subdispatcher):
     @decode_arg('block_id', block_id_decoder)
     @encode_res(data_encoder)
     def getCode(self, address, block_id=None):
-        block = self.json_rpc_server.get_block(block_id)
-        state = State(block.state_root, self.chain.chain.env)
-        return state.get_code(address)
+        with self.state_at(block_id) as state:
+            return state.get_code(address)
 
     @public
     @decode_arg('block_hash', block_hash_decoder)
@@ -953,7 +992,7 @@ class Chain(Subdispatcher):
     @decode_arg('tx_hash', tx_hash_decoder)
     def getTransactionByHash(self, tx_hash):
         try:
-            tx, block, index = self.chain.chain.get_transaction(tx_hash)
+            tx, block, index = self.chain.get_transaction(tx_hash)
             if block in self.chain.chain:
                 return tx_encoder(tx, block, index, False)
         except KeyError:
@@ -1085,10 +1124,8 @@ class Chain(Subdispatcher):
         :return: the next nonce for the address/account
         """
         assert address is not None
-        block = self.json_rpc_server.get_block(block_id)
-        assert block is not None
-        state = State(block.state_root, self.chain.chain.env)
-        nonce = state.get_nonce(address)
+        with self.state_at(block_id) as state:
+            nonce = state.get_nonce(address)
         assert nonce is not None and isinstance(nonce, int)
         return nonce
 
@@ -1356,9 +1393,7 @@ class LogFilter(object):
             if first > last:
                 return {}
 
-        blocks_to_check = []
-        for n in range(first, last):
-            blocks_to_check.append(self.chain.get_block_by_number(n))
+        blocks_to_check = self.chainservice.get_blocks_by_number(list(range(first, last)))
         # last block may be head candidate, which cannot be retrieved via get_block_by_number
         if last == self.chainservice.head_candidate.number:
             blocks_to_check.append(self.chainservice.head_candidate)
@@ -1611,7 +1646,7 @@ class FilterManager(Subdispatcher):
 
     # ########### Trace ############
     def _get_block_before_tx(self, txhash):
-        tx, blk, i = self.app.services.chain.chain.get_transaction(txhash)
+        tx, blk, i = self.app.services.chain.get_transaction(txhash)
         # get the state we had before this transaction
         test_blk = Block.init_from_parent(self.chain.get_parent(blk),
                                           blk.coinbase,
@@ -1669,12 +1704,13 @@ class FilterManager(Subdispatcher):
     @decode_arg('tx_hash', tx_hash_decoder)
     def getTransactionReceipt(self, tx_hash):
         try:
-            tx, block, index = self.chain.chain.get_transaction(tx_hash)
+            tx, block, index = self.chain.get_transaction(tx_hash)
         except KeyError:
             return None
         if block not in self.chain.chain:
             return None
-        receipt = self.chain.get_receipts(block)[index]
+        receipts = self.chain.get_receipts(block)
+        receipt = receipts[index]
         response = {
             'transactionHash': data_encoder(tx.hash),
             'transactionIndex': quantity_encoder(index),
@@ -1686,7 +1722,7 @@ class FilterManager(Subdispatcher):
         if index == 0:
             response['gasUsed'] = quantity_encoder(receipt.gas_used)
         else:
-            prev_receipt = temp_state.receipts[index - 1]
+            prev_receipt = receipts[index - 1]
             assert prev_receipt.gas_used < receipt.gas_used
             response['gasUsed'] = quantity_encoder(receipt.gas_used - prev_receipt.gas_used)
 
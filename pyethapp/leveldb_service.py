@@ -8,13 +8,20 @@ import leveldb
 from ethereum import slogging
 from ethereum.utils import encode_hex
 import random
+from .compression import ValueCodec, NoneCodec
+from .db_snapshot import NULL, OverlayChain, Snapshot
+from .lru_cache import LRUCache
 
 slogging.set_level('db', 'debug')
 log = slogging.get_logger('db')
 
-compress = decompress = lambda x: x
 PY3 = sys.version_info >= (3,)
 
+# values are tagged with their codec if this key is present, see `pyethapp.compression`
+VALUE_FORMAT_KEY = b'db:value_format'
+VALUE_FORMAT_TAGGED = NoneCodec.tag + b'tagged'
+ZSTD_DICTIONARY_KEY = b'db:zstd_dictionary'
+
 
 """
 memleak in py-leveldb
@@ -51,7 +58,7 @@ reading all entries == 400MB
 """
 
 
-class LevelDB(BaseDB):
+class LevelDB(OverlayChain, BaseDB):
     """
     filename                                    the database directory
     block_cache_size  (default: 8 * (2 << 20))  maximum allowed size for the block cache in bytes
@@ -62,74 +69,211 @@ class LevelDB(BaseDB):
     error_if_exists   (default: False)          if True, raises and error if the database exists
     paranoid_checks   (default: False)          if True, raises an error as soon as an internal
                                                 corruption is detected
+
+    Reads are served from a size bounded LRU cache (``cache_size`` bytes) in front of the db,
+    ``uncommitted`` only holds the dirty keys which are written on the next :meth:`commit`.
+    Snapshots freeze the pending changes without copying them, see :class:`OverlayChain`.
+
+    Values are compressed with the codec configured for their key class in `codecs` (see
+    :class:`pyethapp.compression.ValueCodec`). Databases created before values were tagged
+    with their codec are detected on open and stay uncompressed.
     """
 
     max_open_files = 32000
     block_cache_size = 8 * 1024**2
     write_buffer_size = 4 * 1024**2
+    cache_size = 32 * 1024**2
 
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, cache_size=None, codecs=None, zstd_dictionary=None):
         self.uncommitted = dict()
+        self.frozen = []  # changes shared with snapshots, newest first
+        self.committing = dict()  # frozen batch being written, still visible to readers
+        if cache_size is None:
+            cache_size = self.cache_size
         log.info('opening LevelDB',
                  path=dbfile,
                  block_cache_size=self.block_cache_size,
                  write_buffer_size=self.write_buffer_size,
-                 max_open_files=self.max_open_files)
+                 max_open_files=self.max_open_files,
+                 cache_size=cache_size)
+        self.cache = LRUCache(cache_size)
         self.dbfile = dbfile
         self.db = leveldb.LevelDB(dbfile, max_open_files=self.max_open_files)
         self.commit_counter = 0
+        self.overlay_hits = 0  # reads served from pending changes
+        self.codec = self._open_codec(codecs, zstd_dictionary)
+        log.info('value codec', codec=self.codec)
+
+    def _open_codec(self, codecs, zstd_dictionary):
+        try:
+            tagged = bytes(self.db.Get(VALUE_FORMAT_KEY)) == VALUE_FORMAT_TAGGED
+        except KeyError:
+            tagged = next(self.db.RangeIter(include_value=False), None) is None
+            if tagged:  # new database
+                self.db.Put(VALUE_FORMAT_KEY, VALUE_FORMAT_TAGGED, sync=True)
+        if not tagged:
+            if any(name != 'none' for name in (codecs or dict()).values()):
+                log.warning('database has untagged values, compression disabled', path=self.dbfile)
+            return ValueCodec(tagged=False)
+        try:
+            stored_dictionary = bytes(self.db.Get(ZSTD_DICTIONARY_KEY))[1:]
+        except KeyError:
+            stored_dictionary = None
+        if stored_dictionary is None and zstd_dictionary:
+            # values are only readable with the dictionary they were compressed with
+            self.db.Put(ZSTD_DICTIONARY_KEY, NoneCodec.tag + zstd_dictionary, sync=True)
+            stored_dictionary = zstd_dictionary
+        elif zstd_dictionary and zstd_dictionary != stored_dictionary:
+            log.warning('ignoring zstd dictionary, the database uses a different one')
+        return ValueCodec(codecs, zstd_dictionary=stored_dictionary)
 
     def reopen(self):
         del self.db
         self.db = leveldb.LevelDB(self.dbfile)
 
     def get(self, key):
-        log.trace('getting entry', key=encode_hex(key)[:8])
-        if key in self.uncommitted:
-            if self.uncommitted[key] is None:
+        o = self._from_overlay(key)
+        if o is not NULL:
+            self.overlay_hits += 1
+            if o is None:
                 raise KeyError("key not in db")
-            log.trace('from uncommitted')
-            return self.uncommitted[key]
-        log.trace('from db')
+            return o
+        if PY3 and isinstance(key, str):
+            key = key.encode()
+        o = self.cache.get(key)
+        if o is not None:
+            return o
+        if log.is_active('trace'):
+            log.trace('reading from db', key=encode_hex(key)[:8])
+
+        o = self.codec.decode(self.db.Get(key))
+        self.cache.put(key, o)
+        return o
 
-        if PY3:
-            if isinstance(key, str):
+    def get_many(self, keys, executor=None):
+        """Return the values for `keys` in the same order, `None` for unknown keys.
+
+        Keys missing from the overlay and the cache are read in sorted order from a single
+        snapshot, so the result is consistent even if a commit happens concurrently.
+
+        :param executor: optional callable ``executor(func, arg)`` used to run the disk reads
+                         (e.g. on a thread pool)
+        """
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            o = self._from_overlay(key)
+            if o is not NULL:
+                values[i] = o
+                continue
+            if PY3 and isinstance(key, str):
                 key = key.encode()
-            o = bytes(self.db.Get(key))
-        else:
-            o = decompress(self.db.Get(key))
-        self.uncommitted[key] = o
-        return o
+            o = self.cache.get(key)
+            if o is not None:
+                values[i] = o
+            else:
+                missing.append((key, i))
+        if missing:
+            missing.sort()
+            commit_counter = self.commit_counter
+            if executor is None:
+                found = self._read_snapshot(missing)
+            else:
+                found = executor(self._read_snapshot, missing)
+            # values read before a concurrent commit finished might be outdated by now
+            cacheable = commit_counter == self.commit_counter
+            for key, i, o in found:
+                if cacheable:
+                    self.cache.put(key, o)
+                values[i] = o
+        return values
+
+    def _read_snapshot(self, keys):
+        # touches the db only, so it is safe to run outside of the hub's thread
+        snapshot = self.db.CreateSnapshot()
+        found = []
+        for key, i in keys:
+            try:
+                o = snapshot.Get(key)
+            except KeyError:
+                continue
+            found.append((key, i, self.codec.decode(o)))
+        return found
+
+    def snapshot(self):
+        """Return a :class:`Snapshot` of the current state including uncommitted changes."""
+        db_snapshot = self.db.CreateSnapshot()
+
+        def reader(key):
+            if PY3 and isinstance(key, str):
+                key = key.encode()
+            return self.codec.decode(db_snapshot.Get(key))
+
+        return Snapshot(reader, self._snapshot_overlays())
 
     def put(self, key, value):
-        log.trace('putting entry', key=encode_hex(key)[:8], len=len(value))
         self.uncommitted[key] = value
 
-    def commit(self):
+    def commit(self, sync=False):
+        batch = self.freeze_uncommitted()
+        try:
+            self.write_batch(batch, sync)
+        except Exception:
+            self.finish_commit(success=False)
+            raise
+        self.finish_commit()
+
+    def freeze_uncommitted(self):
+        """Move the dirty keys to :attr:`committing` and return them as a write batch.
+
+        Only one batch can be in flight, it is finished by :meth:`finish_commit`.
+        """
+        assert not self.committing, 'commit already in progress'
         log.debug('committing', db=self)
+        self.committing = self._take_uncommitted()  # never modified, snapshots may share it
+        self.commit_counter += 1
         batch = leveldb.WriteBatch()
-        for k, v in list(self.uncommitted.items()):
+        for k, v in list(self.committing.items()):
+            if PY3 and isinstance(k, str):
+                k = k.encode()
+            self.cache.invalidate(k)
             if v is None:
                 batch.Delete(k)
             else:
-                compress_v = compress(v)
-                if PY3:
-                    if isinstance(k, str):
-                        k = k.encode()
-                    if isinstance(compress_v, str):
-                        compress_v = compress_v.encode()
-                batch.Put(k, compress_v)
-        self.db.Write(batch, sync=False)
-        self.uncommitted.clear()
-        log.debug('committed', db=self, num=len(self.uncommitted))
-        # self.commit_counter += 1
-        # if self.commit_counter % 100 == 0:
-        #     self.reopen()
+                if PY3 and isinstance(v, str):
+                    v = v.encode()
+                batch.Put(k, self.codec.encode(k, v))
+        return batch
+
+    def write_batch(self, batch, sync=False):
+        # touches the db only, so it is safe to run outside of the hub's thread
+        self.db.Write(batch, sync=sync)
+
+    def finish_commit(self, success=True):
+        if not success:
+            # keep the changes for the next attempt unless they have been overwritten since
+            self._restore_uncommitted(self.committing)
+        num = len(self.committing)
+        self.committing = dict()
+        log.debug('committed', db=self, num=num, success=success, cache=self.cache.stats)
 
     def delete(self, key):
         log.trace('deleting entry', key=key)
         self.uncommitted[key] = None
 
+    def iterkeys(self):
+        """Iterate over the committed keys in the database."""
+        for key in self.db.RangeIter(include_value=False):
+            yield bytes(key)
+
+    def compact_range(self, start=None, end=None):
+        """Compact the committed keys from `start` to `end`, `None` meaning unbounded."""
+        self.db.CompactRange(start=start, end=end)
+
+    def stats(self):
+        """Return LevelDB's description of its levels and compactions."""
+        return self.db.GetStats()
+
     def _has_key(self, key):
         try:
             self.get(key)
@@ -147,7 +291,8 @@ class LevelDB(BaseDB):
         return isinstance(other, self.__class__) and self.db == other.db
 
     def __repr__(self):
-        return '<DB at %d uncommitted=%d>' % (id(self.db), len(self.uncommitted))
+        return '<DB at %d uncommitted=%d cached=%d>' % (id(self.db), self.num_uncommitted(),
+                                                        len(self.cache))
 
     def inc_refcount(self, key, value):
         self.put(key, value)
@@ -182,7 +327,13 @@ class LevelDBService(LevelDB, BaseService):
         self.uncommitted = dict()
         self.stop_event = Event()
         dbfile = os.path.join(self.app.config['data_dir'], 'leveldb')
-        LevelDB.__init__(self, dbfile)
+        dbconfig = self.app.config.get('db', {})
+        zstd_dictionary = None
+        if dbconfig.get('zstd_dictionary'):
+            with open(dbconfig['zstd_dictionary'], 'rb') as f:
+                zstd_dictionary = f.read()
+        LevelDB.__init__(self, dbfile, cache_size=dbconfig.get('cache_size'),
+                         codecs=dbconfig.get('codecs'), zstd_dictionary=zstd_dictionary)
         self.h = random.randrange(10**50)
 
     def _run(self):
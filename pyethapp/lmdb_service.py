@@ -5,23 +5,93 @@ import lmdb
 from devp2p.service import BaseService
 from ethereum.db import BaseDB
 from ethereum.slogging import get_logger
+from ethereum.utils import to_string
 from gevent.event import Event
+from .db_snapshot import NULL, OverlayChain, Snapshot
+from .lru_cache import LRUCache
 
 log = get_logger('db')
 
-# unique objects to represent state in the transient store, the delete
-# operation will store the DELETE constant in the transient store, and NULL is
-# used to avoid conflicts with None, effectivelly allowing the user to store it
-NULL = object()
+# unique object to represent state in the transient store, the delete operation
+# will store the DELETE constant in the transient store, and NULL is used to
+# avoid conflicts with None, effectivelly allowing the user to store it
 DELETE = object()
 TB = (2 ** 10) ** 4
+MAX_DBS = 32  # named databases for column families
 
 
-class LmDBService(BaseDB, BaseService):
-    """A service providing an interface to a lmdb."""
+class LmDBColumnFamily(object):
+
+    """A named database in the environment of a :class:`LmDBService`.
+
+    Changes are buffered like the ones of the main database and written in the same transaction
+    by :meth:`LmDBService.commit`. The names of named databases are keys of the main database.
+    """
+
+    def __init__(self, service, name):
+        self.service = service
+        self.name = to_string(name)
+        self.handle = service.env.open_db(self.name)
+        self.uncommitted = dict()
+        self.committing = dict()
+
+    def _from_overlay(self, key):
+        value = self.uncommitted.get(key, NULL)
+        if value is NULL:
+            value = self.committing.get(key, NULL)
+        return value
+
+    def get(self, key):
+        value = self._from_overlay(key)
+        if value is DELETE:
+            raise KeyError('key not in db')
+        if value is NULL:
+            with self.service.env.begin(db=self.handle, write=False) as transaction:
+                value = transaction.get(key, NULL)
+            if value is NULL:
+                raise KeyError('key not in db')
+        return value
+
+    def get_many(self, keys):
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            value = self._from_overlay(key)
+            if value is NULL:
+                missing.append((key, i))
+            elif value is not DELETE:
+                values[i] = value
+        if missing:
+            with self.service.env.begin(db=self.handle, write=False) as transaction:
+                for key, i in sorted(missing):
+                    values[i] = transaction.get(key)
+        return values
+
+    def put(self, key, value):
+        self.uncommitted[key] = value
+
+    def delete(self, key):
+        self.uncommitted[key] = DELETE
+
+    def __repr__(self):
+        return '<LmDBColumnFamily %s uncommitted=%d>' % (self.name, len(self.uncommitted))
+
+
+class LmDBService(OverlayChain, BaseDB, BaseService):
+    """A service providing an interface to a lmdb.
+
+    Reads are served from a size bounded LRU cache (``db.cache_size`` bytes) in front of the
+    environment, ``uncommitted`` only holds the dirty keys which are written on the next
+    :meth:`commit`. Keys are written in sorted order, with MDB_APPEND if all of them are larger
+    than the last key in the database (e.g. ascending block numbers in a new database).
+
+    Durability can be traded for speed with ``db.lmdb_sync`` and ``db.lmdb_metasync`` (see the
+    lmdb documentation), ``db.lmdb_writemap`` writes through a writable memory map.
+    """
 
     name = 'db'
     default_config = dict()  # the defaults are defined in pyethapp.db_service
+    cache_size = 32 * 1024**2
 
     def __init__(self, app):
         assert app.config['data_dir']
@@ -29,10 +99,26 @@ class LmDBService(BaseDB, BaseService):
         BaseService.__init__(self, app)
 
         db_directory = os.path.join(app.config['data_dir'], 'lmdb')
-
-        self.env = lmdb.Environment(db_directory, map_size=TB)
+        dbconfig = app.config.get('db', {})
+        self.env_options = dict(
+            max_dbs=MAX_DBS,
+            writemap=dbconfig.get('lmdb_writemap', False),
+            metasync=dbconfig.get('lmdb_metasync', True),
+            sync=dbconfig.get('lmdb_sync', True),
+        )
+        log.info('opening LMDB', path=db_directory, **self.env_options)
+        self.env = lmdb.Environment(db_directory, map_size=dbconfig.get('lmdb_map_size', TB),
+                                    **self.env_options)
         self.db_directory = db_directory
+        self.column_families = dict()
         self.uncommitted = dict()
+        self.frozen = []  # changes shared with snapshots, newest first
+        self.committing = dict()  # frozen batch being written, still visible to readers
+        cache_size = dbconfig.get('cache_size')
+        self.cache = LRUCache(self.cache_size if cache_size is None else cache_size)
+        self.commit_counter = 0
+        self.overlay_hits = 0  # reads served from pending changes
+        self.active_transactions = 0  # open outside of the hub's greenlets, see resize
         self.stop_event = Event()
 
     def _run(self):
@@ -47,6 +133,26 @@ class LmDBService(BaseDB, BaseService):
     def delete(self, key):
         self.uncommitted[key] = DELETE
 
+    def snapshot(self):
+        """Return a :class:`Snapshot` of the current state including uncommitted changes.
+
+        The snapshot holds a read transaction open until it is closed.
+        """
+        transaction = self.env.begin(write=False)
+
+        def reader(key):
+            value = transaction.get(key, NULL)
+            if value is NULL:
+                raise KeyError('key not in db')
+            return value
+
+        def close():
+            transaction.abort()
+            self.active_transactions -= 1
+
+        self.active_transactions += 1
+        return Snapshot(reader, self._snapshot_overlays(), deleted=DELETE, close=close)
+
     def inc_refcount(self, key, value):
         self.put(key, value)
 
@@ -61,44 +167,197 @@ class LmDBService(BaseDB, BaseService):
         self.env.close()
         del self.env
         # the map_size is stored in the database itself after it's first created
-        self.env = lmdb.Environment(self.db_directory)
+        self.env = lmdb.Environment(self.db_directory, **self.env_options)
+        for cf in self.column_families.values():
+            cf.handle = self.env.open_db(cf.name)
+
+    def column_family(self, name):
+        """Return the :class:`LmDBColumnFamily` called `name`, creating it if necessary."""
+        if name not in self.column_families:
+            self.column_families[name] = LmDBColumnFamily(self, name)
+        return self.column_families[name]
 
     def get(self, key):
-        value = self.uncommitted.get(key, NULL)
+        value = self._from_overlay(key)
 
         if value is DELETE:
+            self.overlay_hits += 1
             raise KeyError('key not in db')
 
         if value is NULL:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+
             with self.env.begin(write=False) as transaction:
                 value = transaction.get(key, NULL)
 
             if value is NULL:
                 raise KeyError('key not in db')
 
-            self.uncommitted[key] = value
+            self.cache.put(key, value)
+        else:
+            self.overlay_hits += 1
 
         return value
 
-    def commit(self):
-        keys_to_delete = (
-            key
-            for key, value in list(self.uncommitted.items())
-            if value is DELETE
-        )
+    def get_many(self, keys, executor=None):
+        """Return the values for `keys` in the same order, `None` for unknown keys.
 
-        items_to_insert = (
-            (key, value)
-            for key, value in list(self.uncommitted.items())
-            if value not in (DELETE, NULL)  # NULL shouldn't happen
-        )
+        All keys neither pending nor cached are read in sorted order in a single read
+        transaction.
 
+        :param executor: optional callable ``executor(func, arg)`` used to run the reads
+        """
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            value = self._from_overlay(key)
+            if value is NULL:
+                value = self.cache.get(key)
+                if value is None:
+                    missing.append((key, i))
+                else:
+                    values[i] = value
+            elif value is not DELETE:
+                values[i] = value
+        if missing:
+            missing.sort()
+            commit_counter = self.commit_counter
+            if executor is None:
+                found = self._read_transaction(missing)
+            else:
+                found = executor(self._read_transaction, missing)
+            # values read before a concurrent commit finished might be outdated by now
+            cacheable = commit_counter == self.commit_counter
+            for key, i, value in found:
+                if cacheable:
+                    self.cache.put(key, value)
+                values[i] = value
+        return values
+
+    def _read_transaction(self, keys):
+        found = []
+        self.active_transactions += 1
+        try:
+            with self.env.begin(write=False) as transaction:
+                for key, i in keys:
+                    value = transaction.get(key, NULL)
+                    if value is not NULL:
+                        found.append((key, i, value))
+        finally:
+            self.active_transactions -= 1
+        return found
+
+    def commit(self, sync=False):
+        batch = self.freeze_uncommitted()
+        try:
+            self.write_batch(batch, sync)
+        except Exception:
+            self.finish_commit(success=False)
+            raise
+        self.finish_commit()
+
+    def freeze_uncommitted(self):
+        """Move the dirty keys to :attr:`committing` and return them as a batch for
+        :meth:`write_batch`.
+
+        Only one batch can be in flight, it is finished by :meth:`finish_commit`.
+        """
+        assert not self.committing, 'commit already in progress'
+        self.committing = self._take_uncommitted()  # never modified, snapshots may share it
+        self.commit_counter += 1
+        deletes = []
+        puts = []
+        for key, value in self.committing.items():
+            self.cache.invalidate(key)
+            if value is DELETE:
+                deletes.append(key)
+            else:
+                puts.append((key, value))
+        puts.sort()
+        column_families = []
+        for cf in self.column_families.values():
+            cf.committing, cf.uncommitted = cf.uncommitted, dict()
+            if cf.committing:
+                column_families.append((cf.handle, sorted(cf.committing.items())))
+        return deletes, puts, column_families
+
+    def write_batch(self, batch, sync=False):
+        # touches the environment only, so it is safe to run outside of the hub's thread
+        self.active_transactions += 1
+        try:
+            self._write_batch(batch, sync)
+        finally:
+            self.active_transactions -= 1
+
+    def _write_batch(self, batch, sync):
+        deletes, puts, column_families = batch
         with self.env.begin(write=True) as transaction:
-            for key in keys_to_delete:
+            for key in deletes:
                 transaction.delete(key)
+            self._put_sorted(transaction.cursor(), puts)
+            for handle, items in column_families:
+                for key, value in items:
+                    if value is DELETE:
+                        transaction.delete(key, db=handle)
+                self._put_sorted(transaction.cursor(db=handle),
+                                 [(key, value) for key, value in items if value is not DELETE])
+        if sync:
+            self.env.sync(True)  # also with lmdb_sync or lmdb_metasync disabled
+
+    def _put_sorted(self, cursor, items):
+        if not items:
+            return
+        # appending skips the search for the insert position, it fails for smaller keys
+        append = not cursor.last() or cursor.key() < items[0][0]
+        cursor.putmulti(items, overwrite=True, append=append)
+
+    def finish_commit(self, success=True):
+        if not success:
+            # keep the changes for the next attempt unless they have been overwritten since
+            self._restore_uncommitted(self.committing)
+            for cf in self.column_families.values():
+                for key, value in cf.committing.items():
+                    cf.uncommitted.setdefault(key, value)
+        num = len(self.committing)
+        self.committing = dict()
+        for cf in self.column_families.values():
+            cf.committing = dict()
+        log.debug('committed', db=self, num=num, success=success, cache=self.cache.stats)
+
+    def map_usage(self):
+        """Return the size of the map, the bytes in use and the bytes on the freelist.
+
+        The freelist is estimated as the pages in use but not referenced by any database.
+        """
+        info = self.env.info()
+        page_size = self.env.stat()['psize']
+        pages = 0
+        stats = [self.env.stat()]
+        with self.env.begin(write=False) as transaction:
+            stats.extend(transaction.stat(cf.handle) for cf in self.column_families.values())
+        for stat in stats:
+            pages += stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages']
+        used = info['last_pgno'] + 1
+        return dict(map_size=info['map_size'], used=used * page_size,
+                    freelist=max(0, used - pages - 2) * page_size)  # 2 meta pages
+
+    def resize(self, map_size):
+        """Set the size of the map, which must not be smaller than the data.
+
+        Returns `False` without resizing while transactions are open, e.g. of snapshots.
+        """
+        if self.active_transactions:
+            return False
+        self.env.set_mapsize(map_size)
+        return True
 
-            cursor = transaction.cursor()
-            cursor.putmulti(items_to_insert, overwrite=True)
+    def iterkeys(self):
+        """Iterate over the committed keys in the database."""
+        with self.env.begin(write=False) as transaction:
+            for key in transaction.cursor().iternext(values=False):
+                yield key
 
     def revert_refcount_changes(self, epoch):
         pass
@@ -117,7 +376,8 @@ class LmDBService(BaseDB, BaseService):
         return True
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.db == other.db
+        return isinstance(other, self.__class__) and self.env == other.env
 
     def __repr__(self):
-        return '<DB at %d uncommitted=%d>' % (id(self.env), len(self.uncommitted))
+        return '<DB at %d uncommitted=%d cached=%d>' % (id(self.env), self.num_uncommitted(),
+                                                        len(self.cache))
@@ -0,0 +1,91 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from builtins import object
+from collections import OrderedDict
+
+# rough per entry bookkeeping overhead of the OrderedDict in bytes
+ENTRY_OVERHEAD = 96
+
+
+def _sizeof(value):
+    try:
+        return len(value)
+    except TypeError:  # e.g. float scores stored by the chain
+        return 8
+
+
+class LRUCache(object):
+
+    """A least recently used cache bounded by the total size of its entries.
+
+    Sizes are estimated as ``len(key) + len(value)`` plus a constant per entry overhead, which is
+    accurate enough for the byte strings stored in the database.
+
+    :ivar max_size: the maximum size of all entries in bytes, `0` disables the cache
+    :ivar size: the current size of all entries in bytes
+    :ivar hits: number of successful lookups
+    :ivar misses: number of failed lookups
+    :ivar evictions: number of entries dropped to make room for new ones
+    """
+
+    def __init__(self, max_size):
+        assert max_size >= 0
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def _entry_size(self, key, value):
+        return _sizeof(key) + _sizeof(value) + ENTRY_OVERHEAD
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value  # move to the most recently used end
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        entry_size = self._entry_size(key, value)
+        if entry_size > self.max_size:
+            return  # would evict everything else, don't bother
+        self.invalidate(key)
+        self._data[key] = value
+        self.size += entry_size
+        while self.size > self.max_size:
+            old_key, old_value = self._data.popitem(last=False)
+            self.size -= self._entry_size(old_key, old_value)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return
+        self.size -= self._entry_size(key, value)
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(entries=len(self._data), size=self.size, max_size=self.max_size,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    hit_ratio=self.hits / lookups if lookups else 0.)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<LRUCache entries=%d size=%d/%d>' % (len(self._data), self.size, self.max_size)
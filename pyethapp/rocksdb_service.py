@@ -0,0 +1,290 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+import os
+import random
+import rocksdb
+from rocksdb.interfaces import SliceTransform
+from devp2p.service import BaseService
+from ethereum.db import BaseDB
+from ethereum.slogging import get_logger
+from gevent.event import Event
+from .bloom_filter import key_namespace
+from .db_snapshot import NULL, OverlayChain, Snapshot
+from .lru_cache import LRUCache
+
+log = get_logger('db')
+
+COMPRESSION_TYPES = dict(
+    none=rocksdb.CompressionType.no_compression,
+    snappy=rocksdb.CompressionType.snappy_compression,
+    zlib=rocksdb.CompressionType.zlib_compression,
+    lz4=rocksdb.CompressionType.lz4_compression,
+    zstd=rocksdb.CompressionType.zstd_compression,
+)
+
+_block_caches = dict()
+
+
+def shared_block_cache(size):
+    """Return the block cache of `size` bytes shared by all RocksDB instances of the process."""
+    if size not in _block_caches:
+        _block_caches[size] = rocksdb.LRUCache(size)
+    return _block_caches[size]
+
+
+class KeyPrefix(SliceTransform):
+
+    """Prefix extractor mapping keys to their namespace (see
+    :func:`pyethapp.bloom_filter.key_namespace`), or to their first `hash_prefix` bytes for 32
+    byte hash keys (trie nodes, blocks, code).
+
+    RocksDB builds prefix Bloom filters from it, which lets lookups skip files without keys of
+    the namespace. The name includes `hash_prefix`, the extractor must not change for an
+    existing database.
+    """
+
+    def __init__(self, hash_prefix=4):
+        self.hash_prefix = hash_prefix
+
+    def name(self):
+        return b'pyethapp.KeyPrefix.%d' % self.hash_prefix
+
+    def transform(self, src):
+        if len(src) == 32:
+            return 0, self.hash_prefix
+        return 0, len(key_namespace(src))
+
+    def in_domain(self, src):
+        return True
+
+    def in_range(self, dst):
+        return True
+
+
+class RocksDB(OverlayChain, BaseDB):
+
+    """A RocksDB database in the directory `dbfile`.
+
+    Like :class:`pyethapp.leveldb_service.LevelDB` reads are served from a size bounded LRU cache
+    (``cache_size`` bytes) in front of the db, ``uncommitted`` only holds the dirty keys which
+    are written on the next :meth:`commit` and snapshots freeze them without copying. Below
+    that RocksDB keeps uncompressed blocks in a block cache shared by the process and filters
+    lookups with per table whole key and :class:`KeyPrefix` Bloom filters.
+
+    :param options: dict of ``rocksdb_*`` settings, see :class:`pyethapp.db_service.DBService`
+    """
+
+    max_open_files = 32000
+    cache_size = 32 * 1024**2
+
+    def __init__(self, dbfile, cache_size=None, options=None):
+        options = options or dict()
+        self.uncommitted = dict()
+        self.frozen = []  # changes shared with snapshots, newest first
+        self.committing = dict()  # frozen batch being written, still visible to readers
+        if cache_size is None:
+            cache_size = self.cache_size
+        self.options = rocksdb.Options(
+            create_if_missing=True,
+            max_open_files=self.max_open_files,
+            write_buffer_size=options.get('rocksdb_write_buffer_size', 64 * 1024**2),
+            max_background_compactions=options.get('rocksdb_compaction_threads', 2),
+            compression=COMPRESSION_TYPES[options.get('rocksdb_compression', 'snappy')],
+            prefix_extractor=KeyPrefix(options.get('rocksdb_hash_prefix', 4)),
+            table_factory=rocksdb.BlockBasedTableFactory(
+                filter_policy=rocksdb.BloomFilterPolicy(options.get('rocksdb_bloom_bits', 10)),
+                block_cache=shared_block_cache(
+                    options.get('rocksdb_block_cache_size', 256 * 1024**2))),
+        )
+        log.info('opening RocksDB', path=dbfile, cache_size=cache_size, **options)
+        self.cache = LRUCache(cache_size)
+        self.dbfile = dbfile
+        self.db = rocksdb.DB(dbfile, self.options)
+        self.commit_counter = 0
+        self.overlay_hits = 0  # reads served from pending changes
+
+    def reopen(self):
+        del self.db
+        self.db = rocksdb.DB(self.dbfile, self.options)
+
+    def get(self, key):
+        o = self._from_overlay(key)
+        if o is not NULL:
+            self.overlay_hits += 1
+            if o is None:
+                raise KeyError('key not in db')
+            return o
+        o = self.cache.get(key)
+        if o is not None:
+            return o
+        o = self.db.get(key)
+        if o is None:
+            raise KeyError('key not in db')
+        self.cache.put(key, o)
+        return o
+
+    def get_many(self, keys, executor=None):
+        """Return the values for `keys` in the same order, `None` for unknown keys.
+
+        Keys missing from the overlay and the cache are read with a single ``MultiGet``.
+
+        :param executor: optional callable ``executor(func, arg)`` used to run the disk reads
+        """
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            o = self._from_overlay(key)
+            if o is NULL:
+                o = self.cache.get(key)
+                if o is None:
+                    missing.append(key)
+            values[i] = o
+        if missing:
+            commit_counter = self.commit_counter
+            if executor is None:
+                found = self.db.multi_get(missing)
+            else:
+                found = executor(self.db.multi_get, missing)
+            # values read before a concurrent commit finished might be outdated by now
+            cacheable = commit_counter == self.commit_counter
+            for i, key in enumerate(keys):
+                if values[i] is None and found.get(key) is not None:
+                    values[i] = found[key]
+                    if cacheable:
+                        self.cache.put(key, values[i])
+        return values
+
+    def snapshot(self):
+        """Return a :class:`Snapshot` of the current state including uncommitted changes."""
+        db_snapshot = self.db.snapshot()
+
+        def reader(key):
+            o = self.db.get(key, snapshot=db_snapshot)
+            if o is None:
+                raise KeyError('key not in db')
+            return o
+
+        return Snapshot(reader, self._snapshot_overlays())
+
+    def put(self, key, value):
+        self.uncommitted[key] = value
+
+    def delete(self, key):
+        self.uncommitted[key] = None
+
+    def commit(self, sync=False):
+        batch = self.freeze_uncommitted()
+        try:
+            self.write_batch(batch, sync)
+        except Exception:
+            self.finish_commit(success=False)
+            raise
+        self.finish_commit()
+
+    def freeze_uncommitted(self):
+        """Move the dirty keys to :attr:`committing` and return them as a write batch.
+
+        Only one batch can be in flight, it is finished by :meth:`finish_commit`.
+        """
+        assert not self.committing, 'commit already in progress'
+        self.committing = self._take_uncommitted()  # never modified, snapshots may share it
+        self.commit_counter += 1
+        batch = rocksdb.WriteBatch()
+        for k, v in self.committing.items():
+            self.cache.invalidate(k)
+            if v is None:
+                batch.delete(k)
+            else:
+                batch.put(k, v)
+        return batch
+
+    def write_batch(self, batch, sync=False):
+        # touches the db only, so it is safe to run outside of the hub's thread
+        self.db.write(batch, sync=sync)
+
+    def finish_commit(self, success=True):
+        if not success:
+            # keep the changes for the next attempt unless they have been overwritten since
+            self._restore_uncommitted(self.committing)
+        num = len(self.committing)
+        self.committing = dict()
+        log.debug('committed', db=self, num=num, success=success, cache=self.cache.stats)
+
+    def iterkeys(self):
+        """Iterate over the committed keys in the database."""
+        it = self.db.iterkeys()
+        it.seek_to_first()
+        for key in it:
+            yield key
+
+    def compact_range(self, start=None, end=None):
+        """Compact the committed keys from `start` to `end`, `None` meaning unbounded."""
+        self.db.compact_range(begin=start, end=end)
+
+    def stats(self):
+        """Return RocksDB's description of its levels and compactions."""
+        return self.db.get_property(b'rocksdb.stats')
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.db == other.db
+
+    def __repr__(self):
+        return '<RocksDB at %d uncommitted=%d cached=%d>' % (id(self.db), self.num_uncommitted(),
+                                                             len(self.cache))
+
+    def inc_refcount(self, key, value):
+        self.put(key, value)
+
+    def dec_refcount(self, key):
+        pass
+
+    def revert_refcount_changes(self, epoch):
+        pass
+
+    def commit_refcount_changes(self, epoch):
+        pass
+
+    def cleanup(self, epoch):
+        pass
+
+    def put_temporarily(self, key, value):
+        self.inc_refcount(key, value)
+        self.dec_refcount(key)
+
+
+class RocksDBService(RocksDB, BaseService):
+
+    """A service providing an interface to a RocksDB database."""
+
+    name = 'db'
+    default_config = dict()  # the defaults are defined in pyethapp.db_service
+
+    def __init__(self, app):
+        BaseService.__init__(self, app)
+        assert self.app.config['data_dir']
+        self.stop_event = Event()
+        dbfile = os.path.join(self.app.config['data_dir'], 'rocksdb')
+        dbconfig = self.app.config.get('db', {})
+        options = dict((k, v) for k, v in dbconfig.items() if k.startswith('rocksdb_'))
+        RocksDB.__init__(self, dbfile, cache_size=dbconfig.get('cache_size'), options=options)
+        self.h = random.randrange(10**50)
+
+    def _run(self):
+        self.stop_event.wait()
+
+    def stop(self):
+        self.stop_event.set()
+        log.debug('closing db')
+
+    def __hash__(self):
+        return self.h
@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from builtins import object
+from builtins import range
+import gevent
+import gevent.lock
+import gipc
+import rlp
+from ethereum.slogging import get_logger
+from ethereum.transactions import Transaction
+
+log = get_logger('eth.sender_recovery')
+
+
+def recovery_worker(pipe):
+    "entry point of the worker processes, answers lists of RLP encoded txs with their senders"
+    gevent.get_hub().SYSTEM_ERROR = BaseException  # stop on any exception
+    while True:
+        senders = []
+        for tx_rlp in pipe.get():
+            try:
+                senders.append(rlp.decode(tx_rlp, Transaction).sender)
+            except Exception:
+                senders.append(None)  # left to the validation in the parent
+        pipe.put(senders)
+
+
+class SenderRecovery(object):
+
+    """Recovers the senders of transactions in a pool of worker processes.
+
+    The signatures of a batch are split evenly across the workers, the recovered senders are
+    set on the transactions so later accesses to ``tx.sender`` are free. Waiting for the
+    workers only blocks the calling greenlet. Batches of less than `min_batch` transactions
+    are not worth the IPC and left to be recovered on access.
+
+    :param processes: number of worker processes
+    """
+
+    min_batch = 16
+
+    def __init__(self, processes):
+        self.workers = []
+        for _ in range(processes):
+            parent_end, child_end = gipc.pipe(duplex=True)
+            process = gipc.start_process(target=recovery_worker, args=(child_end,))
+            self.workers.append((parent_end, process, gevent.lock.Semaphore()))
+        self.recovered = 0
+        self.batches = 0
+
+    def recover(self, txs):
+        """Recover and set the senders of those of `txs` without one.
+
+        Invalid signatures are skipped, they raise when the sender is accessed.
+        """
+        txs = [tx for tx in txs if tx._sender is None]
+        if len(txs) < self.min_batch or not self.workers:
+            return
+        size = -(-len(txs) // len(self.workers))  # ceil
+        chunks = [txs[i:i + size] for i in range(0, len(txs), size)]
+        jobs = [gevent.spawn(self._recover_chunk, worker, chunk)
+                for worker, chunk in zip(self.workers, chunks)]
+        gevent.joinall(jobs)
+        self.batches += 1
+
+    def _recover_chunk(self, worker, txs):
+        pipe, process, lock = worker
+        with lock:
+            try:
+                pipe.put([rlp.encode(tx) for tx in txs])
+                senders = pipe.get()
+            except (EOFError, IOError) as e:
+                log.error('sender recovery worker failed', pid=process.pid, error=e)
+                if worker in self.workers:
+                    self.workers.remove(worker)
+                return
+        for tx, sender in zip(txs, senders):
+            if sender is not None:
+                tx.sender = sender
+                self.recovered += 1
+
+    def stop(self):
+        for pipe, process, lock in self.workers:
+            process.terminate()
+            process.join()
+            pipe.close()
+        self.workers = []
@@ -0,0 +1,687 @@
+import json
+import os
+import threading
+import gevent
+import pytest
+import rlp
+from devp2p.app import BaseApp
+from ethereum.utils import sha3
+from pyethapp.bloom_filter import KeyFilter
+from pyethapp.compression import key_class
+from pyethapp.lru_cache import LRUCache
+from pyethapp import db_bench, leveldb_service
+from pyethapp.db_service import DBService
+from pyethapp.freezer import Freezer
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_size=3 * (2 + 100 + 96))
+    for i in range(3):
+        cache.put(b'k%d' % i, b'\x00' * 100)
+    assert len(cache) == 3
+    assert cache.get(b'k0') is not None  # k0 is now the most recently used
+    cache.put(b'k3', b'\x00' * 100)
+    assert b'k1' not in cache
+    assert b'k0' in cache
+    assert cache.evictions == 1
+    assert cache.get(b'k1') is None
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+    assert cache.size <= cache.max_size
+
+
+def test_lru_cache_oversized_and_invalidate():
+    cache = LRUCache(max_size=200)
+    cache.put(b'big', b'\x00' * 1000)
+    assert b'big' not in cache
+    cache.put(b'small', b'\x00')
+    cache.invalidate(b'small')
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+@pytest.fixture
+def leveldb(tmpdir):
+    return leveldb_service.LevelDB(os.path.join(str(tmpdir), 'leveldb'), cache_size=1024**2)
+
+
+def test_leveldb_reads_are_not_written_back(leveldb):
+    leveldb.put(b'a', b'1')
+    leveldb.commit()
+    assert len(leveldb.uncommitted) == 0
+    assert leveldb.get(b'a') == b'1'
+    assert b'a' in leveldb
+    assert len(leveldb.uncommitted) == 0  # the read is cached, not buffered
+    assert b'a' in leveldb.cache
+    leveldb.put(b'a', b'2')
+    assert leveldb.get(b'a') == b'2'
+    leveldb.commit()
+    assert leveldb.get(b'a') == b'2'
+    leveldb.delete(b'a')
+    assert b'a' not in leveldb
+    leveldb.commit()
+    with pytest.raises(KeyError):
+        leveldb.get(b'a')
+
+
+def test_leveldb_get_many(leveldb):
+    leveldb.put(b'a', b'1')
+    leveldb.put(b'b', b'2')
+    leveldb.commit()
+    leveldb.put(b'c', b'3')
+    leveldb.delete(b'b')
+    assert leveldb.get_many([b'c', b'b', b'a', b'x']) == [b'3', None, b'1', None]
+
+
+@pytest.fixture
+def offload_db(tmpdir):
+    db = dict(implementation='LevelDB', offload=True, offload_min_keys=2, bloom_filter=False)
+    return DBService(BaseApp(config=dict(data_dir=str(tmpdir), db=db)))
+
+
+def block_in_thread(func, started, release):
+    "wraps `func` to set `started` and wait for `release` in the offload thread after running"
+    def blocking(*args):
+        try:
+            return func(*args)
+        finally:
+            started.set()
+            release.wait()
+    return blocking
+
+
+def stored(leveldb, keys):
+    "reads `keys` from disk, bypassing the overlay and the cache"
+    return [leveldb.codec.decode(leveldb.db.Get(key)) for key in keys]
+
+
+def wait_for(event):
+    while not event.is_set():
+        gevent.sleep(0.001)
+
+
+def test_offloaded_commit_ordering(offload_db, monkeypatch):
+    db, leveldb = offload_db, offload_db.db_service
+    written = []
+
+    def write_batch(batch, sync=False):
+        written.append(sorted(leveldb.committing))
+        return leveldb.__class__.write_batch(leveldb, batch, sync)
+
+    started, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(leveldb, 'write_batch', block_in_thread(write_batch, started, release))
+    db.put(b'a', b'1')
+    db.put(b'b', b'1')
+    first = gevent.spawn(db.commit)
+    wait_for(started)
+    # reads during the write see the frozen batch
+    assert leveldb.committing == {b'a': b'1', b'b': b'1'}
+    assert db.get(b'a') == b'1'
+    assert db.get_many([b'a', b'b']) == [b'1', b'1']
+    # writes during the write go to a fresh overlay
+    db.put(b'a', b'2')
+    db.put(b'c', b'2')
+    assert leveldb.uncommitted == {b'a': b'2', b'c': b'2'}
+    assert db.get(b'a') == b'2'
+    # a second commit waits for the first one
+    second = gevent.spawn(db.commit)
+    gevent.sleep(0.01)
+    assert not second.ready()
+    assert b'c' in leveldb.uncommitted
+    release.set()
+    gevent.joinall([first, second], raise_error=True)
+    assert written == [[b'a', b'b'], [b'a', b'c']]
+    assert leveldb.committing == {} and leveldb.uncommitted == {}
+    assert db.offload_stats['commits'] == 2
+    assert stored(leveldb, [b'a', b'b', b'c']) == [b'2', b'1', b'2']
+
+
+def test_offloaded_commit_failure(offload_db, monkeypatch):
+    db, leveldb = offload_db, offload_db.db_service
+
+    def write_batch(batch, sync=False):
+        raise IOError('disk full')
+
+    started, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(leveldb, 'write_batch', block_in_thread(write_batch, started, release))
+    db.put(b'a', b'1')
+    db.put(b'b', b'1')
+    failing = gevent.spawn(db.commit)
+    wait_for(started)
+    db.put(b'b', b'2')
+    release.set()
+    failing.join()
+    assert isinstance(failing.exception, IOError)
+    # the frozen keys are back, unless they were overwritten while in flight
+    assert leveldb.committing == {}
+    assert leveldb.uncommitted == {b'a': b'1', b'b': b'2'}
+    monkeypatch.undo()
+    db.commit()
+    assert stored(leveldb, [b'a', b'b']) == [b'1', b'2']
+
+
+def test_offloaded_get_many_during_commit(offload_db, monkeypatch):
+    db, leveldb = offload_db, offload_db.db_service
+    db.put(b'a', b'1')
+    db.put(b'b', b'1')
+    db.commit()
+    started, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(leveldb, '_read_snapshot',
+                        block_in_thread(leveldb._read_snapshot, started, release))
+    reader = gevent.spawn(db.get_many, [b'a', b'b'])
+    wait_for(started)
+    db.put(b'a', b'2')
+    db.put(b'b', b'2')
+    db.commit()
+    release.set()
+    # consistent with the db before the commit, but not cached
+    assert reader.get() == [b'1', b'1']
+    assert db.offload_stats['reads'] == 1
+    assert b'a' not in leveldb.cache and b'b' not in leveldb.cache
+    assert db.get_many([b'a', b'b']) == [b'2', b'2']
+
+
+def test_refcount_pruning():
+    db = DBService(BaseApp(config=dict(db=dict(implementation='EphemDB'))))
+    db.ttl = 0  # only the latest state is kept
+    prefix = b'\x00\x00\x00\x01'  # put counter of RefcountDB
+    leaf = prefix + rlp.encode([b'\x20\x01', b'value'])
+    root1 = prefix + rlp.encode([sha3(leaf)] + [b''] * 16)
+    root2 = prefix + rlp.encode([b''] * 16 + [b'value'])
+    side = prefix + rlp.encode([b''] * 16 + [b'side'])
+    db.put(sha3(leaf), leaf)
+    db.inc_refcount(sha3(root1), root1)
+    db.commit_refcount_changes(1)
+    db.cleanup(1)
+    assert sha3(root1) in db
+    assert sha3(leaf) in db
+
+    db.inc_refcount(sha3(root2), root2)
+    db.commit_refcount_changes(2)
+    db.cleanup(2)  # releases the root pinned in epoch 1
+    assert sha3(root1) in db  # pruned in the background
+    db.pruner.join()
+    assert sha3(root1) not in db
+    assert sha3(leaf) not in db
+    assert sha3(root2) in db
+
+    # a side chain block of a released epoch is pinned until the next release
+    db.inc_refcount(sha3(side), side)
+    db.commit_refcount_changes(1)
+    assert sha3(side) in db
+    db.cleanup(3)
+    db.pruner.join()
+    assert sha3(root2) not in db
+    assert sha3(side) not in db
+
+    root3 = prefix + rlp.encode([sha3(leaf)] + [b''] * 16)
+    db.put(sha3(leaf), leaf)
+    db.inc_refcount(sha3(root3), root3)
+    db.revert_refcount_changes(4)
+    assert db._refcount(sha3(root3)) == 0
+    assert db._refcount(sha3(leaf)) == 0
+
+
+def test_pruning_between_blocks(tmpdir):
+    dbconfig = dict(implementation='LevelDB', bloom_filter=False, prune_batch_size=1)
+    config = dict(data_dir=str(tmpdir), db=dbconfig)
+    db = DBService(BaseApp(config=config))
+    db.ttl = 0
+    prefix = b'\x00\x00\x00\x01'  # put counter of RefcountDB
+    leaf = prefix + rlp.encode([b'\x20\x01', b'value'])
+    root1 = prefix + rlp.encode([sha3(leaf)] + [b''] * 16)
+    root2 = prefix + rlp.encode([b''] * 16 + [b'value'])
+    db.put(sha3(leaf), leaf)
+    db.inc_refcount(sha3(root1), root1)
+    db.commit_refcount_changes(1)
+    db.cleanup(1)
+    db.begin_block()
+    db.inc_refcount(sha3(root2), root2)
+    db.commit_refcount_changes(2)
+    db.cleanup(2)
+    gevent.sleep(0.01)
+    assert sha3(root1) in db  # not while a block is imported
+    db.end_block()
+    # stopped after the first batch, the rest is stored
+    db.stop()
+    assert sha3(root1) not in db and sha3(leaf) in db
+    del db.db_service.db  # closes the db
+
+    db = DBService(BaseApp(config=config))
+    db.ttl = 0
+    assert db.death_row == [(sha3(leaf), True)]
+    db.start()
+    db.pruner.join()
+    assert sha3(leaf) not in db
+    assert db.death_row == [] and not db._stored_death_row()
+    db.stop()
+
+
+def test_key_filter(tmpdir):
+    key_filter = KeyFilter(min_capacity=1000)
+    keys = [sha3(b'%d' % i) for i in range(1000)] + [b'block:%d' % i for i in range(1000)]
+    for key in keys:
+        key_filter.add(key)
+    assert all(key_filter.might_contain(key) for key in keys)
+    absent = [sha3(b'%d' % -i) for i in range(1, 1001)] + [b'block:x%d' % i for i in range(1000)]
+    false_positives = sum(key_filter.might_contain(key) for key in absent)
+    assert false_positives < 50
+    assert not key_filter.might_contain(b'txindex:' + sha3(b''))  # unknown namespace
+    path = os.path.join(str(tmpdir), 'bloom_filter')
+    key_filter.save(path)
+    loaded = KeyFilter.load(path)
+    assert not os.path.exists(path)  # a crash before the next save forces a rebuild
+    assert all(loaded.might_contain(key) for key in keys)
+    assert loaded.stats['keys'] == 2000
+
+
+def test_db_service_key_filter(tmpdir):
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(implementation='LevelDB')))
+    db = DBService(app)
+    db.put(b'a:1', b'1')
+    db.commit()
+    db.put(b'a:2', b'2')  # put before the filter is built
+    db.rebuild_key_filter()
+    assert db.key_filter is not None
+    assert db.get(b'a:1') == b'1'
+    assert b'a:2' in db
+    assert b'b:1' not in db
+    assert db.get_many([b'a:1', b'b:1', b'a:2']) == [b'1', None, b'2']
+    assert db.key_filter.negatives == 2
+    db.put(b'b:1', b'3')
+    assert db.get(b'b:1') == b'3'
+
+
+def test_key_filter_epoch(tmpdir, monkeypatch):
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(implementation='LevelDB')))
+    db = DBService(app)
+    db.put(b'a:1', b'1')
+    db.commit()
+    db.rebuild_key_filter()
+    rebuilds = []
+    monkeypatch.setattr(db, 'rebuild_key_filter', lambda: rebuilds.append(True))
+
+    def start():
+        db.key_filter, db.key_filter_pending = None, []
+        db.load_key_filter()
+        gevent.sleep(0)
+
+    db.stop()
+    start()
+    assert db.key_filter is not None and not rebuilds
+    assert db.get(b'a:1') == b'1'
+    db.stop()
+    db.put(b'b:1', b'2')  # e.g. by a service stopped after the db
+    db.commit()
+    start()
+    assert db.key_filter is None and rebuilds
+    assert not os.path.exists(db.key_filter_path)
+
+
+def test_leveldb_snapshot(leveldb):
+    leveldb.put(b'a', b'1')
+    leveldb.put(b'b', b'2')
+    leveldb.commit()
+    leveldb.put(b'c', b'3')
+    with leveldb.snapshot() as snapshot:
+        leveldb.put(b'a', b'4')
+        leveldb.delete(b'c')
+        leveldb.commit()
+        leveldb.delete(b'b')
+        assert snapshot.get(b'a') == b'1'
+        assert snapshot.get(b'c') == b'3'
+        assert b'b' in snapshot
+        snapshot.put(b'd', b'5')
+        assert snapshot.get_many([b'a', b'd', b'x']) == [b'1', b'5', None]
+    assert leveldb.get(b'a') == b'4'
+    assert b'b' not in leveldb
+    assert b'c' not in leveldb
+    assert b'd' not in leveldb
+
+
+def test_leveldb_snapshot_overlays(leveldb, monkeypatch):
+    monkeypatch.setattr(leveldb, 'max_frozen', 2)
+    leveldb.put(b'a', b'1')
+    pending = leveldb.uncommitted
+    first = leveldb.snapshot()
+    leveldb.put(b'a', b'2')
+    # the pending changes are frozen and shared, not copied
+    assert first.overlays[0] is pending and pending == {b'a': b'1'}
+    assert leveldb.frozen == [pending] and leveldb.uncommitted == {b'a': b'2'}
+    assert leveldb.snapshot().overlays[0] is leveldb.frozen[0]
+    leveldb.snapshot()  # nothing new to freeze
+    leveldb.delete(b'a')
+    leveldb.put(b'b', b'3')
+    third = leveldb.snapshot()
+    assert len(leveldb.frozen) == 1  # merged
+    assert leveldb.frozen[0] == {b'a': None, b'b': b'3'}
+    assert leveldb.num_uncommitted() == 2
+    assert first.get(b'a') == b'1' and b'a' not in third
+    assert third.get(b'b') == b'3'
+    leveldb.put(b'c', b'4')
+    leveldb.commit()
+    assert leveldb.frozen == [] and leveldb.num_uncommitted() == 0
+    assert b'a' not in leveldb
+    assert leveldb.get_many([b'b', b'c']) == [b'3', b'4']
+    assert first.get(b'a') == b'1' and b'c' not in third
+
+
+def test_freezer(tmpdir):
+    path = os.path.join(str(tmpdir), 'freezer')
+    freezer = Freezer(path)
+    assert freezer.append(b'block0') == 0
+    assert freezer.append(b'') == 1
+    assert freezer.append(b'block2') == 2
+    assert [freezer.get(i) for i in range(3)] == [b'block0', b'', b'block2']
+    with pytest.raises(KeyError):
+        freezer.get(3)
+    freezer.sync()
+    freezer.close()
+    with open(os.path.join(path, 'blocks.idx'), 'ab') as f:
+        f.write(b'\x00' * 3)  # partially written index entry
+    freezer = Freezer(path)
+    assert len(freezer) == 3
+    assert freezer.get(2) == b'block2'
+    freezer.truncate(1)
+    assert freezer.append(b'block1') == 1
+    assert freezer.get(1) == b'block1'
+
+
+def test_db_service_freeze(tmpdir):
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(implementation='LevelDB')))
+    db = DBService(app)
+    blockhash = sha3(b'block')
+    db.put(blockhash, b'block rlp')
+    db.commit()
+    assert db.freeze(blockhash) == 0
+    db.commit()
+    with pytest.raises(KeyError):
+        db.db_service.get(blockhash)
+    assert blockhash in db
+    assert db.get(blockhash) == b'block rlp'
+    assert db.get_many([blockhash, sha3(b'x')]) == [b'block rlp', None]
+    assert sha3(b'x') not in db
+    db.freezer.append(b'uncommitted')
+    db.freezer.close()
+    db.open_freezer(db.freezer.path)  # drops items the db does not know about
+    assert db.freezer.count == 1
+
+
+def test_leveldb_compression(tmpdir):
+    path = os.path.join(str(tmpdir), 'leveldb')
+    db = leveldb_service.LevelDB(path, codecs=dict(hash='zlib'))
+    block = b'\x00' * 1000
+    db.put(sha3(block), block)
+    db.put(b'block:1', block)
+    db.commit()
+    assert len(db.db.Get(sha3(block))) < 100
+    assert len(db.db.Get(b'block:1')) == 1001
+    del db
+    db = leveldb_service.LevelDB(path)  # reading does not depend on the configured codecs
+    assert db.get(sha3(block)) == block
+    assert db.get(b'block:1') == block
+
+
+def test_codec_key_classes(tmpdir):
+    header = [b'\x00' * 32] * 15
+    body = rlp.encode([header, [], []])
+    node = rlp.encode([b'\x00' * 32] * 16 + [b''])
+    assert key_class(sha3(body), body) == 'body'
+    assert key_class(sha3(node), node) == 'node'
+    assert key_class(b'block:1', sha3(body)) == 'block'
+    db = leveldb_service.LevelDB(os.path.join(str(tmpdir), 'leveldb'),
+                                 codecs=dict(body='zlib', hash='none'))
+    db.put(sha3(body), body)
+    db.put(sha3(node), node)
+    db.commit()
+    assert len(db.db.Get(sha3(body))) < len(body)
+    assert len(db.db.Get(sha3(node))) == len(node) + 1
+    assert db.get(sha3(body)) == body
+
+
+def test_leveldb_untagged_values(tmpdir):
+    path = os.path.join(str(tmpdir), 'leveldb')
+    legacy = leveldb_service.leveldb.LevelDB(path)
+    legacy.Put(b'a', b'\x01' * 100)
+    del legacy
+    db = leveldb_service.LevelDB(path, codecs=dict(default='zlib'))
+    assert not db.codec.tagged
+    assert db.get(b'a') == b'\x01' * 100
+    db.put(b'b', b'\x01' * 100)
+    db.commit()
+    assert bytes(db.db.Get(b'b')) == b'\x01' * 100
+
+
+@pytest.mark.parametrize('workload', ['appends', 'mixed'])
+def test_db_bench(workload):
+    result = db_bench.run('LevelDB', 1024**2, workload, 120)
+    assert result['ops'] == 120
+    assert result['ops_per_sec'] > 0
+    assert 0 < result['p50'] <= result['p99']
+    assert result['peak_rss'] > 0
+
+
+@pytest.mark.parametrize('implementation', ['LevelDB', 'LmDB'])
+def test_namespace(tmpdir, implementation):
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(implementation=implementation,
+                                                            namespaces=dict(meta=1024))))
+    db = DBService(app)
+    meta = db.namespace('meta')
+    assert db.namespace('meta') is meta
+    assert meta.cache.max_size == 1024
+    meta.put(b'network_id', b'1')
+    db.put(b'network_id', b'legacy')
+    meta.commit()
+    assert meta.get(b'network_id') == b'1'
+    assert db.get(b'network_id') == b'legacy'
+    assert meta.get_many([b'network_id', b'x']) == [b'1', None]
+    meta.delete(b'network_id')
+    db.commit()
+    assert b'network_id' not in meta
+    assert meta.stats['writes'] == 1
+    assert meta.stats['column_family'] == (implementation == 'LmDB')
+
+
+@pytest.mark.parametrize('implementation', ['EphemDB', 'LmDB'])
+def test_routed_namespaces(tmpdir, implementation):
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(implementation=implementation)))
+    db = DBService(app)
+    blockhash = sha3(b'1')
+    db.put(b'block:1', blockhash)  # as written by the chain
+    db.put(b'state:1', blockhash)
+    db.commit()
+    assert db.get(b'block:1') == blockhash
+    assert db.get_many([b'block:1', b'block:2']) == [blockhash, None]
+    assert b'block:1' in db and b'block:2' not in db
+    block = db.namespace('block')
+    assert block.stats['writes'] == 1 and block.stats['reads'] == 5
+    assert not block.stats['column_family']  # still stored at the prefixed key
+    assert db.db_service.get(b'block:1') == blockhash
+    assert db.get(b'state:1') == blockhash
+    db.delete(b'block:1')
+    db.commit()
+    assert b'block:1' not in db
+    assert block.stats['deletes'] == 1
+
+
+def test_lmdb_write_path(tmpdir):
+    from pyethapp.lmdb_service import LmDBService
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(cache_size=1024**2)))
+    db = LmDBService(app)
+    for i in range(10):
+        db.put(b'block:%03d' % i, b'%d' % i)
+    db.commit()
+    assert len(db.uncommitted) == 0 and len(db.committing) == 0
+    assert db.get(b'block:000') == b'0'
+    assert len(db.uncommitted) == 0  # the read is cached, not buffered
+    assert b'block:000' in db.cache
+    db.put(b'block:010', b'10')  # appended
+    db.put(b'block:000', b'x')  # overwritten
+    db.delete(b'block:001')
+    db.commit()
+    assert b'block:000' not in db.cache
+    assert db.get_many([b'block:010', b'block:000', b'block:001']) == [b'10', b'x', None]
+    assert len(db.uncommitted) == 0
+    assert sorted(db.iterkeys())[0] == b'block:000'
+
+
+def test_ephemdb_fork():
+    app = BaseApp(config=dict(db=dict(implementation='EphemDB')))
+    genesis = DBService(app)
+    genesis.put(b'a', b'1')
+    genesis.put(b'b', b'2')
+    fork = genesis.fork(BaseApp(config=app.config))
+    assert fork.db_service.base is genesis.db_service.base
+    assert genesis.fork(app).db_service.base is fork.db_service.base  # nothing to merge
+    fork.put(b'a', b'x')
+    fork.delete(b'b')
+    fork.put(b'c', b'3')
+    assert fork.get_many([b'a', b'b', b'c']) == [b'x', None, b'3']
+    assert b'b' not in fork
+    with pytest.raises(KeyError):
+        fork.delete(b'b')
+    assert genesis.get_many([b'a', b'b', b'c']) == [b'1', b'2', None]
+    genesis.put(b'd', b'4')
+    grandchild = fork.fork(app)
+    assert grandchild.db_service.contents() == {b'a': b'x', b'c': b'3'}
+    assert b'd' not in fork and b'd' in genesis
+    # equal contents, but distinct services
+    assert len(set([fork.fork(app).db_service, fork.fork(app).db_service])) == 2
+
+
+def test_ephemdb_snapshot():
+    app = BaseApp(config=dict(db=dict(implementation='EphemDB')))
+    genesis = DBService(app)
+    genesis.put(b'a', b'1')
+    db = genesis.fork(BaseApp(config=app.config)).db_service
+    db.put(b'b', b'2')
+    snapshot = db.snapshot()
+    assert snapshot.overlays[1] is db.db  # read through, not copied
+    db.put(b'b', b'3')
+    db.put(b'b', b'4')
+    db.delete(b'a')
+    db.put(b'c', b'5')
+    assert snapshot.get_many([b'a', b'b', b'c']) == [b'1', b'2', None]
+    assert db.get_many([b'a', b'b', b'c']) == [None, b'4', b'5']
+    db.snapshot()  # dropped right away
+    assert len(db.snapshots) == 1
+    db.fork(app)  # merges the changes into a new base, nothing to preserve any more
+    assert len(db.snapshots) == 0
+    db.put(b'b', b'6')
+    assert snapshot.get(b'b') == b'2' and db.get(b'b') == b'6'
+
+
+def test_group_commit(tmpdir):
+    dbconfig = dict(implementation='LevelDB', group_commit=True, group_commit_blocks=3,
+                    bloom_filter=False)
+    db = DBService(BaseApp(config=dict(data_dir=str(tmpdir), db=dbconfig)))
+    for i in range(4):
+        db.begin_block()
+        db.put(b'block:%d' % i, b'%d' % i)
+        db.commit()
+        db.put(b'txindex:%d' % i, b'%d' % i)
+        db.commit()  # blocks are counted, not commits
+        db.end_block()
+        assert db.get(b'block:%d' % i) == b'%d' % i  # pending changes are readable
+    assert db.batches_written == 1
+    assert db.db_service.get(b'block:2') == b'2'
+    assert b'block:3' in db.db_service.uncommitted
+    assert db._last_group() == (1, 3, False)
+    # commits outside of a block neither count as one nor touch the marker
+    db.put(b'index', b'x')
+    db.commit()
+    assert db.pending_blocks == 1
+    # groups are only flushed between blocks
+    db.group_commit_bytes = 1
+    db.begin_block()
+    db.put(b'block:4', b'4')
+    db.commit()
+    assert db.batches_written == 1
+    db.end_block()
+    assert db.batches_written == 2
+    assert db._last_group() == (2, 2, False)
+    db.put(b'index', b'y')
+    db.commit()
+    assert db.batches_written == 3
+    assert db._last_group() == (2, 2, False)
+    db.begin_block()
+    db.put(b'block:5', b'5')
+    db.end_block(blocks=0)  # not imported
+    db.group_commit_bytes = 2**20
+    db.stop()
+    assert not db.db_service.uncommitted
+    assert db._last_group() == (2, 2, True)
+    # started again, stopped cleanly
+    db._open_group_log()
+    assert not db.group_recovered
+    assert db._last_group() == (2, 2, False)
+    # started again after a crash
+    db._open_group_log()
+    assert db.group_recovered
+    assert db.stats()['group_commit']['recovered']
+
+
+def test_db_maintenance(tmpdir):
+    from pyethapp.db_maintenance_service import DBMaintenanceService
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(bloom_filter=False),
+                              dbmaintenance=dict(compaction_ranges=4, compaction_min_writes=10,
+                                                 max_duty=1.)))
+    DBService.register_with_app(app)
+    maintenance = DBMaintenanceService(app)
+    assert maintenance.range_bounds(0) == (None, b'\x40')
+    assert maintenance.range_bounds(3) == (b'\xc0', None)
+    for i in range(20):
+        app.services.db.put(b'\x01%d' % i, b'x')
+    app.services.db.commit()
+    maintenance.maintain()  # written during the last round
+    assert maintenance.stats['compactions'] == 0
+    maintenance.maintain()
+    assert maintenance.stats['compactions'] == 1
+    maintenance.maintain()  # no writes since
+    assert maintenance.stats['compactions'] == 1
+    assert app.services.db.get(b'\x010') == b'x'
+
+
+def test_rocksdb(tmpdir):
+    pytest.importorskip('rocksdb')
+    from pyethapp.rocksdb_service import RocksDB
+    db = RocksDB(os.path.join(str(tmpdir), 'rocksdb'), cache_size=1024**2)
+    node = sha3(b'node')
+    db.put(node, b'1')
+    db.put(b'block:1', node)
+    db.commit()
+    assert len(db.uncommitted) == 0
+    assert db.get(node) == b'1'
+    assert node in db.cache
+    db.delete(b'block:1')
+    assert db.get_many([b'block:1', node, b'x']) == [None, b'1', None]
+    with db.snapshot() as snapshot:
+        db.commit()
+        assert snapshot.get(node) == b'1'
+        assert b'block:1' not in snapshot
+    assert sorted(db.iterkeys()) == [node]
+
+
+def test_db_metrics(tmpdir):
+    metrics_file = os.path.join(str(tmpdir), 'metrics.json')
+    app = BaseApp(config=dict(data_dir=str(tmpdir), db=dict(metrics_file=metrics_file,
+                                                            bloom_filter=False)))
+    db = DBService(app)
+    db.put(b'a', b'123')
+    assert db.get(b'a') == b'123'
+    db.commit()
+    assert db.get(b'a') == b'123'
+    with pytest.raises(KeyError):
+        db.get(b'b')
+    assert db.get_many([b'a', b'b']) == [b'123', None]
+    stats = db.stats()
+    assert stats['ops']['get']['count'] == 3
+    assert stats['ops']['commit']['count'] == 1
+    assert stats['commit_keys']['total'] >= 1
+    assert stats['bytes_read'] == 9
+    assert stats['misses'] == 2
+    assert stats['overlay_hits'] == 1
+    assert stats['cache']['hits'] == 1  # by get_many, the get after the commit read the db
+    db.stop()
+    with open(metrics_file) as f:
+        assert json.load(f)['ops']['put']['count'] == 1
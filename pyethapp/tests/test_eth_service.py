@@ -12,6 +12,7 @@ from pyethapp import eth_service
 from pyethapp import leveldb_service
 # from pyethapp import codernitydb_service
 from pyethapp import eth_protocol
+from pyethapp.sender_recovery import SenderRecovery
 from ethereum import slogging
 from ethereum.tools import tester
 from ethereum import config as eth_config
@@ -31,10 +32,7 @@ class AppMock(object):
             coinbase = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
 
         class peermanager(object):
-
-            @classmethod
-            def broadcast(*args, **kwargs):
-                pass
+            peers = []
 
     def __init__(self, db=None, config={}):
         self.services = self.Services()
@@ -104,6 +102,18 @@ def test_receive_newblock():
     eth.on_receive_newblock(proto, **d)
 
 
+def test_prepare_queued_blocks():
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    t_block = eth_protocol.ETHProtocol.newblock.decode_payload(decode_hex(newblk_rlp))['block']
+    eth.block_queue.put((t_block, None))
+    eth._prepare_queued_blocks()
+    block, error = t_block.preparation.get()
+    assert error is None
+    assert block.hash == t_block.header.hash
+    assert eth.import_stats()['decode']['count'] == 1
+
+
 def receive_blockheaders(rlp_data, leveldb=False, codernitydb=False):
     app = AppMock()
     if leveldb:
@@ -168,6 +178,46 @@ def test_head_candidate(test_app):
         assert len(chainservice.head_candidate.transactions) == i + 1
 
 
+def test_head_candidate_incremental(test_app):
+    chainservice = test_app.chain
+    for i in range(3):
+        chainservice.add_transaction(make_transaction(tester.keys[i], 0, 0, tester.accounts[2]))
+        incremental = chainservice.head_candidate
+    chainservice._head_candidate_needs_rebuild = True
+    rebuilt = chainservice.head_candidate
+    assert rebuilt.transactions == incremental.transactions
+    assert rebuilt.header.state_root == incremental.header.state_root
+
+    # updates are debounced, rebuilds are not
+    chainservice.head_candidate_debounce = 3600
+    chainservice.add_transaction(make_transaction(tester.keys[3], 0, 0, tester.accounts[2]))
+    assert len(chainservice.head_candidate.transactions) == 3
+    chainservice._head_candidate_needs_rebuild = True
+    assert len(chainservice.head_candidate.transactions) == 4
+
+
+def test_add_transactions(test_app):
+    chainservice = test_app.chain
+    sent = []
+
+    class PeerMock(object):
+        protocols = {eth_protocol.ETHProtocol: type('ProtoMock', (object,), dict(
+            send_transactions=staticmethod(lambda *txs: sent.append(txs))))}
+        safe_to_read = type('EventMock', (object,), dict(wait=staticmethod(lambda: None)))
+
+    peer = PeerMock()
+    test_app.services.peermanager = type('PeerManagerMock', (object,), dict(peers=[peer]))
+    chainservice.known_txs[peer] = eth_service.DuplicatesFilter()
+    first, second = [make_transaction(tester.keys[0], n, 0, tester.accounts[2]) for n in (0, 1)]
+    gap = make_transaction(tester.keys[1], 5, 0, tester.accounts[2])
+    chainservice.known_txs[peer].add(first.hash)
+    chainservice.add_transactions([second, first, second, gap])
+    # ordered by nonce, the duplicate and the nonce gap are dropped, the peer knew `first`
+    assert sent == [(second,)]
+    assert [tx.nonce for tx in chainservice.head_candidate.transactions] == [0, 1]
+    assert second.hash in chainservice.known_txs[peer]
+
+
 def make_transaction(key, nonce, value, to):
     gasprice = 20 * 10**9
     startgas = 500 * 1000
@@ -245,3 +295,94 @@ def test_query_headers(test_app):
     assert len(headers) == 5
     assert headers[0].number == 10
     assert headers[-1].number == 14
+
+
+def test_duplicates_filter():
+    f = eth_service.DuplicatesFilter(max_items=4)
+    assert f.update(b'a')
+    assert not f.update(b'a')
+    for item in (b'b', b'c', b'd'):
+        assert f.update(item)
+    assert b'a' in f and b'd' in f  # two generations of two items
+    assert f.update(b'e')
+    assert b'a' not in f and b'b' not in f
+    assert len(f) == 3
+
+
+def broadcast_peer(app, eth, sent):
+    "a connected peer whose eth protocol records what it is sent"
+    peer = PeerMock(app)
+    proto = eth_protocol.ETHProtocol(peer, eth)
+    proto.send_transactions = lambda *txs: sent.append((proto, txs))
+    peer.protocols = {eth_protocol.ETHProtocol: proto}
+    peer.safe_to_read = type('EventMock', (object,), dict(wait=staticmethod(lambda: None)))
+    app.services.peermanager.peers.append(peer)
+    eth.on_wire_protocol_start(proto)
+    return proto
+
+
+def test_broadcast_skips_peers_knowing_item():
+    app = AppMock()
+    app.services.peermanager = type('PeerManagerMock', (object,), dict(peers=[]))
+    eth = eth_service.ChainService(app)
+    sent = []
+    proto, other = broadcast_peer(app, eth, sent), broadcast_peer(app, eth, sent)
+    tx = Transaction(0, 1, 21000, b'\x00' * 20, 0, b'')
+    eth._mark_known(eth.known_txs, other, tx.hash)
+    eth.broadcast_transaction(tx)
+    assert sent == [(proto, (tx,))]
+    assert tx.hash in eth.known_txs[proto.peer]
+    eth.on_wire_protocol_stop(other)
+    assert other.peer not in eth.known_txs
+
+
+def test_broadcast_marks_only_recipients():
+    app = AppMock()
+    app.services.peermanager = type('PeerManagerMock', (object,), dict(peers=[]))
+    eth = eth_service.ChainService(app)
+    sent, late = [], []
+    proto = broadcast_peer(app, eth, sent)
+
+    def send_transactions(*txs):
+        # a peer completes its handshake while the broadcast is under way
+        late.append(broadcast_peer(app, eth, sent))
+        sent.append((proto, txs))
+
+    proto.send_transactions = send_transactions
+    tx = Transaction(0, 1, 21000, b'\x00' * 20, 0, b'')
+    eth.broadcast_transaction(tx)
+    assert sent == [(proto, (tx,))]
+    assert tx.hash in eth.known_txs[proto.peer]
+    assert tx.hash not in eth.known_txs[late[0].peer]
+
+
+def test_block_queue_index():
+    class TBlock(object):
+        def __init__(self, h):
+            self.header = type('Header', (object,), dict(hash=h))
+
+    q = eth_service.BlockQueue(maxsize=4)
+    a, b = TBlock(b'a'), TBlock(b'b')
+    q.put((a, None))
+    q.put((b, None))
+    q.put((a, None))
+    assert b'a' in q and b'b' in q and b'c' not in q
+    assert q.peek()[0] is a
+    q.get()
+    assert b'a' in q  # queued twice
+    q.get()
+    assert b'b' not in q
+    q.get()
+    assert not q.hashes
+
+
+def test_sender_recovery():
+    txs = [make_transaction(tester.keys[i % 5], i, 0, tester.accounts[2]) for i in range(40)]
+    received = [rlp.decode(rlp.encode(tx), Transaction) for tx in txs]
+    recovery = SenderRecovery(2)
+    try:
+        recovery.recover(received)
+    finally:
+        recovery.stop()
+    assert recovery.recovered == len(txs)
+    assert [tx._sender for tx in received] == [tx.sender for tx in txs]
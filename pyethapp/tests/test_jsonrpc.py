@@ -16,10 +16,12 @@ import serpent
 import ethereum
 import ethereum.config
 import ethereum.tools.keys
+from ethereum.meta import make_head_candidate
 from ethereum.pow.ethpow import mine
 from ethereum.tools import tester
 from ethereum.slogging import get_logger, configure_logging
 from ethereum.state import State
+from ethereum.transaction_queue import TransactionQueue
 from ethereum.utils import (
     decode_hex,
     encode_hex,
@@ -134,6 +136,10 @@ def test_compile_solidity():
     assert compiler_info['abiDefinition'] == info['abiDefinition']
 
 
+# committed db of a freshly set up test app per fixture param, forked for the later ones
+genesis_dbs = dict()
+
+
 @pytest.fixture(params=[0,
     PROFILES['testnet']['eth']['block']['ACCOUNT_INITIAL_NONCE']])
 def test_app(request, tmpdir):
@@ -252,7 +258,12 @@ def test_app(request, tmpdir):
     update_config_with_defaults(config, {'eth': {'block': ethereum.config.default_config}})
     app = TestApp(config)
     for service in services:
-        service.register_with_app(app)
+        if service is DBService and request.param in genesis_dbs:
+            app.register_service(genesis_dbs[request.param].fork(app))
+        else:
+            service.register_with_app(app)
+    if request.param not in genesis_dbs:
+        genesis_dbs[request.param] = app.services.db.fork(app)
 
     def fin():
         log.debug('stopping test app')
@@ -910,3 +921,114 @@ def test_eth_nonce(test_app):
     assert (
         int(test_app.client.call('eth_nonce', address_encoder(tester.accounts[0])), 16) ==
         test_app.config['eth']['block']['ACCOUNT_INITIAL_NONCE'] + 2)
+
+
+def test_debug_db_stats(test_app):
+    stats = test_app.client.call('debug_dbStats')
+    assert stats['implementation'] == 'EphemDB'
+    assert stats['ops']['get']['count'] > 0
+    assert stats['bytes_written'] > 0
+
+
+def test_tx_index(test_app):
+    chainservice = test_app.services.chain
+    tx = {
+        'from': address_encoder(test_app.services.accounts.unlocked_accounts[0].address),
+        'to': address_encoder(b'\xff' * 20),
+        'value': quantity_encoder(1)
+    }
+    tx_hash = test_app.client.call('eth_sendTransaction', tx)
+    head = test_app.mine_next_block()
+    assert chainservice.txloc.get(data_decoder(tx_hash)) == rlp.encode([head.hash, 0])
+    found = test_app.client.call('eth_getTransactionByHash', tx_hash)
+    assert found['blockHash'] == data_encoder(head.hash)
+    progress = test_app.client.call('debug_txIndexProgress')
+    assert progress['enabled'] and progress['last'] == 1 and progress['progress'] == 1
+
+    # removed when the block leaves the window of a bounded index
+    chainservice.txindex_blocks = 1
+    test_app.mine_next_block()
+    assert data_decoder(tx_hash) not in chainservice.txloc
+    assert test_app.client.call('debug_txIndexProgress')['first'] == 2
+    # still found through the chain's own index
+    assert test_app.client.call('eth_getTransactionByHash', tx_hash)['blockHash'] == \
+        data_encoder(head.hash)
+
+
+def add_side_block(test_app, parent, txs=()):
+    "mines a block on `parent` including `txs` and adds it to the chain"
+    chain = test_app.services.chain.chain
+    txqueue = TransactionQueue()
+    for tx in txs:
+        txqueue.add_transaction(tx)
+    # as old as possible, so it is not delayed in the time queue
+    block, _ = make_head_candidate(chain, txqueue, parent=parent, timestamp=parent.timestamp + 1)
+    bin_nonce, mixhash = mine(block.number, block.difficulty, block.mining_hash,
+                              start_nonce=0, rounds=10 ** 6)
+    block.header.mixhash = mixhash
+    block.header.nonce = bin_nonce
+    chain.add_block(block)
+    assert chain.has_blockhash(block.hash)
+    return block
+
+
+def test_tx_index_reorg(test_app):
+    chainservice = test_app.services.chain
+    chain = chainservice.chain
+    sender = address_encoder(test_app.services.accounts.unlocked_accounts[0].address)
+    for value in (1, 2):
+        test_app.client.call('eth_sendTransaction',
+                             {'from': sender, 'to': address_encoder(b'\xff' * 20),
+                              'value': quantity_encoder(value)})
+    head = test_app.mine_next_block()
+    included, orphaned = head.transactions
+    assert chainservice.txloc.get(orphaned.hash) == rlp.encode([head.hash, 1])
+
+    # a longer fork of the genesis including only the first transaction becomes the head
+    side = add_side_block(test_app, chain.genesis, [included])
+    assert chain.head_hash == head.hash
+    assert chainservice.txloc.get(included.hash) == rlp.encode([head.hash, 0])
+    new_head = add_side_block(test_app, side)
+    assert chain.head_hash == new_head.hash
+
+    # re-pointed to the new chain
+    assert chainservice.txloc.get(included.hash) == rlp.encode([side.hash, 0])
+    found = test_app.client.call('eth_getTransactionByHash', data_encoder(included.hash))
+    assert found['blockHash'] == data_encoder(side.hash)
+    # not included by the new chain
+    assert orphaned.hash not in chainservice.txloc
+    assert chainservice.txindex_head == new_head.hash
+
+
+def test_receipts(test_app):
+    chainservice = test_app.services.chain
+    tx = {
+        'from': address_encoder(test_app.services.accounts.unlocked_accounts[0].address),
+        'to': address_encoder(b'\xff' * 20),
+        'value': quantity_encoder(1)
+    }
+    tx_hash = test_app.client.call('eth_sendTransaction', tx)
+    # computed for the pending block, but not stored as its hash changes with every tx
+    pending = chainservice.head_candidate
+    assert len(chainservice.get_receipts(pending)) == 1
+    assert pending.hash not in chainservice.receipts
+
+    # stored when imported
+    head = test_app.mine_next_block()
+    assert chainservice.has_receipts(head)
+    gas_used = chainservice.get_receipts(head)[0].gas_used
+    receipt = test_app.client.call('eth_getTransactionReceipt', tx_hash)
+    assert receipt['blockHash'] == data_encoder(head.hash)
+
+    # computed and stored on a miss
+    chainservice.receipts.delete(head.hash)
+    assert not chainservice.has_receipts(head)
+    assert chainservice.get_receipts(head)[0].gas_used == gas_used
+    assert chainservice.has_receipts(head)
+
+    # the backfill skips blocks with stored receipts or without transactions
+    test_app.mine_next_block()
+    assert chainservice.backfill_receipts(1, 2) == 0
+    chainservice.receipts.delete(head.hash)
+    assert chainservice.backfill_receipts(1, 2) == 1
+    assert chainservice.has_receipts(head)
@@ -0,0 +1,101 @@
+from builtins import range
+from ethereum.tools import tester
+from ethereum.transactions import Transaction
+import rlp
+from pyethapp.tx_pool import TxPool
+
+
+def make_tx(key, nonce, gasprice, startgas=21000):
+    tx = Transaction(nonce, gasprice, startgas, b'\x00' * 20, 0, b'')
+    tx.sign(key)
+    return tx
+
+
+def pop_all(pool, **kwargs):
+    txs = []
+    tx = pool.pop_transaction(**kwargs)
+    while tx is not None:
+        txs.append(tx)
+        tx = pool.pop_transaction(**kwargs)
+    return txs
+
+
+def test_nonce_order_per_sender():
+    pool = TxPool()
+    # the later nonce pays more but can only be executed after the first one
+    a = [make_tx(tester.k0, 0, 10), make_tx(tester.k0, 1, 50)]
+    b = [make_tx(tester.k1, 0, 20)]
+    for tx in reversed(a + b):
+        assert pool.add_transaction(tx)
+    assert len(pool) == 3
+    assert pop_all(pool) == [b[0], a[0], a[1]]
+    assert len(pool) == 0
+
+
+def test_replace_and_aside():
+    pool = TxPool()
+    tx = make_tx(tester.k0, 0, 10)
+    assert pool.add_transaction(tx)
+    assert not pool.add_transaction(make_tx(tester.k0, 0, 10))
+    replacement = make_tx(tester.k0, 0, 11)
+    assert pool.add_transaction(replacement)
+    assert pool.txs == [replacement]
+
+    big = make_tx(tester.k1, 0, 100, startgas=100000)
+    assert pool.add_transaction(big)
+    assert pool.pop_transaction(max_gas=50000) == replacement
+    assert pool.pop_transaction(max_gas=50000) is None
+    assert pool.pop_transaction(max_gas=100000) == big
+
+
+def test_copy():
+    pool = TxPool()
+    txs = [make_tx(tester.k0, n, 10) for n in range(3)]
+    for tx in txs:
+        pool.add_transaction(tx)
+    assert pop_all(pool.copy()) == txs
+    assert len(pool) == 3
+    assert pool.txs == txs
+
+
+def test_bounds_evict_cheapest():
+    pool = TxPool(max_txs=3)
+    cheap = [make_tx(tester.k0, n, 10) for n in range(2)]
+    for tx in cheap:
+        assert pool.add_transaction(tx)
+    assert pool.add_transaction(make_tx(tester.k1, 0, 20))
+    # not paying more than the cheapest
+    assert not pool.add_transaction(make_tx(tester.k2, 0, 10))
+    assert len(pool) == 3
+    # the cheapest goes with the later nonces of its sender
+    expensive = make_tx(tester.k2, 0, 30)
+    assert pool.add_transaction(expensive)
+    assert len(pool) == 2
+    assert pool.evicted == 2
+    assert pool.pop_transaction() == expensive
+
+    txs = [make_tx(key, 0, price) for key, price in ((tester.k0, 10), (tester.k1, 11),
+                                                       (tester.k2, 12))]
+    max_bytes = sum(len(rlp.encode(tx)) for tx in txs) - 1
+    pool = TxPool(max_bytes=max_bytes)
+    for tx in txs:
+        assert pool.add_transaction(tx)
+    assert pool.txs == txs[1:]
+    assert pool.num_bytes <= max_bytes
+    # forced transactions get in and are not evicted
+    forced = make_tx(tester.k0, 0, 1)
+    assert pool.add_transaction(forced, force=True)
+    assert sorted(pool.txs, key=lambda tx: tx.gasprice) == [forced, txs[2]]
+    assert pool.pop_transaction() == forced
+
+
+def test_remove_included():
+    pool = TxPool()
+    txs = [make_tx(tester.k0, n, 10) for n in range(4)]
+    other = make_tx(tester.k1, 0, 5)
+    for tx in txs + [other]:
+        pool.add_transaction(tx)
+    # a block including nonce 1 makes nonce 0 invalid too
+    assert pool.diff([txs[1], make_tx(tester.k2, 0, 10)]) is pool
+    assert len(pool) == 3
+    assert pop_all(pool) == [txs[2], txs[3], other]
@@ -53,9 +53,7 @@ class ChainServiceMock(BaseService):
 
 class PeerManagerMock(BaseService):
     name = 'peermanager'
-
-    def broadcast(*args, **kwargs):
-        pass
+    peers = []
 
 @pytest.fixture()
 def test():
@@ -0,0 +1,236 @@
+# -*- coding: utf8 -*-
+from __future__ import absolute_import
+from builtins import object
+import heapq
+import itertools
+import rlp
+from ethereum.slogging import get_logger
+
+log = get_logger('eth.txpool')
+
+PRIO_INFINITY = -2**100  # as in ethereum.transaction_queue, forced transactions come first
+
+
+class PooledTx(object):
+
+    "a transaction of the pool, never modified so copies of the pool can share it"
+
+    __slots__ = ('tx', 'sender', 'nonce', 'prio', 'size', 'counter')
+
+    def __init__(self, tx, sender, prio, size, counter):
+        self.tx = tx
+        self.sender = sender
+        self.nonce = tx.nonce
+        self.prio = prio
+        self.size = size
+        self.counter = counter
+
+
+def _bisect(lane, nonce):
+    "index of the first transaction in `lane` with a nonce not lower than `nonce`"
+    lo, hi = 0, len(lane)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if lane[mid].nonce < nonce:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class TxPool(object):
+
+    """Pending transactions, ordered by nonce per sender and by gas price across senders.
+
+    Every sender has a lane of its transactions sorted by nonce. Only the first transaction of
+    a lane can be executed next, the lane heads are kept in a heap by gas price and
+    :meth:`pop_transaction` takes the best paying one and then pushes the next transaction of
+    its lane. Outdated heap entries are skipped when they come up.
+
+    The pool holds at most `max_txs` transactions of together `max_bytes` RLP encoded bytes.
+    When it is full the cheapest transaction is evicted together with the later nonces of its
+    sender, which could not be executed anymore, a new transaction paying no more than the
+    cheapest one is rejected. Forced transactions are never evicted.
+
+    Can be used in place of :class:`ethereum.transaction_queue.TransactionQueue`, but
+    :meth:`diff` removes the included transactions in place.
+    """
+
+    max_txs = 4096
+    max_bytes = 16 * 1024**2
+
+    def __init__(self, max_txs=None, max_bytes=None):
+        if max_txs is not None:
+            self.max_txs = max_txs
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.lanes = dict()  # sender -> [PooledTx], sorted by nonce
+        self.executable = []  # heap of (prio, counter, PooledTx) of the lane heads
+        self.aside = []  # heap of (startgas, counter, PooledTx) too big for the last block
+        self.cheapest = []  # heap of (gasprice, counter, PooledTx) of evictable transactions
+        self.counter = itertools.count()
+        self.num_txs = 0
+        self.num_bytes = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.num_txs
+
+    @property
+    def txs(self):
+        "all pooled transactions, in nonce order per sender"
+        return [p.tx for lane in self.lanes.values() for p in lane]
+
+    def peek(self, num=None):
+        """Return up to `num` transactions, all if `None`, in nonce order per sender."""
+        txs = self.txs
+        return txs[:num] if num else txs
+
+    def _contains(self, pooled):
+        lane = self.lanes.get(pooled.sender)
+        if not lane:
+            return False
+        i = _bisect(lane, pooled.nonce)
+        return i < len(lane) and lane[i] is pooled
+
+    def _is_head(self, pooled):
+        lane = self.lanes.get(pooled.sender)
+        return bool(lane) and lane[0] is pooled
+
+    def _push_head(self, lane):
+        head = lane[0]
+        heapq.heappush(self.executable, (head.prio, head.counter, head))
+
+    def add_transaction(self, tx, force=False):
+        """Add `tx`, replacing a transaction of the same sender and nonce paying less.
+
+        :returns: `False` if `tx` was rejected
+        """
+        pooled = PooledTx(tx, tx.sender, PRIO_INFINITY if force else -tx.gasprice,
+                          len(rlp.encode(tx)), next(self.counter))
+        lane = self.lanes.get(pooled.sender, [])
+        i = _bisect(lane, pooled.nonce)
+        if i < len(lane) and lane[i].nonce == pooled.nonce:
+            if pooled.prio >= lane[i].prio:
+                log.debug('tx not paying more than the pooled one', tx=tx)
+                return False
+            self._remove(pooled.sender, i, i + 1)
+        if not self._make_room(pooled):
+            log.debug('tx pool full', tx=tx, num_txs=self.num_txs, num_bytes=self.num_bytes)
+            return False
+        # making room might have evicted transactions of the sender
+        lane = self.lanes.setdefault(pooled.sender, [])
+        i = _bisect(lane, pooled.nonce)
+        lane.insert(i, pooled)
+        self.num_txs += 1
+        self.num_bytes += pooled.size
+        if not force:
+            heapq.heappush(self.cheapest, (tx.gasprice, pooled.counter, pooled))
+        if i == 0:
+            self._push_head(lane)
+        self._compact()
+        return True
+
+    def _make_room(self, pooled):
+        if pooled.size > self.max_bytes:
+            return False
+        while self.num_txs >= self.max_txs or self.num_bytes + pooled.size > self.max_bytes:
+            while self.cheapest and not self._contains(self.cheapest[0][2]):
+                heapq.heappop(self.cheapest)
+            if not self.cheapest:
+                return False
+            gasprice, _, cheapest = self.cheapest[0]
+            if pooled.prio != PRIO_INFINITY and pooled.tx.gasprice <= gasprice:
+                return False
+            if cheapest.sender == pooled.sender and cheapest.nonce < pooled.nonce:
+                return False  # would leave `pooled` behind a nonce gap
+            lane = self.lanes[cheapest.sender]
+            i = _bisect(lane, cheapest.nonce)
+            self.evicted += len(lane) - i
+            self._remove(cheapest.sender, i, len(lane))
+        return True
+
+    def _remove(self, sender, start, end):
+        "removes ``lane[start:end]`` of `sender`, the heaps are cleaned up lazily"
+        lane = self.lanes[sender]
+        for p in lane[start:end]:
+            self.num_txs -= 1
+            self.num_bytes -= p.size
+        del lane[start:end]
+        if not lane:
+            del self.lanes[sender]
+        elif start == 0:
+            self._push_head(lane)
+
+    def _compact(self):
+        # drop outdated heap entries once they outnumber the live ones
+        if len(self.executable) + len(self.aside) > 2 * len(self.lanes) + 64:
+            self.executable = [e for e in self.executable if self._is_head(e[2])]
+            heapq.heapify(self.executable)
+            self.aside = [e for e in self.aside if self._is_head(e[2])]
+            heapq.heapify(self.aside)
+        if len(self.cheapest) > 2 * self.num_txs + 64:
+            self.cheapest = [e for e in self.cheapest if self._contains(e[2])]
+            heapq.heapify(self.cheapest)
+
+    def pop_transaction(self, max_gas=9999999999, max_seek_depth=16, min_gasprice=0):
+        """Remove and return the best paying executable transaction using at most `max_gas`.
+
+        Transactions using more gas are set aside until a call with enough `max_gas`. Returns
+        `None` if none is found within `max_seek_depth` transactions or the best one pays less
+        than `min_gasprice`.
+        """
+        while self.aside and self.aside[0][0] <= max_gas:
+            _, counter, pooled = heapq.heappop(self.aside)
+            heapq.heappush(self.executable, (pooled.prio, counter, pooled))
+        depth = 0
+        while self.executable and depth < max_seek_depth:
+            prio, counter, pooled = self.executable[0]
+            if not self._is_head(pooled):
+                heapq.heappop(self.executable)
+                continue
+            depth += 1
+            if pooled.tx.startgas > max_gas:
+                heapq.heappop(self.executable)
+                heapq.heappush(self.aside, (pooled.tx.startgas, counter, pooled))
+            elif pooled.tx.gasprice >= min_gasprice or prio == PRIO_INFINITY:
+                heapq.heappop(self.executable)
+                self._remove(pooled.sender, 0, 1)
+                return pooled.tx
+            else:
+                return None
+        return None
+
+    def remove(self, txs):
+        """Remove `txs` and the transactions their nonces make invalid.
+
+        Takes time in the number of `txs`, not the size of the pool.
+        """
+        for tx in txs:
+            try:
+                sender = tx.sender
+            except Exception:
+                continue
+            lane = self.lanes.get(sender)
+            if lane:
+                end = _bisect(lane, tx.nonce + 1)
+                if end:
+                    self._remove(sender, 0, end)
+        self._compact()
+
+    def diff(self, txs):
+        """Remove `txs` like :meth:`remove` and return the pool."""
+        self.remove(txs)
+        return self
+
+    def copy(self):
+        """Return a copy sharing the transactions, e.g. to build a block from."""
+        pool = TxPool(self.max_txs, self.max_bytes)
+        pool.lanes = dict((sender, list(lane)) for sender, lane in self.lanes.items())
+        pool.executable = list(self.executable)
+        pool.aside = list(self.aside)
+        pool.cheapest = list(self.cheapest)
+        pool.counter = itertools.count(next(self.counter))
+        pool.num_txs = self.num_txs
+        pool.num_bytes = self.num_bytes
+        return pool